@@ -0,0 +1,105 @@
+"""Backup catalog update cost with large backup lists.
+
+Times a backup-list refresh with the previous list-of-dicts approach and
+with BackupCatalog (cold, unchanged output, one backup added and one
+deleted) for the PostgreSQL and MySQL exporters.
+
+    python3 bench/bench_backup_catalog.py [backups]
+"""
+import datetime
+import json
+import os
+import sys
+import time
+
+BACKUPS = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'mysql'))
+import exporter  # noqa: E402
+from prometheus_client import REGISTRY  # noqa: E402
+# Both scripts register the same self-metrics; only their catalogs are used here
+for collector in list(REGISTRY._collector_to_names):
+    REGISTRY.unregister(collector)
+import mysql_exporter  # noqa: E402
+
+
+def backup_list(first, count):
+    start = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    bbs = []
+    for i in range(first, first + count):
+        started = start + datetime.timedelta(hours=i)
+        finished = started + datetime.timedelta(minutes=10)
+        bbs.append({
+            'backup_name': 'base_%024X' % (i * 4 + 2),
+            'time': finished.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            'wal_file_name': '%024X' % (i * 4 + 2),
+            'start_time': started.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            'finish_time': finished.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            'date_fmt': '%Y-%m-%dT%H:%M:%S.%fZ',
+            'hostname': 'db1',
+            'data_dir': '/var/lib/postgresql/data',
+            'pg_version': 150000,
+            'start_lsn': i * 0x4000000,
+            'finish_lsn': i * 0x4000000 + 0x1000,
+            'is_permanent': i % 100 == 0,
+            'system_identifier': 7000000000000000000,
+            'uncompressed_size': 10 ** 9 + i,
+            'compressed_size': 3 * 10 ** 8 + i,
+        })
+    return json.dumps(bbs).encode()
+
+
+def previous_update(old_bbs, output):
+    # update_basebackup() before the catalog: every backup re-parsed and
+    # membership checked against name lists
+    def format_date(bb):
+        bb['date_fmt'] = bb['date_fmt'].replace('Z', '%z')
+        bb['time'] = exporter.parse_date(bb['time'], bb['date_fmt'])
+        bb['start_time'] = exporter.parse_date(bb['start_time'], bb['date_fmt'])
+        bb['finish_time'] = exporter.parse_date(bb['finish_time'], bb['date_fmt'])
+        return bb
+
+    new_bbs = list(map(format_date, json.loads(output)))
+    new_bbs.sort(key=lambda bb: bb['start_time'])
+    new_bbs_name = [bb['backup_name'] for bb in new_bbs]
+    old_bbs_name = [bb['backup_name'] for bb in old_bbs]
+    deleted = [bb for bb in old_bbs if bb['backup_name'] not in new_bbs_name]
+    added = [bb for bb in new_bbs if bb['backup_name'] not in old_bbs_name]
+    for bb in added:
+        (exporter.convert_size(bb['uncompressed_size']),
+         exporter.convert_size(bb['compressed_size']))
+    return new_bbs, added, deleted
+
+
+def timed(fn, *fn_args):
+    started = time.perf_counter()
+    result = fn(*fn_args)
+    return result, time.perf_counter() - started
+
+
+def main():
+    current = backup_list(0, BACKUPS)
+    rotated = backup_list(1, BACKUPS)
+
+    print('%d backups, %.1f MB of backup-list output' % (BACKUPS, len(current) / 2 ** 20))
+    (old_bbs, _, _), cold = timed(previous_update, [], current)
+    _, unchanged = timed(previous_update, old_bbs, current)
+    _, rotate = timed(previous_update, old_bbs, rotated)
+    print('%-24s cold %7.3fs  unchanged %7.3fs  +1/-1 %7.3fs' % (
+        'previous', cold, unchanged, rotate))
+
+    for name, catalog in (('pg BackupCatalog', exporter.BackupCatalog()),
+                          ('mysql BackupCatalog', mysql_exporter.BackupCatalog())):
+        delta, cold = timed(catalog.update, current)
+        assert len(delta[0]) == BACKUPS
+        delta, unchanged = timed(catalog.update, current)
+        assert delta is None
+        delta, rotate = timed(catalog.update, rotated)
+        assert (len(delta[0]), len(delta[1])) == (1, 1)
+        print('%-24s cold %7.3fs  unchanged %7.3fs  +1/-1 %7.3fs' % (
+            name, cold, unchanged, rotate))
+
+
+if __name__ == '__main__':
+    main()
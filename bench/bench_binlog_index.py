@@ -0,0 +1,122 @@
+"""Binlog archive index of the MySQL exporter against a file storage.
+
+Checks that the integrity stays OK while several binlogs are uploaded
+between two cycles (out of order too), that a deleted binlog shows up as
+a gap after the next full listing and that the upload backlog is unknown
+(-1) while binlog-find fails but not while it is skipped, then reports
+the cost of a full listing of binlog_005/ and of an incremental cycle.
+
+    python3 bench/bench_binlog_index.py [binlogs]
+"""
+import datetime
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BINLOGS = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'mysql'))
+import mysql_exporter  # noqa: E402
+import walg_common  # noqa: E402
+
+
+def upload(storage_dir, *seqs):
+    for seq in seqs:
+        open(os.path.join(storage_dir, 'binlog_005', 'mysql-bin.%06d.br' % seq), 'w').close()
+
+
+class BinlogFind:
+    # Runner stand-in, binlog-find prints the latest upload, fails or is
+    # skipped for backoff
+    def __init__(self, latest=None, skipped=False):
+        self.latest = latest
+        self.skipped = skipped
+
+    def run(self, name, args):
+        if self.skipped:
+            raise walg_common.CommandSkipped('binlog-find backing off')
+        if self.latest is None:
+            raise subprocess.CalledProcessError(1, args)
+        return walg_common.CommandResult(b'', ('INFO: found %s\n' % self.latest).encode())
+
+
+class BinlogStatus:
+    # Connection stand-in, closed binlogs 1-5 of 100 bytes and 6 active
+    def binlog_snapshot(self):
+        binlogs = [{'Log_name': 'mysql-bin.%06d' % seq, 'File_size': 100} for seq in range(1, 7)]
+        return mysql_exporter.BinlogSnapshot(binlogs, {'File': 'mysql-bin.000006'}, '')
+
+
+def value(gauge):
+    return gauge.collect()[0].samples[0].value
+
+
+def check_backlog():
+    instance = mysql_exporter.MySQLExporter({}, runner=BinlogFind('mysql-bin.000003'), archive_dir=os.devnull,
+                                            registry=mysql_exporter.CollectorRegistry())
+    instance.db = BinlogStatus()
+    instance.update_binlogs()
+    assert (value(instance.pending_files), value(instance.pending_bytes)) == (2, 200), instance.binlog_backlog
+    # A skipped binlog-find keeps counting from the last identified upload
+    instance.runner = BinlogFind(skipped=True)
+    instance.update_binlogs()
+    assert (value(instance.pending_files), value(instance.pending_bytes)) == (2, 200), instance.binlog_backlog
+    # A failed binlog-find leaves the backlog unknown instead of every closed binlog pending
+    instance.runner = BinlogFind()
+    instance.update_binlogs()
+    assert instance.binlog_backlog is None, instance.binlog_backlog
+    assert (value(instance.pending_files), value(instance.pending_bytes),
+            value(instance.pending_oldest_age)) == (-1, -1, -1)
+
+
+def cycle(instance, active):
+    instance.latest_active_binlog = 'mysql-bin.%06d' % active
+    started = time.perf_counter()
+    instance.update_binlog_index()
+    instance.update_binlog_integrity()
+    return instance.binlog_integrity, time.perf_counter() - started
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    mysql_exporter.configure(['--archive_dir', os.devnull, '--config', os.devnull])
+    check_backlog()
+    with tempfile.TemporaryDirectory(prefix='walg-binlogs-') as storage_dir:
+        os.mkdir(os.path.join(storage_dir, 'binlog_005'))
+        upload(storage_dir, *range(1, BINLOGS + 1))
+        instance = mysql_exporter.MySQLExporter({}, runner=mysql_exporter.WalgRunner(os.devnull),
+                                                storage=walg_common.FileStorage(storage_dir))
+        instance.bbs = [mysql_exporter.MySQLBackup({
+            'backup_name': 'stream_1', 'binlog_start': 'mysql-bin.000001',
+            'start_time': datetime.datetime(2020, 1, 1).isoformat()})]
+        # A state file written from binlog-find alone: only the newest binlog is known
+        instance.binlog_index.add('mysql-bin.%06d' % BINLOGS)
+
+        integrity, full = cycle(instance, BINLOGS + 1)
+        assert integrity == (BINLOGS, 0, None), integrity
+
+        # Several uploads between two cycles, one of them late
+        high = BINLOGS
+        for batch in ((1, 2, 3), (5, 6), (4,), (9, 7, 8)):
+            seqs = [BINLOGS + i for i in batch]
+            upload(storage_dir, *seqs)
+            high = max(high, *seqs)
+            integrity, incremental = cycle(instance, high + 1)
+            if batch != (5, 6):
+                assert integrity == (high, 0, None), (batch, integrity)
+
+        # A binlog deleted from the storage is caught by the full listing
+        os.remove(os.path.join(storage_dir, 'binlog_005', 'mysql-bin.%06d.br' % (BINLOGS // 2)))
+        instance.update_binlog_index(full=True)
+        instance.update_binlog_integrity()
+        assert instance.binlog_integrity == (high - 1, 1, (BINLOGS // 2, BINLOGS // 2)), instance.binlog_integrity
+
+    print('%d binlogs: full listing %.3fs, incremental cycle %.4fs' % (BINLOGS, full, incremental))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""Startup cost of both exporters.
+
+Reported per exporter, as the median of several fresh processes:
+
+- import: time to import the module in a fresh interpreter, and whether
+  the database driver or dotenv got imported with it (they should not)
+- first scrape: from spawning the exporter to the first 200 on /metrics,
+  with an unreachable database and bench/fake-wal-g as WALG_BINARY_PATH
+
+    python3 bench/bench_startup.py [--exporter pg|mysql|all] [--runs 5] [--json out.json]
+
+The exporters listen on port 9351, which must be free.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+FAKE_WALG = os.path.join(HERE, 'fake-wal-g')
+PORT = 9351
+TIMEOUT = 30
+
+EXPORTERS = {
+    'pg': (ROOT, 'exporter', ['psycopg2', 'dotenv']),
+    'mysql': (os.path.join(ROOT, 'mysql'), 'mysql_exporter', ['pymysql', 'dotenv']),
+}
+
+IMPORT_SNIPPET = '''
+import json, sys, time
+sys.path.insert(0, %r)
+started = time.perf_counter()
+import %s
+print(json.dumps([time.perf_counter() - started, [m for m in %r if m in sys.modules]]))
+'''
+
+
+def time_import(name):
+    path, module, drivers = EXPORTERS[name]
+    proc = subprocess.run([sys.executable, '-c', IMPORT_SNIPPET % (path, module, drivers)],
+                          stdout=subprocess.PIPE, check=True)
+    return json.loads(proc.stdout.decode())
+
+
+def command(name, workdir):
+    archive_dir = os.path.join(workdir, 'archive')
+    os.makedirs(archive_dir, exist_ok=True)
+    if name == 'pg':
+        return [sys.executable, os.path.join(ROOT, 'exporter.py'), '--archive_dir', archive_dir]
+    config = os.path.join(workdir, 'exporter.conf')
+    with open(config, 'w') as f:
+        f.write('host = 127.0.0.1\nport = 1\ntmp_binlog_dir = %s\n\n[exporter]\nport = %d\n'
+                % (workdir, PORT))
+    return [sys.executable, os.path.join(ROOT, 'mysql', 'mysql_exporter.py'),
+            '--archive_dir', archive_dir, '--config', config]
+
+
+def time_first_scrape(name):
+    with tempfile.TemporaryDirectory(prefix='walg-startup-') as workdir:
+        env = dict(os.environ,
+                   WALG_BINARY_PATH=FAKE_WALG,
+                   WALG_EXPORTER_STATE_FILE=os.path.join(workdir, 'state'),
+                   # Nothing listens there: startup must not wait on the database
+                   PGHOST='127.0.0.1', PGPORT='1')
+        started = time.perf_counter()
+        proc = subprocess.Popen(command(name, workdir), env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while time.perf_counter() - started < TIMEOUT:
+                if proc.poll() is not None:
+                    raise RuntimeError('%s exited with %s' % (name, proc.returncode))
+                try:
+                    with urllib.request.urlopen('http://127.0.0.1:%d/metrics' % PORT, timeout=1) as r:
+                        if r.status == 200:
+                            return time.perf_counter() - started
+                except (urllib.error.URLError, ConnectionError):
+                    time.sleep(0.005)
+            raise RuntimeError('%s not serving after %ss' % (name, TIMEOUT))
+        finally:
+            # Shutdown is not measured
+            proc.kill()
+            proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--exporter', choices=['pg', 'mysql', 'all'], default='all')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--json', help='write the results to this file')
+    options = parser.parse_args()
+
+    names = list(EXPORTERS) if options.exporter == 'all' else [options.exporter]
+    print('%-6s %10s %12s %15s' % ('target', 'import ms', 'first ms', 'eager imports'))
+    results = {}
+    for name in names:
+        imports = [time_import(name) for _ in range(options.runs)]
+        scrapes = [time_first_scrape(name) for _ in range(options.runs)]
+        results[name] = {
+            'import': statistics.median(seconds for seconds, _ in imports),
+            'first_scrape': statistics.median(scrapes),
+            'eager_imports': imports[0][1],
+        }
+        print('%-6s %10.1f %12.1f %15s' % (
+            name, results[name]['import'] * 1000, results[name]['first_scrape'] * 1000,
+            ','.join(results[name]['eager_imports']) or '-'))
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
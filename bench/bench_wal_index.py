@@ -0,0 +1,99 @@
+"""WAL segment index of the PostgreSQL exporter against a file storage.
+
+Checks that the integrity stays OK while the archiver moves on between
+two listings of wal_005/, that a segment reported archived but absent
+from the storage is missing, that a .history or .partial file reported
+by the archiver is handled and that a deleted segment shows up as a gap
+after a rebuild, then reports the cost of a full listing and of an
+incremental cycle.
+
+    python3 bench/bench_wal_index.py [segments]
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+
+SEGMENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import exporter  # noqa: E402
+import walg_common  # noqa: E402
+
+INDEX = exporter.WalSegmentIndex()
+
+
+def archive(storage_dir, *segnos):
+    for segno in segnos:
+        open(os.path.join(storage_dir, 'wal_005', INDEX.name(1, segno) + '.br'), 'w').close()
+
+
+def report(instance, segno, name=None):
+    # What the archive-status job reads from pg_stat_archiver
+    instance.archive_status = {'last_archived_wal': name or INDEX.name(1, segno),
+                               'wal_segment_size': exporter.DEFAULT_WAL_SEGMENT_SIZE}
+
+
+def summary(instance):
+    integrity, gaps = instance.index_integrity()
+    return integrity['status'], integrity['found'], integrity['missing'], gaps
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    with tempfile.TemporaryDirectory(prefix='walg-wal-') as storage_dir:
+        os.mkdir(os.path.join(storage_dir, 'wal_005'))
+        archive(storage_dir, *range(1, SEGMENTS + 1))
+        instance = exporter.Exporter(None, None, runner=exporter.WalgRunner(os.devnull),
+                                     wal_storage=walg_common.FileStorage(storage_dir),
+                                     register=False)
+        report(instance, SEGMENTS)
+
+        started = time.perf_counter()
+        instance.rebuild_wal_index()
+        full = time.perf_counter() - started
+        assert summary(instance) == ('OK', SEGMENTS, 0, []), summary(instance)
+
+        # The archive-status job runs between two listings: the segments
+        # archived since the last listing are not missing
+        high = SEGMENTS
+        for batch in (2, 1, 3):
+            archive(storage_dir, *range(high + 1, high + batch + 1))
+            report(instance, high + batch)
+            assert summary(instance) == ('OK', high, 0, []), (batch, summary(instance))
+            started = time.perf_counter()
+            instance.update_wal_index()
+            incremental = time.perf_counter() - started
+            high += batch
+            assert summary(instance) == ('OK', high, 0, []), (batch, summary(instance))
+
+        # Archived before the listing started but not in the storage
+        report(instance, high + 1)
+        instance.update_wal_index()
+        assert summary(instance) == ('FAILURE', high, 1, [(1, high + 1, high + 1)]), summary(instance)
+        archive(storage_dir, high + 1)
+        high += 1
+        instance.update_wal_index()
+        assert summary(instance) == ('OK', high, 0, []), summary(instance)
+
+        # After a promotion the archiver reports the .history file of the
+        # new timeline, the range keeps ending at the last listed segment
+        report(instance, high, '00000002.history')
+        instance.update_wal_index()
+        instance.rebuild_wal_index()
+        assert summary(instance) == ('OK', high, 0, []), summary(instance)
+        report(instance, high, INDEX.name(1, high) + '.partial')
+        instance.update_wal_index()
+        assert summary(instance) == ('OK', high, 0, []), summary(instance)
+
+        # A segment deleted from the storage is caught by the rebuild
+        os.remove(os.path.join(storage_dir, 'wal_005', INDEX.name(1, SEGMENTS // 2) + '.br'))
+        instance.rebuild_wal_index()
+        assert summary(instance) == ('FAILURE', high - 1, 1,
+                                     [(1, SEGMENTS // 2, SEGMENTS // 2)]), summary(instance)
+
+    print('%d segments: full listing %.3fs, incremental cycle %.4fs' % (SEGMENTS, full, incremental))
+
+
+if __name__ == '__main__':
+    main()
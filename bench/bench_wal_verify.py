@@ -0,0 +1,101 @@
+"""Peak memory and time of the wal-verify report reader.
+
+Compares the previous approach (buffer the whole output, json.loads it)
+with the streaming WalVerifyReader on synthetic reports of growing size.
+
+    python3 bench/bench_wal_verify.py [entries ...]
+"""
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+SIZES = [int(n) for n in sys.argv[1:]] or [10000, 50000, 200000]
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import exporter  # noqa: E402
+
+STATUSES = ('FOUND', 'FOUND', 'FOUND', 'MISSING_LOST')
+
+
+def report_chunks(entries, timelines=8):
+    yield b'{"integrity":{"status":"FAILURE","details":['
+    per_timeline = max(entries // timelines, 1)
+    for i in range(entries):
+        timeline = i // per_timeline + 1
+        entry = {
+            'timeline_id': timeline,
+            'start_segment': '%08X%08X%08X' % (timeline, i >> 8, i & 0xFF),
+            'end_segment': '%08X%08X%08X' % (timeline, (i + 1) >> 8, (i + 1) & 0xFF),
+            'segments_count': 1 + i % 64,
+            'status': STATUSES[i % len(STATUSES)],
+        }
+        yield (b',' if i else b'') + json.dumps(entry).encode()
+    yield b']}}'
+
+
+class GeneratedStream(io.RawIOBase):
+    # Pipe stand-in producing the report on the fly, so the measured peak
+    # only contains what the reader itself keeps
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while len(self.pending) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.pending += chunk
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+
+def buffered(entries):
+    stdout = b''.join(report_chunks(entries))
+    details = list(json.loads(stdout)['integrity']['details'])
+    details.sort(key=lambda walarchive: walarchive['timeline_id'])
+    status = json.loads(stdout)['integrity']['status']
+    found = sum(d['segments_count'] for d in details if d['status'] == 'FOUND')
+    missing = sum(d['segments_count'] for d in details if d['status'] != 'FOUND')
+    return status, found, missing
+
+
+def streaming(entries, chunk_size=64 * 1024):
+    report = exporter.WalVerifyReader().read(
+        GeneratedStream(report_chunks(entries)), chunk_size)
+    return report.status, report.found, report.missing
+
+
+def measure(fn, *fn_args):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = fn(*fn_args)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    # Entries split at every possible position must still add up
+    assert streaming(500, chunk_size=7) == buffered(500)
+
+    print('%10s %10s  %22s  %22s' % ('entries', 'report', 'buffered (s / peak)',
+                                     'streaming (s / peak)'))
+    for entries in SIZES:
+        size = sum(len(c) for c in report_chunks(entries))
+        old, old_time, old_peak = measure(buffered, entries)
+        new, new_time, new_peak = measure(streaming, entries)
+        assert old == new, (old, new)
+        print('%10d %8.1fMB  %8.2fs / %8.1fMB  %8.2fs / %8.1fMB' % (
+            entries, size / 2 ** 20,
+            old_time, old_peak / 2 ** 20, new_time, new_peak / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
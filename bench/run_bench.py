@@ -0,0 +1,313 @@
+"""End to end benchmark of both exporters against a fake wal-g.
+
+Each scenario runs in its own process with bench/fake-wal-g as
+WALG_BINARY_PATH, the database driver connect() replaced by an in-memory
+stand-in and a synthetic archive_status (or binlog) directory. Reported
+per scenario:
+
+- integrity: one wal-verify run (PostgreSQL only)
+- cold / warm: first and median following collection cycle, i.e. one run
+  of every scheduled job outside the integrity lane
+- scrape p50 / max: rendering the registry, as a Prometheus scrape does
+- cached: median scrape served from the output rendered once per cycle
+- rss: peak resident memory of the exporter process
+- alloc peak: peak memory allocated by Python during one cycle and scrape
+
+    python3 bench/run_bench.py [--exporter pg|mysql|all] [--backups 100,10000]
+                               [--ready 0,10000] [--segments 1000] [--json out.json]
+
+--json writes the results with the exporter version, so runs of two
+releases can be compared.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+FAKE_WALG = os.path.join(HERE, 'fake-wal-g')
+# Segments archived by the fake primary
+ARCHIVED = 50000
+
+
+def csv_ints(value):
+    return [int(v) for v in value.split(',')]
+
+
+def wal_name(segment):
+    # Timeline 1, 16MB segments
+    return '00000001%08X%08X' % (segment >> 8, segment & 0xFF)
+
+
+def timed(fn, *fn_args):
+    started = time.perf_counter()
+    fn(*fn_args)
+    return time.perf_counter() - started
+
+
+# Database stand-ins
+# ------------------
+
+class FakeCursor():
+    def __init__(self, rows):
+        self.rows = rows
+        self.results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def execute(self, query, *params):
+        # One result set per statement
+        self.results = [next((rows for key, rows in self.rows if key in statement), [])
+                        for statement in query.split(';')]
+
+    def nextset(self):
+        self.results.pop(0)
+        return True if self.results else None
+
+    def fetchall(self):
+        return self.results[0]
+
+    def fetchone(self):
+        return self.results[0][0] if self.results[0] else None
+
+    def close(self):
+        pass
+
+
+class FakeConnection():
+    # Answers every query from a fixed (query fragment, row) table
+    def __init__(self, rows):
+        self.rows = rows
+        self.closed = 0
+        self.open = True
+        self.autocommit = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def cursor(self, *factory_args, **factory_kwargs):
+        return FakeCursor(self.rows)
+
+    def close(self):
+        self.closed = 1
+        self.open = False
+
+
+def postgres_rows(ready):
+    import datetime
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return [('pg_stat_archiver', [{
+        'archived_count': 100000,
+        'failed_count': 0,
+        'last_archived_wal': wal_name(ARCHIVED),
+        'last_archived_time': now,
+        'last_failed_wal': None,
+        'last_failed_time': None,
+        'is_in_recovery': False,
+        'current_lsn': '%X/%X' % ((ARCHIVED + ready) >> 8, (ARCHIVED + ready) << 24 & 0xFFFFFFFF),
+        'current_wal': wal_name(ARCHIVED + ready),
+        'wal_segment_size': 16 * 1024 * 1024,
+    }])]
+
+
+def mysql_rows(binlogs):
+    active = 'mysql-bin.%06d' % binlogs
+    return [('SHOW BINARY LOGS', [{'Log_name': 'mysql-bin.%06d' % (i + 1), 'File_size': 1 << 30}
+                                  for i in range(binlogs)]),
+            ('SHOW MASTER STATUS', [{'File': active, 'Position': 4}]),
+            ('gtid_executed', [{'gtid_executed': '3e11fa47-71ca-11e1-9e33-c80aa9429562:1-%d' % (binlogs * 1000)}])]
+
+
+# Scenario child
+# --------------
+
+def make_files(directory, count, name):
+    for i in range(count):
+        open(os.path.join(directory, name(i)), 'w').close()
+
+
+class Jobs():
+    # Stands in for the scheduler: keeps the jobs an exporter schedules so a
+    # cycle runs exactly those, one after the other
+    def __init__(self):
+        self.jobs = []
+
+    def add(self, name, fn, interval, cluster='', refresh=False, enabled=None, lane=''):
+        if lane == '':
+            self.jobs.append(fn)
+
+    def cycle(self):
+        for fn in self.jobs:
+            fn()
+
+
+def measure(module, collect, scrapes):
+    from prometheus_client import REGISTRY, generate_latest
+    from prometheus_client.exposition import choose_encoder
+    result = {'cold': timed(collect)}
+    result['warm'] = statistics.median(timed(collect) for _ in range(3))
+    scrape = [timed(generate_latest, REGISTRY) for _ in range(scrapes)]
+    result['scrape_p50'] = statistics.median(scrape)
+    result['scrape_max'] = max(scrape)
+    cache = module.RenderCache(REGISTRY, max_age=3600)
+    encoder, content_type = choose_encoder(None)
+    cache.get(encoder, content_type)
+    result['scrape_cached'] = statistics.median(
+        timed(cache.get, encoder, content_type) for _ in range(scrapes))
+    result['version'] = module.parser.version
+    tracemalloc.start()
+    collect()
+    generate_latest(REGISTRY)
+    result['alloc_peak'] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result
+
+
+def run_postgres(scenario, workdir):
+    archive_status = os.path.join(workdir, 'archive_status')
+    os.mkdir(archive_status)
+    make_files(archive_status, scenario['ready'],
+               lambda i: wal_name(ARCHIVED + 1 + i) + '.ready')
+    sys.path.insert(0, ROOT)
+    import psycopg2
+    import exporter
+    psycopg2.connect = lambda **params: FakeConnection(postgres_rows(scenario['ready']))
+
+    watcher = exporter.ArchiveStatusWatcher(archive_status)
+    reconcile = timed(watcher.reconcile)
+    runner = exporter.WalgRunner(FAKE_WALG)
+    db = exporter.PostgresConnection(host='bench')
+    instance = exporter.Exporter(db, watcher, runner,
+                                 state_file=os.path.join(workdir, 'state'))
+    integrity = timed(instance.update_wal_status)
+    jobs = Jobs()
+    instance.schedule(jobs, {'backup-list': 60, 'archive-status': 60, 'wal-integrity': 3600})
+    result = measure(exporter, jobs.cycle, scenario['scrapes'])
+    result.update(integrity=integrity, reconcile=reconcile)
+    return result
+
+
+def run_mysql(scenario, workdir):
+    binlogs = os.path.join(workdir, 'binlogs')
+    os.mkdir(binlogs)
+    make_files(binlogs, scenario['ready'], lambda i: 'mysql-bin.%06d' % (i + 1))
+    os.environ['WALG_EXPORTER_TMP_BINLOG_DIR'] = workdir
+    sys.path.insert(0, os.path.join(ROOT, 'mysql'))
+    import pymysql
+    import mysql_exporter
+    mysql_exporter.configure(['--archive_dir', binlogs, '--config', os.devnull])
+    # The server holds a few more binlogs than wal-g uploaded
+    pymysql.connect = lambda **params: FakeConnection(mysql_rows(scenario['binlogs'] + 10))
+
+    runner = mysql_exporter.WalgRunner(FAKE_WALG)
+    instance = mysql_exporter.MySQLExporter({}, state_file=os.path.join(workdir, 'state'),
+                                            runner=runner)
+    jobs = Jobs()
+    instance.schedule(jobs)
+    return measure(mysql_exporter, jobs.cycle, scenario['scrapes'])
+
+
+def child(scenario):
+    import logging
+    logging.disable(logging.CRITICAL)
+    with tempfile.TemporaryDirectory(prefix='walg-bench-') as workdir:
+        run = run_postgres if scenario['exporter'] == 'pg' else run_mysql
+        result = run(scenario, workdir)
+    # ru_maxrss is in kilobytes on Linux
+    result['rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    print(json.dumps(result))
+
+
+# Driver
+# ------
+
+def scenarios(options):
+    exporters = ['pg', 'mysql'] if options.exporter == 'all' else [options.exporter]
+    for name, backups, ready in itertools.product(exporters, options.backups, options.ready):
+        yield {
+            'exporter': name,
+            'backups': backups,
+            'ready': ready,
+            'timelines': options.timelines,
+            'segments': options.segments,
+            'binlogs': options.binlogs,
+            'latency': options.latency,
+            'scrapes': options.scrapes,
+        }
+
+
+def run_scenario(scenario):
+    env = dict(os.environ,
+               WALG_BINARY_PATH=FAKE_WALG,
+               FAKE_WALG_ENGINE='mysql' if scenario['exporter'] == 'mysql' else 'pg',
+               FAKE_WALG_BACKUPS=str(scenario['backups']),
+               FAKE_WALG_TIMELINES=str(scenario['timelines']),
+               FAKE_WALG_SEGMENTS=str(scenario['segments']),
+               FAKE_WALG_BINLOGS=str(scenario['binlogs']),
+               FAKE_WALG_LATENCY=str(scenario['latency']))
+    proc = subprocess.run([sys.executable, __file__, '--child', json.dumps(scenario)],
+                          env=env, stdout=subprocess.PIPE, check=True)
+    return json.loads(proc.stdout.decode().splitlines()[-1])
+
+
+def ms(seconds):
+    return '%9.1f' % (seconds * 1000) if seconds is not None else '%9s' % '-'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--exporter', choices=['pg', 'mysql', 'all'], default='all')
+    parser.add_argument('--backups', type=csv_ints, default=[100, 10000],
+                        help='backup-list sizes, comma separated')
+    parser.add_argument('--ready', type=csv_ints, default=[0, 10000],
+                        help='.ready files (binlog files for MySQL), comma separated')
+    parser.add_argument('--timelines', type=int, default=4)
+    parser.add_argument('--segments', type=int, default=10000,
+                        help='wal-verify entries per timeline')
+    parser.add_argument('--binlogs', type=int, default=1000,
+                        help='binlogs reported by binlog-find')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds each fake wal-g call sleeps')
+    parser.add_argument('--scrapes', type=int, default=20)
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+    if options.child:
+        return child(json.loads(options.child))
+
+    print('%-6s %7s %7s %9s %9s %9s %9s %9s %9s %8s %10s' % (
+        'target', 'backups', 'ready', 'integ ms', 'cold ms', 'warm ms',
+        'scr50 ms', 'scrmax ms', 'cache ms', 'rss MB', 'alloc MB'))
+    results = []
+    for scenario in scenarios(options):
+        result = run_scenario(scenario)
+        results.append({'scenario': scenario, 'result': result})
+        print('%-6s %7d %7d %s %s %s %s %s %s %8.1f %10.1f' % (
+            scenario['exporter'], scenario['backups'], scenario['ready'],
+            ms(result.get('integrity')), ms(result['cold']), ms(result['warm']),
+            ms(result['scrape_p50']), ms(result['scrape_max']),
+            ms(result.get('scrape_cached')),
+            result['rss'] / 2 ** 20, result['alloc_peak'] / 2 ** 20))
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump({'python': platform.python_version(), 'runs': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,16 +5,32 @@ import json
 import datetime
 import re
 import argparse
+import bisect
 import logging
 import time
 import math
+import codecs
+import configparser
+import collections
+import concurrent.futures
+import ctypes
+import ctypes.util
+import functools
+import hashlib
+import heapq
+import itertools
+import select
+import struct
+import threading
 from logging import warning, info, debug, error  # noqa: F401
-from prometheus_client import start_http_server
-from prometheus_client import Gauge
-import psycopg2
-from psycopg2.extras import DictCursor
-from dotenv import load_dotenv
+from prometheus_client import REGISTRY
+from prometheus_client.core import GaugeMetricFamily, Metric
+from prometheus_client.samples import Sample
 from pathlib import Path
+import walg_common
+from walg_common import CommandSkipped, PARSE_DURATION, RefreshTrigger
+from walg_common import RenderCache, Scheduler, WalgRunner
+from walg_common import instrument, open_storage, signal_handler, start_server
 
 # Configuration
 # -------------
@@ -25,40 +41,20 @@ walg_binary_path = os.getenv("WALG_BINARY_PATH", "/usr/local/bin/wal-g")
 parser = argparse.ArgumentParser()
 parser.version = "0.3.1"
 parser.add_argument("--archive_dir",
-                    help="pg_wal/archive_status/ Directory location", action="store", required=True)
+                    help="pg_wal/archive_status/ Directory location", action="store")
 parser.add_argument("--config", help="walg config file path", action="store")
+parser.add_argument("--targets", help="monitor every cluster listed in this file "
+                    "instead of a single one", action="store")
 parser.add_argument("--debug", help="enable debug log", action="store_true")
 parser.add_argument("--version", help="show binary version", action="version")
 
-args = parser.parse_args()
-if args.debug:
-    logging.basicConfig(level=logging.DEBUG)
-else:
-    logging.basicConfig(level=logging.INFO)
-
-# Disable logging of libs
-for key in logging.Logger.manager.loggerDict:
-    if key != 'root':
-        logging.getLogger(key).setLevel(logging.WARNING)
-
-archive_dir = args.archive_dir
 http_port = 9351
 READY_WAL_RE = re.compile(r"^[A-F0-9]{24}\.ready$")
-terminate = False
 
 # Base backup update
 # ------------------
 
 
-def format_date(bb):
-    # fix date format to include timezone
-    bb['date_fmt'] = bb['date_fmt'].replace('Z', '%z')
-    bb['time'] = parse_date(bb['time'], bb['date_fmt'])
-    bb['start_time'] = parse_date(bb['start_time'], bb['date_fmt'])
-    bb['finish_time'] = parse_date(bb['finish_time'], bb['date_fmt'])
-    return bb
-
-
 def parse_date(date, fmt):
     fmt = fmt.replace('Z', '%z')
     try:
@@ -67,14 +63,192 @@ def parse_date(date, fmt):
         fmt = fmt.replace('.%f', '')
         return datetime.datetime.strptime(date, fmt)
 
-def wal_diff(a, b):
-    timeline_a = a[0:8]
-    timeline_b = b[0:8]
-    if timeline_a != timeline_b:
-        return -1
-    a_int = int(a[8:16], 16) * 0x100 + int(a[16:24], 16)
-    b_int = int(b[8:16], 16) * 0x100 + int(b[16:24], 16)
-    return a_int - b_int
+STATE_DATE_FMT = '%Y-%m-%dT%H:%M:%S.%f%z'
+BACKUP_STATE_FIELDS = ('backup_name', 'wal_file_name', 'start_lsn', 'finish_lsn',
+                       'is_permanent', 'uncompressed_size', 'compressed_size',
+                       'start_time', 'finish_time')
+
+
+# Computed values, labels of walg_basebackup can not hold them: both modes
+# export them as samples keyed by backup_name
+BASEBACKUP_RATE_FAMILIES = (
+    ('walg_basebackup_throughput_bytes_per_second', 'Basebackup uncompressed bytes per second'),
+    ('walg_basebackup_compression_ratio', 'Basebackup uncompressed size over its compressed size'),
+)
+# In compact mode a backup is only identified by its name, its values are
+# samples of one family each instead of labels of walg_basebackup
+COMPACT_BASEBACKUP_FAMILIES = (
+    ('walg_basebackup', 'Remote Basebackups'),
+    ('walg_basebackup_start_timestamp', 'Basebackup start time'),
+    ('walg_basebackup_finish_timestamp', 'Basebackup finish time'),
+    ('walg_basebackup_duration_seconds', 'Basebackup duration'),
+    ('walg_basebackup_uncompressed_size_bytes', 'Basebackup size before compression'),
+    ('walg_basebackup_compressed_size_bytes', 'Basebackup size in the storage'),
+) + BASEBACKUP_RATE_FAMILIES + (
+    ('walg_basebackup_start_lsn', 'Basebackup start LSN'),
+    ('walg_basebackup_finish_lsn', 'Basebackup finish LSN'),
+    ('walg_basebackup_permanent', '1 if the basebackup is permanent else 0'),
+)
+BASEBACKUP_FAMILIES = COMPACT_BASEBACKUP_FAMILIES[:1] + BASEBACKUP_RATE_FAMILIES
+
+
+class Backup():
+    # Backups never change once written, a record is built once per backup
+    # and kept for as long as it is listed
+    __slots__ = ('name', 'wal_file_name', 'start_lsn', 'finish_lsn',
+                 'is_permanent', 'uncompressed_size', 'compressed_size',
+                 'start_time', 'finish_time', 'sample')
+
+    def __init__(self, bb):
+        date_fmt = bb['date_fmt'].replace('Z', '%z')
+        self.name = bb['backup_name']
+        self.wal_file_name = bb['wal_file_name']
+        self.start_lsn = bb['start_lsn']
+        self.finish_lsn = bb['finish_lsn']
+        self.is_permanent = bb['is_permanent']
+        self.uncompressed_size = bb['uncompressed_size']
+        self.compressed_size = bb['compressed_size']
+        self.start_time = parse_date(bb['start_time'], date_fmt)
+        self.finish_time = parse_date(bb['finish_time'], date_fmt)
+        self.sample = Sample('walg_basebackup', {
+            'start_wal_segment': self.wal_file_name,
+            'start_lsn': str(self.start_lsn),
+            'finish_lsn': str(self.finish_lsn),
+            'is_permanent': str(self.is_permanent),
+            'uncompressed_size': convert_size(self.uncompressed_size),
+            'compressed_size': convert_size(self.compressed_size),
+            'start_time': str(self.start_time),
+            'finish_time': str(self.finish_time),
+        }, self.start_time.timestamp())
+
+    def compact_samples(self):
+        # Values of COMPACT_BASEBACKUP_FAMILIES, in the same order
+        labels = {'backup_name': self.name}
+        start = self.start_time.timestamp()
+        finish = self.finish_time.timestamp()
+        values = (start, start, finish, finish - start,
+                  self.uncompressed_size, self.compressed_size,
+                  self.throughput(), self.compression_ratio(), self.start_lsn, self.finish_lsn, 1 if self.is_permanent else 0)
+        return tuple(Sample(name, labels, value) for (name, _), value
+                     in zip(COMPACT_BASEBACKUP_FAMILIES, values))
+
+    def full_samples(self):
+        # Values of BASEBACKUP_FAMILIES, in the same order
+        labels = {'backup_name': self.name}
+        return (self.sample,
+                Sample(BASEBACKUP_RATE_FAMILIES[0][0], labels, self.throughput()),
+                Sample(BASEBACKUP_RATE_FAMILIES[1][0], labels, self.compression_ratio()))
+
+    def throughput(self):
+        duration = (self.finish_time - self.start_time).total_seconds()
+        return self.uncompressed_size / duration if duration > 0 else 0
+
+    def compression_ratio(self):
+        if not self.compressed_size:
+            return 0
+        return self.uncompressed_size / self.compressed_size
+
+    def same(self, bb):
+        # Only the permanent flag can change, through backup-mark
+        return bb['is_permanent'] == self.is_permanent
+
+    def to_state(self):
+        return [self.name, self.wal_file_name, self.start_lsn, self.finish_lsn,
+                self.is_permanent, self.uncompressed_size, self.compressed_size,
+                self.start_time.strftime(STATE_DATE_FMT),
+                self.finish_time.strftime(STATE_DATE_FMT)]
+
+    @classmethod
+    def from_state(cls, row):
+        return cls(dict(zip(BACKUP_STATE_FIELDS, row), date_fmt=STATE_DATE_FMT))
+
+
+BACKUP_QUANTILES = (0.5, 0.9, 0.99)
+BackupStats = collections.namedtuple('BackupStats', [
+    'durations', 'throughputs', 'compression_ratio', 'growth_per_day'])
+
+
+def quantiles(values):
+    # Nearest rank quantiles of BACKUP_QUANTILES
+    values = sorted(values)
+    if not values:
+        return ()
+    return tuple(values[max(math.ceil(q * len(values)) - 1, 0)]
+                 for q in BACKUP_QUANTILES)
+
+
+def backup_stats(bbs):
+    # Statistics of the full backups in the retention window, computed
+    # once per backup list change. Delta backups (_D_ in the name) would
+    # skew the sizes and durations.
+    full = [bb for bb in bbs if '_D_' not in bb.name]
+    compressed = sum(bb.compressed_size for bb in full)
+    # Least squares slope of the uncompressed size over the start time
+    growth = 0
+    if len(full) > 1:
+        days = [bb.start_time.timestamp() / 86400 for bb in full]
+        mean_day = sum(days) / len(days)
+        mean_size = sum(bb.uncompressed_size for bb in full) / len(full)
+        spread = sum((day - mean_day) ** 2 for day in days)
+        if spread:
+            growth = sum((day - mean_day) * (bb.uncompressed_size - mean_size)
+                         for day, bb in zip(days, full)) / spread
+    return BackupStats(
+        quantiles((bb.finish_time - bb.start_time).total_seconds() for bb in full),
+        quantiles(bb.throughput() for bb in full),
+        sum(bb.uncompressed_size for bb in full) / compressed if compressed else 0,
+        growth)
+
+
+class BackupCatalog():
+    # backup-list results indexed by backup_name. Unchanged output is
+    # skipped altogether and only new entries are parsed.
+    def __init__(self, record=Backup):
+        self.record = record
+        self.digest = None
+        self.backups = {}
+        self.ordered = []
+
+    def update(self, output, parse=json.loads):
+        # Returns (added, removed) records, None when the output did not
+        # change since the last call
+        digest = hashlib.sha1(output).digest()
+        if digest == self.digest:
+            return None
+        return self.merge(parse(output) if output.strip() else [], digest)
+
+    def merge(self, raw, digest):
+        # Index a parsed backup list, digest identifies its source
+        backups = {}
+        added = []
+        for bb in raw:
+            record = self.backups.get(bb['backup_name'])
+            if record is None or not record.same(bb):
+                record = self.record(bb)
+                added.append(record)
+            backups[record.name] = record
+        removed = [record for name, record in self.backups.items()
+                   if backups.get(name) is not record]
+        if added or removed:
+            self.ordered = sorted(backups.values(),
+                                  key=lambda record: record.start_time)
+        self.backups = backups
+        self.digest = digest
+        return added, removed
+
+    def __len__(self):
+        return len(self.ordered)
+
+    def to_state(self):
+        return {'digest': self.digest.hex() if self.digest else None,
+                'backups': [record.to_state() for record in self.ordered]}
+
+    def restore(self, state):
+        records = [self.record.from_state(row) for row in state['backups']]
+        self.backups = dict((record.name, record) for record in records)
+        self.ordered = sorted(records, key=lambda record: record.start_time)
+        self.digest = bytes.fromhex(state['digest']) if state['digest'] else None
+
 
 def convert_size(size_bytes):
     if size_bytes == 0:
@@ -86,259 +260,1444 @@ def convert_size(size_bytes):
     s = round(size_bytes / p, 2)
     return "%s %s" % (s, size_name[i])
 
-def signal_handler(sig, frame):
-    global terminate
-    info('SIGTERM received, preparing to shutdown')
-    terminate = True
 
-class Exporter():
-    def __init__(self):
-        self.basebackup_exception = False
-        self.xlog_exception = False
-        self.bbs = []
-        self.last_archive_check = None
-        self.archive_status = None
+# WAL positions
+# -------------
 
-        # Declare metrics
-        self.basebackup = Gauge('walg_basebackup', 'Remote Basebackups',
-                                [
-                                    'start_wal_segment',
-                                    'start_lsn',
-                                    'finish_lsn',
-                                    'is_permanent',
-                                    'uncompressed_size',
-                                    'compressed_size',
-                                    'start_time',
-                                    'finish_time'
-                                ])
-        self.basebackup_count = Gauge('walg_basebackup_count',
-                                      'Remote Basebackups count')
-        self.basebackup_count.set_function(lambda: len(self.bbs))
-
-        self.last_upload = Gauge('walg_last_upload',
-                                 'Last upload of incremental or full backup',
-                                 ['type'])
-        self.last_upload.labels('xlog').set_function(
-            self.last_xlog_upload_callback)
-        self.last_upload.labels('basebackup').set_function(
-            lambda: self.bbs[len(self.bbs) - 1]['start_time'].timestamp()
-            if self.bbs else 0
-        )
-        self.oldest_basebackup = Gauge('walg_oldest_basebackup',
-                                       'Oldest full backup')
-        self.oldest_basebackup.set_function(
-            lambda: self.bbs[0]['start_time'].timestamp() if self.bbs else 0
-        )
-
-        self.xlog_ready = Gauge('walg_missing_remote_wal_segment_at_end',
-                                'Xlog ready for upload')
-        self.xlog_ready.set_function(self.xlog_ready_callback)
-
-        self.exception = Gauge('walg_exception',
-                               'Wal-g exception: 1 for basebackup error, '
-                               '2 for xlog error and '
-                               '3 for both errors')
-        self.exception.set_function(
-            lambda: (1 if self.basebackup_exception else 0 +
-                     2 if self.xlog_exception else 0))
-
-        self.xlog_since_last_bb = Gauge('walg_xlogs_since_basebackup',
-                                        'Xlog uploaded since last base backup')
-        self.xlog_since_last_bb.set_function(self.xlog_since_last_bb_callback)
-
-        self.last_backup_duration = Gauge('walg_last_backup_duration',
-                                          'Duration of the last full backup')
-        self.last_backup_duration.set_function(
-            lambda: ((self.bbs[len(self.bbs) - 1]['finish_time'] -
-                      self.bbs[len(self.bbs) - 1]['start_time']).total_seconds()
-                     if self.bbs else 0)
-        )
-
-        self.wal_integrity_status = Gauge('walg_wal_integrity_status', 'Overall WAL archive integrity status', ['status'])
-        self.wal_archive_count = Gauge('walg_wal_archive_count', 'Total WAL archived count from oldest to latest full backup')
-        self.wal_archive_missing_count = Gauge('walg_wal_archive_missing_count', 'Total missing WAL count')
+DEFAULT_WAL_SEGMENT_SIZE = 16 * 1024 * 1024
+# Segment names, backup labels and partial segments carry the segment in
+# their first 24 characters; history files do not
+WAL_FILE_RE = re.compile(r'^[0-9A-F]{24}(\.|$)')
 
-    def update_wal_status(self):
-        try:
-            command = [walg_binary_path, 'wal-verify', 'integrity', '--json']
-            if args.config:
-                command.extend(["--config", args.config])
 
-            res = subprocess.run(command,
-                                 capture_output=True, check=True)
+def parse_lsn(lsn):
+    high, low = lsn.split('/')
+    return int(high, 16) << 32 | int(low, 16)
+
+
+def wal_position(name, segment_size=DEFAULT_WAL_SEGMENT_SIZE):
+    # (timeline, start LSN) of the segment of a WAL file name, None for
+    # files outside the segment sequence
+    if not name or not WAL_FILE_RE.match(name):
+        return None
+    segno = (int(name[8:16], 16) * (0x100000000 // segment_size) +
+             int(name[16:24], 16))
+    return int(name[0:8], 16), segno * segment_size
+
+
+def read_timeline_history(path):
+    # Ancestors of a timeline from its .history file, as
+    # {parent timeline: LSN where the server switched away from it}
+    ancestors = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 2 and fields[0].isdigit():
+                ancestors[int(fields[0])] = parse_lsn(fields[1])
+    return ancestors
+
+
+def wal_distance(a, b, ancestors=None):
+    # Bytes from position a to position b, both (timeline, LSN). a may be
+    # on an ancestor of b's timeline (ancestors from b's history file) as
+    # long as it is before the switch; None when a is not in b's past.
+    if a is None or b is None:
+        return None
+    if a[0] != b[0]:
+        switch = (ancestors or {}).get(a[0])
+        if switch is None or a[1] > switch:
+            return None
+    return b[1] - a[1]
+
+
+def wal_diff(a, b, segment_size=DEFAULT_WAL_SEGMENT_SIZE, ancestors=None):
+    # Segments from WAL file b to WAL file a, -1 when b is not in a's past
+    distance = wal_distance(wal_position(b, segment_size),
+                            wal_position(a, segment_size), ancestors)
+    return distance // segment_size if distance is not None else -1
 
-        except subprocess.CalledProcessError as e:
-            error(e)
 
-        # Check json output of wal-g for the integrity status
-        if res.stdout.decode("utf-8") == "":
-            wal_archive_list = []
-            wal_archive_integrity_status = []
+# wal-verify report
+# -----------------
+
+WAL_VERIFY_DETAILS_RE = re.compile(r'"details"\s*:\s*\[')
+
+
+class WalVerifyReader():
+    # Aggregates `wal-verify integrity --json` output while it is read from
+    # the pipe: only the details entry being decoded is kept in memory, the
+    # array itself is never materialized
+    def __init__(self):
+        self.status = None
+        self.found = 0
+        self.missing = 0
+        self.entries = 0
+        self.timelines = {}
+        self.parse_seconds = 0
+
+    def add(self, entry):
+        self.entries += 1
+        counts = self.timelines.setdefault(entry['timeline_id'], [0, 0])
+        if entry['status'] == 'FOUND':
+            self.found += entry['segments_count']
+            counts[0] += entry['segments_count']
+        else:
+            self.missing += entry['segments_count']
+            counts[1] += entry['segments_count']
+
+    def read(self, stream, chunk_size=64 * 1024):
+        text = codecs.getincrementaldecoder('utf-8')()
+        decoder = json.JSONDecoder()
+        # Document before and after the details array, both are small
+        head = None
+        tail = None
+        buf = ''
+        eof = False
+        waited = 0
+        started = time.time()
+        while not eof:
+            read_started = time.time()
+            chunk = stream.read(chunk_size)
+            waited += time.time() - read_started
+            eof = not chunk
+            buf += text.decode(chunk, final=eof)
+            if tail is not None:
+                tail.append(buf)
+                buf = ''
+                continue
+            if head is None:
+                match = WAL_VERIFY_DETAILS_RE.search(buf)
+                if match is None:
+                    continue
+                head = buf[:match.end() - 1]
+                buf = buf[match.end():]
+
+            pos = 0
+            while True:
+                while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                    pos += 1
+                if pos == len(buf):
+                    break
+                if buf[pos] == ']':
+                    tail = [buf[pos + 1:]]
+                    pos = len(buf)
+                    break
+                try:
+                    entry, pos = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    # Entry split across chunks, wait for the rest
+                    if eof:
+                        raise
+                    break
+                self.add(entry)
+            buf = buf[pos:]
+
+        if head is None:
+            document = buf
+        elif tail is None:
+            raise ValueError('Truncated wal-verify output')
+        else:
+            document = head + '[]' + ''.join(tail)
+        if document.strip():
+            self.status = json.loads(document)['integrity']['status']
+        # Time spent decoding, not waiting on wal-g
+        self.parse_seconds = time.time() - started - waited
+        return self
+
+
+# Storage catalog reader
+# ----------------------
+
+BASEBACKUPS_PATH = 'basebackups_005/'
+SENTINEL_SUFFIX = '_backup_stop_sentinel.json'
+
+
+class SentinelReader():
+    # Backup list read straight from the storage instead of forking wal-g.
+    # A stop sentinel marks each finished backup; the details come from
+    # <backup>/metadata.json, the object backup-list --detail reads too,
+    # as the sentinel has no times nor permanent flag. A cycle is a single
+    # listing: metadata is only fetched for sentinels that are new or whose
+    # ETag changed, on a pool of parallel requests. backup-mark can rewrite
+    # metadata.json alone, so every recheck_interval the metadata of every
+    # backup is checked for a new ETag as well.
+    def __init__(self, storage, workers=8, recheck_interval=3600):
+        self.storage = storage
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='walg-storage')
+        self.recheck_interval = recheck_interval
+        self.checked_at = None
+        # Sentinel key: (sentinel ETag, metadata ETag, entry)
+        self.cache = {}
+
+    def read(self, catalog):
+        # Same contract as BackupCatalog.update()
+        sentinels = sorted((key, etag) for key, etag in self.storage.list(BASEBACKUPS_PATH)
+                           if key.endswith(SENTINEL_SUFFIX))
+        stale = [(key, etag, None) for key, etag in sentinels
+                 if self.cache.get(key, (None,))[0] != etag]
+        now = time.monotonic()
+        if self.checked_at is None or now - self.checked_at >= self.recheck_interval:
+            self.checked_at = now
+            known = [(key, etag) for key, etag in sentinels
+                     if self.cache.get(key, (None,))[0] == etag]
+            meta_etags = self.pool.map(self.storage.stat,
+                                       [self.metadata_key(key) for key, _ in known])
+            stale.extend((key, etag, meta_etag)
+                         for (key, etag), meta_etag in zip(known, meta_etags)
+                         if meta_etag != self.cache[key][1])
+        for (key, etag, _), fetched in zip(stale, self.pool.map(self.fetch, stale)):
+            if fetched is None:
+                # No metadata.json (yet), tried again next cycle
+                debug('Skipping backup %s without metadata.json', self.backup_name(key))
+                self.cache.pop(key, None)
+            else:
+                self.cache[key] = (etag,) + fetched
+        current = set(key for key, _ in sentinels)
+        for key in [key for key in self.cache if key not in current]:
+            del self.cache[key]
+
+        listed = [(key,) + self.cache[key][:2] for key, _ in sentinels if key in self.cache]
+        digest = hashlib.sha1(repr(listed).encode()).digest()
+        if digest == catalog.digest:
+            return None
+        return catalog.merge([self.cache[key][2] for key, _, _ in listed], digest)
+
+    @staticmethod
+    def backup_name(sentinel_key):
+        return sentinel_key[len(BASEBACKUPS_PATH):-len(SENTINEL_SUFFIX)]
+
+    def metadata_key(self, sentinel_key):
+        return '%s%s/metadata.json' % (BASEBACKUPS_PATH, self.backup_name(sentinel_key))
+
+    def fetch(self, item):
+        # (metadata ETag, entry), None while the backup has no metadata.json
+        sentinel_key, _, meta_etag = item
+        name = self.backup_name(sentinel_key)
+        key = self.metadata_key(sentinel_key)
+        if meta_etag is None:
+            meta_etag = self.storage.stat(key)
+            if meta_etag is None:
+                return None
+        meta = json.loads(self.storage.read(key))
+        # Shaped like a backup-list --detail --json entry
+        entry = {'backup_name': name,
+                 'wal_file_name': name[len('base_'):len('base_') + 24],
+                 'start_lsn': meta['start_lsn'],
+                 'finish_lsn': meta['finish_lsn'],
+                 'is_permanent': meta.get('is_permanent', False),
+                 'uncompressed_size': meta['uncompressed_size'],
+                 'compressed_size': meta['compressed_size'],
+                 'start_time': meta['start_time'],
+                 'finish_time': meta['finish_time'],
+                 'date_fmt': meta['date_fmt']}
+        return meta_etag, entry
+
+
+# WAL segment index
+# -----------------
+
+WAL_PATH = 'wal_005/'
+# Segments only, compressed or not; history, backup label and partial
+# files do not match
+WAL_SEGMENT_RE = re.compile(r'^([0-9A-F]{8})([0-9A-F]{8})([0-9A-F]{8})(\.[a-z0-9]+)?$')
+# Parallel uploads (WALG_UPLOAD_CONCURRENCY) can store a segment after a
+# newer one, the incremental listing starts this many segments back
+WAL_INDEX_LOOKBACK = 64
+WAL_INDEX_MAX_GAPS = 20
+
+
+class WalSegmentIndex():
+    # Archived WAL segments of every timeline as sorted, disjoint
+    # [first, last] runs of segment numbers: a healthy archive is a single
+    # run per timeline however long the retention.
+    def __init__(self, segment_size=DEFAULT_WAL_SEGMENT_SIZE):
+        self.segment_size = segment_size
+        self.per_log = 0x100000000 // segment_size
+        self.timelines = {}
+        # (timeline, segment number) of the newest segment
+        self.high_water = None
+        # Last archived segment reported by pg_stat_archiver before the
+        # newest listing started, every segment up to it was listed
+        self.archived = None
+
+    def position(self, name):
+        return (int(name[0:8], 16),
+                int(name[8:16], 16) * self.per_log + int(name[16:24], 16))
+
+    def name(self, timeline, segno):
+        return '%08X%08X%08X' % (timeline, segno // self.per_log,
+                                 segno % self.per_log)
+
+    def add_object(self, name):
+        if not WAL_SEGMENT_RE.match(name):
+            return False
+        self.add(*self.position(name))
+        return True
+
+    def add(self, timeline, segno):
+        if self.high_water is None or (timeline, segno) > self.high_water:
+            self.high_water = (timeline, segno)
+        runs = self.timelines.setdefault(timeline, [])
+        if runs and runs[-1][1] + 1 == segno:
+            # The common case, the archive grows at its end
+            runs[-1][1] = segno
+            return
+        i = bisect.bisect_right(runs, [segno, math.inf])
+        previous = runs[i - 1] if i else None
+        following = runs[i] if i < len(runs) else None
+        if previous and segno <= previous[1]:
+            return
+        if previous and previous[1] + 1 == segno:
+            previous[1] = segno
+            if following and following[0] == segno + 1:
+                previous[1] = following[1]
+                del runs[i]
+        elif following and following[0] == segno + 1:
+            following[0] = segno
         else:
-            wal_archive_list = list(json.loads(res.stdout)["integrity"]["details"])
-            wal_archive_list.sort(key=lambda walarchive: walarchive['timeline_id'])
-            wal_archive_integrity_status = json.loads(res.stdout)["integrity"]["status"]
-
-        wal_archive_count = 0
-        wal_archive_missing_count = 0
-
-        if (len(wal_archive_list) > 0):
-            # Update WAL archive list and export metrics
-            # Count found and missing WAL archives
-            for timelines in wal_archive_list:
-                if timelines['status'] == 'FOUND':
-                    wal_archive_count = wal_archive_count + timelines['segments_count']
+            runs.insert(i, [segno, segno])
+
+    def start_after(self):
+        # Listing key to resume from
+        if self.high_water is None:
+            return None
+        timeline, segno = self.high_water
+        return self.name(timeline, max(segno - WAL_INDEX_LOOKBACK, 0))
+
+    def integrity(self, start=None, end=None):
+        # Found and missing segments from start (oldest backup) to end
+        # (last archived segment), in the shape of the wal-verify result,
+        # and the gaps as (timeline, first, last)
+        found = missing = 0
+        timelines = {}
+        gaps = []
+        for timeline, runs in sorted(self.timelines.items()):
+            if not runs or (start and timeline < start[0]):
+                continue
+            low = start[1] if start and timeline == start[0] else runs[0][0]
+            high = runs[-1][1]
+            if end and timeline == end[0]:
+                high = max(high, end[1])
+            if high < low:
+                continue
+            covered = 0
+            previous = low - 1
+            for first, last in runs:
+                if last < low:
+                    continue
+                if first > high:
+                    break
+                first, last = max(first, low), min(last, high)
+                if first > previous + 1:
+                    gaps.append((timeline, previous + 1, first - 1))
+                covered += last - first + 1
+                previous = last
+            if previous < high:
+                gaps.append((timeline, previous + 1, high))
+            timelines[timeline] = [covered, high - low + 1 - covered]
+            found += covered
+            missing += high - low + 1 - covered
+        return ({'status': 'FAILURE' if missing else 'OK',
+                 'found': found,
+                 'missing': missing,
+                 'timelines': timelines}, gaps)
+
+    def to_state(self):
+        return {'segment_size': self.segment_size,
+                'timelines': dict((str(timeline), runs)
+                                  for timeline, runs in self.timelines.items()),
+                'high_water': self.high_water,
+                'archived': self.archived}
+
+    @classmethod
+    def from_state(cls, state):
+        index = cls(state['segment_size'])
+        index.timelines = dict((int(timeline), runs)
+                               for timeline, runs in state['timelines'].items())
+        index.high_water = tuple(state['high_water']) if state['high_water'] else None
+        archived = state.get('archived')
+        index.archived = archived if archived and WAL_FILE_RE.match(archived) else None
+        return index
+
+
+# Exporter state
+# --------------
+
+STATE_VERSION = 1
+
+
+def write_state(path, state):
+    # Replace the file atomically, a crash leaves the previous state intact
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(state, f, separators=(',', ':'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def read_state(path):
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        warning('Ignoring unreadable state file %s: %s', path, e)
+        return None
+    if state.get('version') != STATE_VERSION:
+        warning('Ignoring state file %s from another exporter version', path)
+        return None
+    return state
+
+
+def encode_row(row):
+    return dict((key, value.isoformat()
+                 if isinstance(value, datetime.datetime) else value)
+                for key, value in row.items())
+
+
+def decode_row(row, keys):
+    return dict((key, datetime.datetime.fromisoformat(value)
+                 if key in keys and value is not None else value)
+                for key, value in row.items())
+
+
+ARCHIVER_SNAPSHOT_QUERY = (
+    'SELECT archived_count, failed_count, '
+    'last_archived_wal, '
+    'last_archived_time, '
+    'last_failed_wal, '
+    'last_failed_time, '
+    'pg_is_in_recovery() AS is_in_recovery, '
+    'CASE WHEN pg_is_in_recovery() THEN NULL '
+    'ELSE pg_current_wal_lsn() END AS current_lsn, '
+    'CASE WHEN pg_is_in_recovery() THEN NULL '
+    'ELSE pg_walfile_name(pg_current_wal_lsn()) END AS current_wal, '
+    '(SELECT setting::bigint * CASE unit WHEN \'8kB\' THEN 8192 ELSE 1 END '
+    'FROM pg_settings WHERE name = \'wal_segment_size\') AS wal_segment_size '
+    'FROM pg_stat_archiver'
+)
+
+
+class PostgresConnection():
+    # Long lived connection shared by every collection, reconnects on the
+    # next query after the server went away
+    def __init__(self, **params):
+        self.params = params
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.connection is None or self.connection.closed:
+            debug('Connecting to postgres at %s:%s',
+                  self.params.get('host'), self.params.get('port'))
+            import psycopg2
+            self.connection = psycopg2.connect(**self.params)
+            self.connection.autocommit = True
+        return self.connection
+
+    def close(self):
+        import psycopg2
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except psycopg2.Error:
+                pass
+            self.connection = None
+
+    def fetchone(self, query):
+        import psycopg2
+        from psycopg2.extras import DictCursor
+        with self.lock:
+            for attempt in (1, 2):
+                try:
+                    with self._connect().cursor(cursor_factory=DictCursor) as c:
+                        c.execute(query)
+                        return c.fetchone()
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    # Stale connection (server restart, failover, idle
+                    # timeout): retry once on a fresh one
+                    self.close()
+                    if attempt == 2:
+                        raise
+
+    def archiver_snapshot(self):
+        res = self.fetchone(ARCHIVER_SNAPSHOT_QUERY)
+        if not res:
+            raise Exception("Cannot fetch archive status")
+        return res
+
+
+# Archiver throughput
+# -------------------
+
+ArchiverSample = collections.namedtuple('ArchiverSample',
+                                        ['at', 'archived', 'failed'])
+
+
+class ArchiverHistory():
+    # Ring buffer of the recent pg_stat_archiver counters. Rates are taken
+    # between the newest sample and the oldest one inside the window, or
+    # the previous sample when the snapshots are further apart than that.
+    def __init__(self, window=600, size=128):
+        self.window = window
+        self.samples = collections.deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, at, archived, failed):
+        with self.lock:
+            last = self.samples[-1] if self.samples else None
+            if last and (archived < last.archived or failed < last.failed):
+                # pg_stat_reset_shared('archiver') or another server behind
+                # the same address, the counters start over
+                self.samples.clear()
+            self.samples.append(ArchiverSample(at, archived, failed))
+
+    def rates(self):
+        # (segments archived per second, failures per second), None until
+        # two samples are available
+        with self.lock:
+            if len(self.samples) < 2:
+                return None
+            newest = self.samples[-1]
+            oldest = self.samples[-2]
+            for sample in self.samples:
+                if sample.at >= newest.at - self.window:
+                    if sample is not newest:
+                        oldest = sample
+                    break
+        elapsed = newest.at - oldest.at
+        if elapsed <= 0:
+            return None
+        return ((newest.archived - oldest.archived) / elapsed,
+                (newest.failed - oldest.failed) / elapsed)
+
+
+# Archive status watcher
+# ----------------------
+
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+def inotify_watch(path, mask):
+    # Returns an inotify fd watching path, or None when inotify is not
+    # available (non Linux, watch limit reached, ...)
+    libc_name = ctypes.util.find_library('c')
+    if libc_name is None:
+        return None
+    try:
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        fd = libc.inotify_init1(IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+        warning('Cannot watch %s: %s', path,
+                os.strerror(ctypes.get_errno()))
+        os.close(fd)
+        return None
+    return fd
+
+
+class ArchiveStatusWatcher():
+    # Live view of the .ready files in archive_status. inotify events keep
+    # it up to date, a periodic scandir reconcile covers missed events and
+    # is the only source when inotify is not available.
+    def __init__(self, path, reconcile_interval=300, poll_interval=60,
+                 rate_window=300):
+        self.path = path
+        self.reconcile_interval = reconcile_interval
+        self.poll_interval = poll_interval
+        self.rate_window = rate_window
+        self.lock = threading.Lock()
+        self.ready = {}
+        self.oldest = []
+        self.arrivals = collections.deque()
+        self.reconciled = False
+        self.inotify = False
+        self.exception = False
+
+    def start(self):
+        worker = threading.Thread(target=self.run, name='walg-archive-status',
+                                  daemon=True)
+        worker.start()
+        return worker
+
+    def run(self):
+        while not walg_common.terminate:
+            fd = inotify_watch(self.path, IN_CREATE | IN_DELETE | IN_MOVED_FROM |
+                               IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF)
+            self.inotify = fd is not None
+            # Watch first, then list, so nothing falls in between
+            self.reconcile()
+            if fd is None:
+                time.sleep(self.poll_interval)
+                continue
+            try:
+                self.follow(fd)
+            finally:
+                os.close(fd)
+
+    def follow(self, fd):
+        next_reconcile = time.time() + self.reconcile_interval
+        while not walg_common.terminate:
+            timeout = max(next_reconcile - time.time(), 0)
+            readable, _, _ = select.select([fd], [], [], timeout)
+            if not readable:
+                self.reconcile()
+                next_reconcile = time.time() + self.reconcile_interval
+                continue
+            buf = os.read(fd, 64 * 1024)
+            now = time.time()
+            offset = 0
+            while offset < len(buf):
+                _, mask, _, length = INOTIFY_EVENT.unpack_from(buf, offset)
+                offset += INOTIFY_EVENT.size
+                name = os.fsdecode(buf[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                if mask & (IN_Q_OVERFLOW | IN_IGNORED |
+                           IN_DELETE_SELF | IN_MOVE_SELF):
+                    # Lost events or the directory went away, start over
+                    # with a fresh watch
+                    return
+                if not READY_WAL_RE.match(name):
+                    continue
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add(name, now)
                 else:
-                    wal_archive_missing_count = wal_archive_missing_count + timelines['segments_count']
+                    self.discard(name)
 
-            # Get archive status from database
-            archive_status = self._last_archive_status()
+    def reconcile(self):
+        ready = {}
+        try:
+            with os.scandir(self.path) as entries:
+                for entry in entries:
+                    # search for xlog waiting for upload
+                    if READY_WAL_RE.match(entry.name):
+                        try:
+                            ready[entry.name] = entry.stat().st_mtime
+                        except FileNotFoundError:
+                            pass
+            self.exception = False
+        except FileNotFoundError:
+            self.exception = True
+        with self.lock:
+            if self.reconciled:
+                for name in ready.keys() - self.ready.keys():
+                    self.arrivals.append(ready[name])
+            self.reconciled = True
+            self.ready = ready
+            self.oldest = sorted(ready)
+
+    def add(self, name, now):
+        with self.lock:
+            if name not in self.ready:
+                self.ready[name] = now
+                heapq.heappush(self.oldest, name)
+                self.arrivals.append(now)
+
+    def discard(self, name):
+        with self.lock:
+            self.ready.pop(name, None)
+
+    def stats(self):
+        # (count, oldest segment, oldest ready since, arrivals per second),
+        # amortized O(1) so it can run on every scrape
+        now = time.time()
+        with self.lock:
+            while self.oldest and self.oldest[0] not in self.ready:
+                heapq.heappop(self.oldest)
+            while self.arrivals and self.arrivals[0] < now - self.rate_window:
+                self.arrivals.popleft()
+            oldest = self.oldest[0] if self.oldest else None
+            return (len(self.ready), oldest,
+                    self.ready[oldest] if oldest else None,
+                    len(self.arrivals) / self.rate_window)
+
+
+def with_cluster(families, cluster):
+    # Label every sample with the target it belongs to, prebuilt samples
+    # already carrying the label are kept as they are
+    for family in families:
+        family.samples = [sample if 'cluster' in sample.labels else
+                          sample._replace(labels=dict(sample.labels, cluster=cluster))
+                          for sample in family.samples]
+        yield family
+
+
+class SnapshotCollector():
+    # Scrapes only hand out the metric families of the last published
+    # snapshots; all the work happens in the collection loops
+    def __init__(self, *exporters):
+        self.exporters = exporters
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        if len(self.exporters) == 1:
+            return self.families(self.exporters[0])
+        # A metric name may only appear once per exposition, families of
+        # the same name from several targets are merged
+        merged = collections.OrderedDict()
+        for exporter in self.exporters:
+            for family in self.families(exporter):
+                target = merged.get(family.name)
+                if target is None:
+                    target = merged[family.name] = Metric(
+                        family.name, family.documentation, family.type)
+                target.samples.extend(family.samples)
+        return merged.values()
+
+    def families(self, exporter):
+        live = self.live_families(exporter)
+        if exporter.cluster is not None:
+            live = with_cluster(live, exporter.cluster)
+        return itertools.chain(exporter.snapshot.families, live)
+
+    def live_families(self, exporter):
+        snapshot = exporter.snapshot
+
+        # archive_status is tracked live by the watcher
+        watcher = exporter.archive_watcher
+        ready, oldest, oldest_since, rate = watcher.stats()
+        yield GaugeMetricFamily('walg_missing_remote_wal_segment_at_end',
+                                'Xlog ready for upload', value=ready)
+        # No segment label, each new oldest segment would be a new series:
+        # the segment is told by its start LSN
+        oldest_ready = GaugeMetricFamily('walg_wal_ready_oldest',
+                                         'Time the oldest WAL segment pending upload became ready')
+        oldest_lsn = GaugeMetricFamily('walg_wal_ready_oldest_lsn',
+                                       'Start LSN of the oldest WAL segment pending upload')
+        if oldest:
+            oldest_ready.add_metric([], oldest_since)
+            position = wal_position(oldest[:-len('.ready')],
+                                    exporter.wal_positions().segment_size)
+            if position is not None:
+                oldest_lsn.add_metric([], position[1])
+        yield oldest_ready
+        yield oldest_lsn
+        yield GaugeMetricFamily('walg_wal_ready_oldest_age_seconds',
+                                'Age of the oldest WAL segment pending upload',
+                                value=time.time() - oldest_since if oldest else 0)
+        yield GaugeMetricFamily('walg_wal_ready_rate',
+                                'New WAL segments ready for upload per second',
+                                value=rate)
+        # The archive lag keeps growing between two archive status updates
+        lag = exporter.archive_lag()
+        last_archived = (exporter.archive_status or {}).get('last_archived_time')
+        lag_seconds = -1
+        if lag == 0:
+            lag_seconds = 0
+        elif lag is not None and last_archived is not None:
+            lag_seconds = time.time() - last_archived.timestamp()
+        yield GaugeMetricFamily('walg_wal_archive_lag_bytes',
+                                'WAL written but not archived yet, -1 if unknown',
+                                value=lag if lag is not None else -1)
+        yield GaugeMetricFamily('walg_wal_archive_lag_seconds',
+                                'Time since the last archived segment while WAL is '
+                                'waiting to be archived, -1 if unknown',
+                                value=lag_seconds)
+        # Net drain of the backlog: archiving throughput minus the rate new
+        # segments become ready
+        rates = exporter.archiver_history.rates()
+        drain = rates[0] - rate if rates else 0
+        yield GaugeMetricFamily('walg_wal_ready_backlog_eta_seconds',
+                                'Estimated seconds until the WAL segments pending '
+                                'upload are archived, -1 if the backlog is not shrinking',
+                                value=ready / drain if drain > 0 else (0 if not ready else -1))
+        yield GaugeMetricFamily('walg_archive_status_inotify',
+                                '1 if archive_status is watched with inotify, '
+                                '0 if it is polled',
+                                value=1 if watcher.inotify else 0)
+        last_success = GaugeMetricFamily('walg_command_last_success_timestamp',
+                                         'End time of the last successful wal-g run',
+                                         labels=['command'])
+        failures = GaugeMetricFamily('walg_command_consecutive_failures',
+                                     'Failed wal-g runs since the last success',
+                                     labels=['command'])
+        stale = GaugeMetricFamily('walg_command_stale',
+                                  '1 if the metrics of a wal-g command are from an '
+                                  'older run because the last ones failed',
+                                  labels=['command'])
+        backoff = GaugeMetricFamily('walg_command_backoff_seconds',
+                                    'Seconds until a failing wal-g command is retried',
+                                    labels=['command'])
+        now = time.time()
+        for name, state in list(exporter.runner.states.items()):
+            last_success.add_metric([name], state.last_success or 0)
+            failures.add_metric([name], state.failures)
+            stale.add_metric([name], 1 if state.failures else 0)
+            backoff.add_metric([name], max(state.retry_at - now, 0))
+        yield last_success
+        yield failures
+        yield stale
+        yield backoff
+        yield GaugeMetricFamily('walg_exception',
+                                'Wal-g exception: 1 for basebackup error, '
+                                '2 for xlog error and '
+                                '3 for both errors',
+                                value=((1 if exporter.basebackup_exception else 0) +
+                                       (2 if watcher.exception else 0)))
+        yield GaugeMetricFamily(
+            'walg_wal_integrity_age_seconds',
+            'Age of the cached wal-verify integrity result, -1 if never verified',
+            value=(time.time() - snapshot.integrity_verified_at
+                   if snapshot.integrity_verified_at else -1))
+
+
+Snapshot = collections.namedtuple('Snapshot',
+                                  ['families', 'integrity_verified_at'])
+WalPositions = collections.namedtuple('WalPositions',
+                                      ['segment_size', 'timeline', 'archived', 'current'])
 
-            # Log WAL informations
-            info("WAL integrity status is: %s", wal_archive_integrity_status)
-            info("Found %s WAL archives in %s timelines, %s WAL archives missing",
-                         wal_archive_count, len(wal_archive_list), wal_archive_missing_count)
 
-            # Update all WAL related metrics
-            # Check for the integrity status and set the metrics accordingly
-            if wal_archive_integrity_status == 'OK':
-                self.wal_integrity_status.labels('OK').set(1)
-                self.wal_integrity_status.labels('FAILURE').set(0)
+class Exporter():
+    def __init__(self, db, archive_watcher, runner=None, state_file=None,
+                 integrity_timeout=None, cluster=None, register=True,
+                 backup_reader=None, wal_storage=None, compact_backups=False,
+                 max_backup_series=0, archiver_window=600):
+        self.db = db
+        # SentinelReader, reads the backup list from the storage instead of
+        # running wal-g backup-list
+        self.backup_reader = backup_reader
+        # With a WAL storage, WAL continuity comes from a local segment index
+        # extended every cycle, and the slow integrity schedule re-lists the
+        # whole archive instead of running wal-verify
+        self.wal_storage = wal_storage
+        self.wal_index = WalSegmentIndex() if wal_storage is not None else None
+        self.wal_index_lock = threading.Lock()
+        # Set when monitoring several targets, every metric gets a cluster
+        # label then
+        self.cluster = cluster
+        self.cluster_label = cluster or ''
+        self.archive_watcher = archive_watcher
+        self.runner = runner or WalgRunner(walg_binary_path)
+        self.integrity_timeout = integrity_timeout
+        self.state_file = state_file
+        self.state_lock = threading.Lock()
+        self.updated_at = None
+        self.restored = False
+        # Jobs still to complete before the restored state is all replaced
+        self.restored_jobs = set()
+        self.basebackup_exception = False
+        self.catalog = BackupCatalog()
+        self.bbs = []
+        # Per backup series: a labelled walg_basebackup sample, or one
+        # sample per compact family. Only the newest max_backup_series
+        # backups (0 for all) and the permanent ones are exported.
+        self.compact_backups = compact_backups
+        self.max_backup_series = max_backup_series
+        self.bb_samples = {}
+        self.bb_stats = backup_stats(())
+        self.archive_status = None
+        # Counters of the recent archive status snapshots, for the archiving
+        # throughput. Kept in memory only, rates start over after a restart.
+        self.archiver_history = ArchiverHistory(archiver_window)
+        # {timeline: {ancestor timeline: switch LSN}} from the history files
+        # in pg_wal, to follow WAL positions across timeline switches
+        self.timeline_history = {}
+        self.integrity = None
+        self.integrity_exception = False
+        self.integrity_verified_at = None
+        self.integrity_duration = 0
+        self.publish_lock = threading.Lock()
+
+        self.snapshot = Snapshot((), None)
+        self.publish()
+        if register:
+            REGISTRY.register(SnapshotCollector(self))
+
+    def publish(self):
+        # Build every metric family once and swap the snapshot atomically,
+        # scrapes never see a half updated state
+        with self.publish_lock:
+            families = self._families()
+            if self.cluster is not None:
+                families = with_cluster(families, self.cluster)
+            self.snapshot = Snapshot(tuple(families),
+                                     self.integrity_verified_at)
+
+    def bb_series(self, bb):
+        samples = bb.compact_samples() if self.compact_backups else bb.full_samples()
+        if self.cluster is None:
+            return samples
+        return tuple(sample._replace(labels=dict(sample.labels, cluster=self.cluster))
+                     for sample in samples)
+
+    def exported_backups(self, bbs):
+        # The newest max_backup_series backups and every permanent one
+        limit = self.max_backup_series
+        if not limit or len(bbs) <= limit:
+            return bbs
+        return [bb for bb in bbs[:-limit] if bb.is_permanent] + bbs[-limit:]
+
+    def _families(self):
+        bbs = self.bbs
+        archive_status = self.archive_status
+        last_bb = bbs[-1] if bbs else None
+
+        families = [GaugeMetricFamily(name, documentation) for name, documentation in
+                    (COMPACT_BASEBACKUP_FAMILIES if self.compact_backups
+                     else BASEBACKUP_FAMILIES)]
+        bb_samples = self.bb_samples
+        exported = self.exported_backups(bbs)
+        for bb in exported:
+            # Records of a backup-list being swapped in are skipped
+            samples = bb_samples.get(bb.name)
+            if samples is not None:
+                for family, sample in zip(families, samples):
+                    family.samples.append(sample)
+        for family in families:
+            yield family
+        yield GaugeMetricFamily('walg_basebackup_count',
+                                'Remote Basebackups count', value=len(bbs))
+        yield GaugeMetricFamily('walg_basebackup_omitted',
+                                'Basebackups without per-backup series because of '
+                                'the series cap',
+                                value=len(bbs) - len(exported))
+
+        stats = self.bb_stats
+        durations = GaugeMetricFamily('walg_basebackup_retention_duration_seconds',
+                                      'Full basebackup duration quantiles over the retention window',
+                                      labels=['quantile'])
+        throughputs = GaugeMetricFamily('walg_basebackup_retention_throughput_bytes_per_second',
+                                        'Full basebackup uncompressed bytes per second '
+                                        'quantiles over the retention window',
+                                        labels=['quantile'])
+        for q, duration, throughput in zip(BACKUP_QUANTILES, stats.durations,
+                                           stats.throughputs):
+            durations.add_metric([str(q)], duration)
+            throughputs.add_metric([str(q)], throughput)
+        yield durations
+        yield throughputs
+        yield GaugeMetricFamily('walg_basebackup_retention_compression_ratio',
+                                'Uncompressed over compressed size of the full '
+                                'basebackups in the retention window',
+                                value=stats.compression_ratio)
+        yield GaugeMetricFamily('walg_basebackup_retention_growth_bytes_per_day',
+                                'Growth of the full basebackup uncompressed size per day',
+                                value=stats.growth_per_day)
+
+        last_upload = GaugeMetricFamily('walg_last_upload',
+                                        'Last upload of incremental or full backup',
+                                        labels=['type'])
+        if archive_status and archive_status['last_archived_time'] is not None:
+            last_archived = archive_status['last_archived_time'].timestamp()
+            last_upload.add_metric(['xlog'], last_archived)
+            last_upload.add_metric(['wal'], last_archived)
+        last_upload.add_metric(['basebackup'],
+                               last_bb.start_time.timestamp() if last_bb else 0)
+        yield last_upload
+        yield GaugeMetricFamily('walg_oldest_basebackup', 'Oldest full backup',
+                                value=bbs[0].start_time.timestamp() if bbs else 0)
+
+        positions = self.wal_positions()
+        ancestors = self.timeline_history.get(positions.timeline)
+        xlogs_since_bb = 0
+        bytes_since_bb = -1
+        if last_bb and archive_status and archive_status['last_archived_wal']:
+            xlogs_since_bb = wal_diff(archive_status['last_archived_wal'],
+                                      last_bb.wal_file_name,
+                                      positions.segment_size, ancestors)
+            bb_start = wal_position(last_bb.wal_file_name, positions.segment_size)
+            if bb_start is not None:
+                distance = wal_distance((bb_start[0], last_bb.finish_lsn),
+                                        positions.archived, ancestors)
+                if distance is not None:
+                    bytes_since_bb = max(distance, 0)
+        yield GaugeMetricFamily('walg_xlogs_since_basebackup',
+                                'Xlog uploaded since last base backup',
+                                value=xlogs_since_bb)
+        yield GaugeMetricFamily('walg_wal_since_basebackup_bytes',
+                                'WAL archived since the last basebackup finished, '
+                                '-1 if unknown',
+                                value=bytes_since_bb)
+        yield GaugeMetricFamily('walg_last_backup_duration',
+                                'Duration of the last full backup',
+                                value=((last_bb.finish_time -
+                                        last_bb.start_time).total_seconds()
+                                       if last_bb else 0))
+
+        archived_rate, failed_rate = self.archiver_history.rates() or (0, 0)
+        yield GaugeMetricFamily('walg_wal_archive_rate_segments_per_second',
+                                'WAL segments archived per second',
+                                value=archived_rate)
+        yield GaugeMetricFamily('walg_wal_archive_rate_bytes_per_second',
+                                'WAL bytes archived per second',
+                                value=archived_rate * positions.segment_size)
+        yield GaugeMetricFamily('walg_wal_archive_failure_rate',
+                                'Failed WAL archiving attempts per second',
+                                value=failed_rate)
+
+        integrity = self.integrity
+        gaps = ()
+        if self.wal_index is not None:
+            integrity, gaps = self.index_integrity()
+        integrity_status = GaugeMetricFamily('walg_wal_integrity_status',
+                                             'Overall WAL archive integrity status',
+                                             labels=['status'])
+        if integrity and integrity['status'] is not None:
+            ok = integrity['status'] == 'OK'
+            integrity_status.add_metric(['OK'], 1 if ok else 0)
+            integrity_status.add_metric(['FAILURE'], 0 if ok else 1)
+        yield integrity_status
+        yield GaugeMetricFamily('walg_wal_archive_count',
+                                'Total WAL archived count from oldest to latest full backup',
+                                value=integrity['found'] if integrity else 0)
+        yield GaugeMetricFamily('walg_wal_archive_missing_count',
+                                'Total missing WAL count',
+                                value=integrity['missing'] if integrity else 0)
+        timeline_segments = GaugeMetricFamily('walg_wal_archive_timeline_segments',
+                                              'WAL segments per timeline and status',
+                                              labels=['timeline', 'status'])
+        if integrity:
+            for timeline, (found, missing) in sorted(integrity['timelines'].items()):
+                timeline_segments.add_metric([str(timeline), 'FOUND'], found)
+                timeline_segments.add_metric([str(timeline), 'MISSING'], missing)
+        yield timeline_segments
+        if self.wal_index is not None:
+            gap_segments = GaugeMetricFamily('walg_wal_archive_gap_segments',
+                                             'Missing WAL segments per gap, newest gaps only',
+                                             labels=['timeline', 'start_segment', 'end_segment'])
+            for timeline, first, last in gaps[-WAL_INDEX_MAX_GAPS:]:
+                gap_segments.add_metric([str(timeline),
+                                         self.wal_index.name(timeline, first),
+                                         self.wal_index.name(timeline, last)],
+                                        last - first + 1)
+            yield gap_segments
+        yield GaugeMetricFamily('walg_wal_integrity_last_success_timestamp',
+                                'End time of the last successful wal-verify integrity run',
+                                value=self.integrity_verified_at or 0)
+        yield GaugeMetricFamily('walg_wal_integrity_last_duration_seconds',
+                                'Duration of the last wal-verify integrity run',
+                                value=self.integrity_duration)
+        yield GaugeMetricFamily('walg_wal_integrity_exception',
+                                '1 if the last wal-verify integrity run failed else 0',
+                                value=1 if self.integrity_exception else 0)
+        yield GaugeMetricFamily('walg_exporter_last_update_timestamp',
+                                'End time of the last completed collection cycle',
+                                value=self.updated_at or 0)
+        yield GaugeMetricFamily('walg_exporter_state_restored',
+                                '1 while serving state restored from disk, until the '
+                                'backup list and the integrity are refreshed after startup',
+                                value=1 if self.restored else 0)
+
+    def wal_positions(self):
+        # Positions of the archive status as (timeline, LSN), None where
+        # unknown: the end of the last archived segment and, on a primary,
+        # the current insert position
+        archive_status = self.archive_status or {}
+        segment_size = (archive_status.get('wal_segment_size') or
+                        DEFAULT_WAL_SEGMENT_SIZE)
+        archived = wal_position(archive_status.get('last_archived_wal'),
+                                segment_size)
+        if archived is not None:
+            archived = (archived[0], archived[1] + segment_size)
+        current = None
+        current_segment = wal_position(archive_status.get('current_wal'),
+                                       segment_size)
+        if current_segment is not None and archive_status.get('current_lsn'):
+            current = (current_segment[0],
+                       parse_lsn(archive_status['current_lsn']))
+        timeline = max(position[0] for position in (archived, current)
+                       if position is not None) if archived or current else None
+        return WalPositions(segment_size, timeline, archived, current)
+
+    def archive_lag(self):
+        # Bytes written but not archived yet, None when unknown
+        positions = self.wal_positions()
+        distance = wal_distance(positions.archived, positions.current,
+                                self.timeline_history.get(positions.timeline))
+        return max(distance, 0) if distance is not None else None
+
+    def load_timeline_history(self):
+        # History files never change once written, the one of the newest
+        # timeline seen is read once from pg_wal, next to archive_status
+        timeline = self.wal_positions().timeline
+        if timeline is None or timeline in self.timeline_history:
+            return
+        ancestors = {}
+        if timeline > 1:
+            path = os.path.join(
+                os.path.dirname(os.path.normpath(self.archive_watcher.path)),
+                '%08X.history' % timeline)
+            try:
+                ancestors = read_timeline_history(path)
+            except (OSError, ValueError) as e:
+                # Not cached: read again on the next archive status update,
+                # the file may not be there yet or readable after a fix
+                warning('Cannot read timeline history %s, WAL lag across '
+                        'timelines is unknown: %s', path, e)
+                return
+        self.timeline_history[timeline] = ancestors
+
+    def save_state(self):
+        if not self.state_file:
+            return
+        archive_status = self.archive_status
+        state = {
+            'version': STATE_VERSION,
+            'saved_at': time.time(),
+            'updated_at': self.updated_at,
+            'catalog': self.catalog.to_state(),
+            'archive_status': (encode_row(archive_status)
+                               if archive_status else None),
+            'integrity': self.integrity,
+            'wal_index': (self.wal_index.to_state()
+                          if self.wal_index is not None else None),
+            'integrity_verified_at': self.integrity_verified_at,
+            'integrity_duration': self.integrity_duration,
+        }
+        with self.state_lock:
+            try:
+                write_state(self.state_file, state)
+            except OSError as e:
+                error('Cannot save state to %s: %s', self.state_file, e)
+
+    def restore_state(self):
+        # Serve the last known values until the first refresh completes
+        if not self.state_file:
+            return False
+        state = read_state(self.state_file)
+        if state is None:
+            return False
+        try:
+            self.catalog.restore(state['catalog'])
+            self.bbs = self.catalog.ordered
+            self.bb_samples = dict((bb.name, self.bb_series(bb)) for bb in self.bbs)
+            self.bb_stats = backup_stats(self.bbs)
+            if state['archive_status']:
+                self.archive_status = decode_row(
+                    state['archive_status'],
+                    ('last_archived_time', 'last_failed_time'))
+                self.load_timeline_history()
+            integrity = state['integrity']
+            if integrity:
+                integrity['timelines'] = dict(
+                    (int(timeline), counts)
+                    for timeline, counts in integrity['timelines'].items())
+            self.integrity = integrity
+            if self.wal_index is not None and state.get('wal_index'):
+                self.wal_index = WalSegmentIndex.from_state(state['wal_index'])
+            self.integrity_verified_at = state['integrity_verified_at']
+            self.integrity_duration = state['integrity_duration']
+            self.updated_at = state['updated_at']
+        except (KeyError, TypeError, ValueError) as e:
+            warning('Ignoring invalid state file %s: %s', self.state_file, e)
+            return False
+        self.restored = True
+        self.restored_jobs = {'backup-list', 'wal-integrity'}
+        self.publish()
+        info('Restored state saved at %s: %s basebackups',
+             datetime.datetime.fromtimestamp(state['saved_at']), len(self.bbs))
+        return True
+
+    def verify_integrity(self):
+        # wal-verify lists every WAL object since the oldest backup, it is
+        # scheduled on its own interval so it never holds up the others
+        started = time.time()
+        verified_at = self.integrity_verified_at
+        try:
+            if self.wal_index is not None:
+                self.rebuild_wal_index()
             else:
-                self.wal_integrity_status.labels('OK').set(0)
-                self.wal_integrity_status.labels('FAILURE').set(1)
-            
-            self.wal_archive_count.set(wal_archive_count)
-            self.wal_archive_missing_count.set(wal_archive_missing_count)
-            self.last_upload.labels('wal').set(archive_status['last_archived_time'].timestamp())
+                self.update_wal_status()
+            if self.integrity_verified_at != verified_at:
+                self.refreshed('wal-integrity')
+        except Exception as e:
+            error(e)
+            self.integrity_exception = True
+        finally:
+            self.integrity_duration = time.time() - started
+            self.publish()
+            self.save_state()
+
+    def run_update(self, update):
+        # One scheduled job: a single update, then the snapshot and the
+        # state file are refreshed
+        try:
+            update()
+        except Exception as e:
+            error(e)
+        self.updated_at = time.time()
+        self.publish()
+        self.save_state()
+
+    def refreshed(self, job):
+        # The restored state is served until the backup list and the
+        # integrity both come from a successful run
+        self.restored_jobs.discard(job)
+        if not self.restored_jobs:
+            self.restored = False
+
+    def schedule(self, scheduler, intervals, enabled=None):
+        cluster = self.cluster_label
+        scheduler.add('backup-list', lambda: self.run_update(self.update_basebackup),
+                      intervals['backup-list'], cluster, refresh=True, enabled=enabled)
+        scheduler.add('archive-status', lambda: self.run_update(self.update_archive_status),
+                      intervals['archive-status'], cluster, refresh=True, enabled=enabled)
+        if self.wal_index is not None:
+            scheduler.add('wal-index', lambda: self.run_update(self.update_wal_index),
+                          intervals['archive-status'], cluster, refresh=True, enabled=enabled)
+        scheduler.add('wal-integrity', self.verify_integrity,
+                      intervals['wal-integrity'], cluster, enabled=enabled,
+                      lane='integrity')
 
+    def update_wal_status(self):
+        info('Updating WAL integrity metrics...')
+        try:
+            # The report grows with retention and timelines, aggregate it
+            # straight from the pipe
+            with instrument('wal-verify', self.cluster_label):
+                report = self.runner.run('wal-verify',
+                                         ['wal-verify', 'integrity', '--json'],
+                                         consume=WalVerifyReader().read,
+                                         timeout=self.integrity_timeout,
+                                         capped=False).output
+                PARSE_DURATION.labels('wal-verify', self.cluster_label).observe(
+                    report.parse_seconds)
+
+        except CommandSkipped as e:
+            info(e)
+            return
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            # Keep serving the last good result
+            error(e)
+            self.integrity_exception = True
+            return
+
+        if report.entries > 0:
+            # Log WAL informations
+            info("WAL integrity status is: %s", report.status)
+            info("Found %s WAL archives in %s timelines, %s WAL archives missing",
+                 report.found, len(report.timelines), report.missing)
             logging.info('Finished updating WAL archive metrics...')
         else:
             logging.info("No WAL archives found")
-            self.wal_archive_count.set(0)
+
+        self.integrity = {'status': report.status,
+                          'found': report.found,
+                          'missing': report.missing,
+                          'timelines': report.timelines}
+        self.integrity_exception = False
+        self.integrity_verified_at = time.time()
+
+    def index_integrity(self):
+        # The index answers for the range wal-verify checks: from the oldest
+        # backup to the last segment archived when the index was listed.
+        # The archiver moves on between two listings, its current position
+        # would count the segments archived since then as missing
+        bbs = self.bbs
+        with self.wal_index_lock:
+            index = self.wal_index
+            start = index.position(bbs[0].wal_file_name) if bbs else None
+            end = index.position(index.archived) if index.archived else None
+            return index.integrity(start, end)
+
+    def archived_wal(self):
+        # Segments only: after a promotion the archiver reports the
+        # timeline .history file, which has no position
+        archive_status = self.archive_status
+        name = archive_status['last_archived_wal'] if archive_status else None
+        return name if name and WAL_FILE_RE.match(name) else None
+
+    def list_wal(self, start_after):
+        # Storage listing only, made without holding wal_index_lock
+        objects = self.wal_storage.list(
+            WAL_PATH, start_after=WAL_PATH + start_after if start_after else None)
+        return [key[len(WAL_PATH):] for key, _ in objects]
+
+    @staticmethod
+    def merge_wal(index, names):
+        added = 0
+        for name in names:
+            if index.add_object(name):
+                added += 1
+        return added
+
+    def update_wal_index(self):
+        # Only the objects after the high-water mark are listed. The lock
+        # is held to read the mark and to merge, scrapes reading the index
+        # never wait for the storage
+        segment_size = (self.archive_status or {}).get('wal_segment_size')
+        # Read before listing, the listing holds every segment up to it
+        archived = self.archived_wal()
+        with instrument('wal-index', self.cluster_label):
+            with self.wal_index_lock:
+                if segment_size and segment_size != self.wal_index.segment_size:
+                    info('WAL segment size is %s, rebuilding the WAL index', segment_size)
+                    self.wal_index = WalSegmentIndex(segment_size)
+                start_after = self.wal_index.start_after()
+            names = self.list_wal(start_after)
+            with self.wal_index_lock:
+                # A rebuild may have swapped the index in the meantime,
+                # adding a segment twice is harmless
+                added = self.merge_wal(self.wal_index, names)
+                if archived:
+                    self.wal_index.archived = archived
+        debug('%s WAL segments added to the index', added)
+
+    def rebuild_wal_index(self):
+        # Full listing on the slow schedule, catches deleted segments
+        info('Rebuilding the WAL index...')
+        with instrument('wal-index-rebuild', self.cluster_label):
+            index = WalSegmentIndex(self.wal_index.segment_size)
+            index.archived = self.archived_wal() or self.wal_index.archived
+            self.merge_wal(index, self.list_wal(None))
+            # Keep what was uploaded during the full listing, later uploads
+            # are within the lookback of the next regular cycle
+            self.merge_wal(index, self.list_wal(index.start_after()))
+            with self.wal_index_lock:
+                if self.wal_index.segment_size == index.segment_size:
+                    self.wal_index = index
+        self.integrity_exception = False
+        self.integrity_verified_at = time.time()
+        integrity, gaps = self.index_integrity()
+        info('WAL index: %s segments in %s timelines, %s missing in %s gaps',
+             integrity['found'], len(integrity['timelines']), integrity['missing'],
+             len(gaps))
+
+    def update_archive_status(self):
+        # Single round-trip per cycle, the snapshot carries the result
+        with instrument('db-query', self.cluster_label):
+            archive_status = self.db.archiver_snapshot()
+        self.archiver_history.add(time.time(), archive_status['archived_count'],
+                                  archive_status['failed_count'])
+        if archive_status['last_archived_time'] is None:
+            error("There is no WAL archiver process running on this postgresql\n"
+                  "Check with SELECT * FROM pg_stat_archiver;")
+        self.archive_status = archive_status
+        self.load_timeline_history()
 
     def update_basebackup(self, *unused):
 
         info('Updating basebackups metrics...')
 
         try:
-            # Fetch remote backup list
-            command = [walg_binary_path, "backup-list",
-                                  "--detail", "--json"]
-            if args.config:
-                command.extend(["--config", args.config])
-
-            res = subprocess.run(command,
-                                 capture_output=True, check=True)
-
-            # Check if backup-list return an empty result
-            if res.stdout.decode("utf-8") is "":
-                new_bbs = []
+            if self.backup_reader is not None:
+                with instrument('storage-catalog', self.cluster_label):
+                    delta = self.backup_reader.read(self.catalog)
             else:
-                new_bbs = list(map(format_date, json.loads(res.stdout)))
-
-            new_bbs.sort(key=lambda bb: bb['start_time'])
-            new_bbs_name = [bb['backup_name'] for bb in new_bbs]
-            old_bbs_name = [bb['backup_name'] for bb in self.bbs]
-            bb_deleted = 0
-
-            # Remove metrics for deleted backups
-            for bb in self.bbs:
-                if bb['backup_name'] not in new_bbs_name:
-                    # Backup deleted
-                    self.basebackup.remove(bb['wal_file_name'],
-                                           bb['start_lsn'])
-                    bb_deleted = bb_deleted + 1
-            # Add metrics for new backups
-            for bb in new_bbs:
-                if bb['backup_name'] not in old_bbs_name:
-                    (self.basebackup.labels(bb['wal_file_name'],
-                                            bb['start_lsn'],
-                                            bb['finish_lsn'],
-                                            bb['is_permanent'],
-                                            convert_size(bb['uncompressed_size']),
-                                            convert_size(bb['compressed_size']),
-                                            bb['start_time'],
-                                            bb['finish_time'])
-                     .set(bb['start_time'].timestamp()))
-
-            if len(new_bbs) == 0:
-                info("No basebackups found")
+                # Fetch remote backup list
+                with instrument('backup-list', self.cluster_label):
+                    output = self.runner.run('backup-list',
+                                             ['backup-list', '--detail', '--json']).output
+                    with PARSE_DURATION.labels('backup-list',
+                                               self.cluster_label).time():
+                        delta = self.catalog.update(output)
+            if delta is None:
+                debug('backup-list output unchanged')
             else:
-                # Update backup list
-                self.bbs = new_bbs
-                info("%s basebackups found (first: %s, last: %s), %s deleted",
-                     len(self.bbs),
-                     self.bbs[0]['start_time'],
-                     self.bbs[len(self.bbs) - 1]['start_time'],
-                     bb_deleted)
+                added, removed = delta
+                # Only the series of added and deleted backups change
+                samples = self.bb_samples.copy()
+                for bb in removed:
+                    del samples[bb.name]
+                for bb in added:
+                    samples[bb.name] = self.bb_series(bb)
+                self.bb_samples = samples
+                bbs = self.catalog.ordered
+                self.bb_stats = backup_stats(bbs)
+                self.bbs = bbs
+                if not bbs:
+                    info("No basebackups found")
+                else:
+                    info("%s basebackups found (first: %s, last: %s), %s added, %s deleted",
+                         len(bbs),
+                         bbs[0].start_time,
+                         bbs[-1].start_time,
+                         len(added), len(removed))
 
             self.basebackup_exception = False
-        except subprocess.CalledProcessError as e:
+            self.refreshed('backup-list')
+        except CommandSkipped as e:
+            info(e)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            # Keep serving the last known backups
             error(e)
             self.basebackup_exception = True
+        except Exception as e:
+            # Storage errors of the backup reader, same as a failed wal-g
+            error('Cannot read the backup list: %s', e)
+            self.basebackup_exception = True
 
-    def last_archive_status(self):
-        if (self.last_archive_check is None or
-                datetime.datetime.now().timestamp() -
-                self.last_archive_check > 1):
-            self.archive_status = self._last_archive_status()
-            self.last_archive_check = datetime.datetime.now().timestamp()
-        return self.archive_status
-
-    def _last_archive_status(self):
-        with psycopg2.connect(
-            host=os.getenv('PGHOST', 'localhost'),
-            port=os.getenv('PGPORT', '5432'),
-            user=os.getenv('PGUSER', 'postgres'),
-            password=os.getenv('PGPASSWORD'),
-            dbname=os.getenv('PGDATABASE', 'postgres'),
-
-        ) as db_connection:
-            db_connection.autocommit = True
-            with db_connection.cursor(cursor_factory=DictCursor) as c:
-                c.execute('SELECT archived_count, failed_count, '
-                          'last_archived_wal, '
-                          'last_archived_time, '
-                          'last_failed_wal, '
-                          'last_failed_time '
-                          'FROM pg_stat_archiver')
-                res = c.fetchone()
-                if not bool(result):
-                    raise Exception("Cannot fetch archive status")
-                return res
-
-    def last_xlog_upload_callback(self):
-        archive_status = self.last_archive_status()
-        if archive_status['last_archived_time'] is None:
-            raise Exception("There is no WAL archiver process running on this postgresql\nCheck with SELECT * FROM pg_stat_archiver;")
-        else:
-            return archive_status['last_archived_time'].timestamp()
-
-    def xlog_ready_callback(self):
-        res = 0
-        try:
-            for f in os.listdir(archive_dir):
-                # search for xlog waiting for upload
-                if READY_WAL_RE.match(f):
-                    res += 1
-            self.xlog_exception = 0
-        except FileNotFoundError:
-            self.xlog_exception = 1
-        return res
 
-    def xlog_since_last_bb_callback(self):
-        # Compute xlog_since_last_basebackup
-        if self.bbs:
-            archive_status = self.last_archive_status()
-            return wal_diff(archive_status['last_archived_wal'],
-                            self.bbs[len(self.bbs) - 1]['wal_file_name'])
-        else:
-            return 0
+# Targets
+# -------
+
+Target = collections.namedtuple('Target', ['cluster', 'dsn', 'archive_dir',
+                                           'walg_config', 'state_file',
+                                           'enable_flag', 'storage_prefix',
+                                           'wal_index'])
+
+
+def read_targets(path, state_file):
+    # One section per cluster, for instance:
+    #
+    #   [main]
+    #   dsn = host=/run/postgresql port=5432 user=postgres
+    #   archive_dir = /var/lib/postgresql/15/main/pg_wal/archive_status
+    #   walg_config = /etc/wal-g/main.yaml
+    #
+    # state_file defaults to WALG_EXPORTER_STATE_FILE suffixed with the
+    # cluster name. A target with an enable_flag is only collected while
+    # that file exists. With a storage_prefix (file path or s3://bucket/path)
+    # the backup list is read from the storage instead of wal-g, and
+    # wal_index = true tracks WAL continuity with the segment index.
+    config = configparser.ConfigParser(interpolation=None)
+    with open(path) as f:
+        config.read_file(f)
+    targets = []
+    for cluster in config.sections():
+        section = config[cluster]
+        targets.append(Target(cluster,
+                              section.get('dsn', ''),
+                              section['archive_dir'],
+                              section.get('walg_config'),
+                              section.get('state_file', '%s.%s' % (state_file, cluster)),
+                              section.get('enable_flag'),
+                              section.get('storage_prefix'),
+                              section.getboolean('wal_index', False)))
+    if not targets:
+        raise ValueError('No target in %s' % path)
+    return targets
 
 
 # Main loop
-if __name__ == '__main__':
+# ---------
+
+def main(argv=None):
+    # Importing the module has no side effect, everything from the command
+    # line to the database happens here. The HTTP endpoint comes up before
+    # any database or wal-g work.
+    global walg_binary_path
+    args = parser.parse_args(argv)
+    if not args.archive_dir and not args.targets:
+        parser.error("--archive_dir or --targets is required")
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    # Disable logging of libs
+    for key in logging.Logger.manager.loggerDict:
+        if key != 'root':
+            logging.getLogger(key).setLevel(logging.WARNING)
+
+    archive_dir = args.archive_dir
     info("Startup...")
     info('My PID is: %s', os.getpid())
 
@@ -346,44 +1705,174 @@ if __name__ == '__main__':
     signal.signal(signal.SIGTERM, signal_handler)
 
     info('Load configuration in /etc/default/walg.env')
+    from dotenv import load_dotenv
     dotenv_path = Path('/etc/default/walg.env')
     load_dotenv(dotenv_path=dotenv_path)
 
     info('Reading configuration')
+    walg_binary_path = os.getenv("WALG_BINARY_PATH", "/usr/local/bin/wal-g")
     dbhost = os.getenv('PGHOST', 'localhost')
     dbport = os.getenv('PGPORT', '5432')
     dbuser = os.getenv('PGUSER', 'postgres')
     dbpassword = os.getenv('PGPASSWORD')
     dbname = os.getenv('PGDATABASE', 'postgres')
     walg_exporter_scrape_interval = int(os.getenv('WALG_EXPORTER_SCRAPE_INTERVAL', 60))
+    walg_exporter_integrity_interval = int(os.getenv('WALG_EXPORTER_INTEGRITY_INTERVAL', 3600))
+    # Each collector runs on its own interval
+    intervals = {
+        'backup-list': int(os.getenv('WALG_EXPORTER_BACKUP_LIST_INTERVAL',
+                                     walg_exporter_scrape_interval)),
+        'archive-status': int(os.getenv('WALG_EXPORTER_ARCHIVE_STATUS_INTERVAL',
+                                        walg_exporter_scrape_interval)),
+        'wal-integrity': walg_exporter_integrity_interval,
+    }
+    walg_exporter_archive_reconcile_interval = int(os.getenv('WALG_EXPORTER_ARCHIVE_RECONCILE_INTERVAL', 300))
+    walg_exporter_archive_rate_window = int(os.getenv('WALG_EXPORTER_ARCHIVE_RATE_WINDOW', 600))
+    walg_exporter_command_timeout = int(os.getenv('WALG_EXPORTER_COMMAND_TIMEOUT', 600))
+    walg_exporter_integrity_timeout = int(os.getenv('WALG_EXPORTER_INTEGRITY_TIMEOUT', 3600))
+    walg_exporter_state_file = os.getenv('WALG_EXPORTER_STATE_FILE',
+                                         '/var/lib/postgresql/walg_exporter.state')
+    walg_exporter_workers = int(os.getenv('WALG_EXPORTER_WORKERS', 4))
+    walg_exporter_integrity_workers = int(os.getenv('WALG_EXPORTER_INTEGRITY_WORKERS', 1))
+    walg_exporter_backup_source = os.getenv('WALG_EXPORTER_BACKUP_SOURCE', 'wal-g')
+    walg_exporter_storage_workers = int(os.getenv('WALG_EXPORTER_STORAGE_WORKERS', 8))
+    walg_exporter_wal_index = os.getenv('WALG_EXPORTER_WAL_INDEX', 'false').lower() == 'true'
+    # Same settings as wal-g itself
+    storage_prefix = os.getenv('WALG_FILE_PREFIX') or os.getenv('WALG_S3_PREFIX')
+    walg_exporter_max_commands = int(os.getenv('WALG_EXPORTER_MAX_COMMANDS',
+                                               walg_exporter_workers))
+    walg_exporter_refresh_debounce = float(os.getenv('WALG_EXPORTER_REFRESH_DEBOUNCE', 2))
+    walg_exporter_refresh_min_interval = float(os.getenv('WALG_EXPORTER_REFRESH_MIN_INTERVAL', 30))
+    walg_exporter_render_max_age = float(os.getenv('WALG_EXPORTER_RENDER_MAX_AGE', 10))
+    walg_exporter_compact_backups = os.getenv('WALG_EXPORTER_BASEBACKUP_SERIES', 'full').lower() == 'compact'
+    walg_exporter_basebackup_max_series = int(os.getenv('WALG_EXPORTER_BASEBACKUP_MAX_SERIES', 0))
+    enable_flag = '/var/lib/postgresql/walg_exporter.enable'
 
     # Start up the server to expose the metrics.
     info('Starting up the server')
-    start_http_server(http_port)
+    refresh = RefreshTrigger(walg_exporter_refresh_debounce,
+                             walg_exporter_refresh_min_interval)
+    refresh.install_signals()
+    cache = RenderCache(REGISTRY, walg_exporter_render_max_age)
+    start_server(http_port, refresh, cache)
     info('Server running in port: %s', http_port)
+    scheduler = Scheduler(walg_exporter_workers, refresh, walg_exporter_scrape_interval,
+                          cache, walg_exporter_integrity_workers)
+
+    def open_backup_reader(prefix):
+        if not prefix:
+            return None
+        storage = open_storage(prefix, walg_exporter_storage_workers)
+        info('Reading the backup list from %s', prefix)
+        return SentinelReader(storage, walg_exporter_storage_workers)
+
+    def open_wal_storage(prefix):
+        if not prefix:
+            return None
+        info('Indexing WAL segments of %s', prefix)
+        return open_storage(prefix, walg_exporter_storage_workers)
+
+    if walg_exporter_backup_source == 'storage' and not storage_prefix:
+        error('WALG_EXPORTER_BACKUP_SOURCE=storage needs WALG_FILE_PREFIX or '
+              'WALG_S3_PREFIX, using wal-g backup-list')
+    if walg_exporter_wal_index and not storage_prefix:
+        error('WALG_EXPORTER_WAL_INDEX needs WALG_FILE_PREFIX or '
+              'WALG_S3_PREFIX, using wal-verify')
+    backup_storage_prefix = storage_prefix if walg_exporter_backup_source == 'storage' else None
+    wal_storage_prefix = storage_prefix if walg_exporter_wal_index else None
+
+    if args.targets:
+        # Every cluster of the host on one endpoint: jobs run on the
+        # scheduler pool and the runners share a cap on wal-g processes
+        targets = read_targets(args.targets, walg_exporter_state_file)
+        info('Monitoring %s clusters: %s', len(targets),
+             ', '.join(target.cluster for target in targets))
+        slots = threading.BoundedSemaphore(walg_exporter_max_commands)
+        exporters = []
+        for target in targets:
+            archive_watcher = ArchiveStatusWatcher(
+                target.archive_dir,
+                reconcile_interval=walg_exporter_archive_reconcile_interval,
+                poll_interval=walg_exporter_scrape_interval)
+            archive_watcher.start()
+            runner = WalgRunner(walg_binary_path, target.walg_config,
+                                timeout=walg_exporter_command_timeout,
+                                backoff=walg_exporter_scrape_interval,
+                                cluster=target.cluster, slots=slots)
+            db = PostgresConnection(dsn=target.dsn,
+                                    application_name='wal-g-prometheus-exporter',
+                                    connect_timeout=10)
+            exporter = Exporter(db, archive_watcher, runner,
+                                state_file=target.state_file,
+                                integrity_timeout=walg_exporter_integrity_timeout,
+                                cluster=target.cluster, register=False,
+                                backup_reader=open_backup_reader(target.storage_prefix),
+                                wal_storage=open_wal_storage(
+                                    target.storage_prefix if target.wal_index else None),
+                                compact_backups=walg_exporter_compact_backups,
+                                max_backup_series=walg_exporter_basebackup_max_series,
+                                archiver_window=walg_exporter_archive_rate_window)
+            exporter.restore_state()
+            exporters.append(exporter)
+            # A target with an enable flag is only collected while it exists
+            enabled = (functools.partial(os.path.isfile, target.enable_flag)
+                       if target.enable_flag else None)
+            exporter.schedule(scheduler, intervals, enabled)
+        REGISTRY.register(SnapshotCollector(*exporters))
+        # Serve the restored state right away
+        cache.invalidate()
+
+        scheduler.run()
+        info('Received SIGTERM, shutting down')
+        raise SystemExit(0)
+
+    db = PostgresConnection(
+        host=dbhost,
+        port=dbport,
+        user=dbuser,
+        password=dbpassword,
+        dbname=dbname,
+        application_name='wal-g-prometheus-exporter',
+        connect_timeout=10,
+    )
+
+    def start_exporter():
+        archive_watcher = ArchiveStatusWatcher(
+            archive_dir,
+            reconcile_interval=walg_exporter_archive_reconcile_interval,
+            poll_interval=walg_exporter_scrape_interval)
+        archive_watcher.start()
+        runner = WalgRunner(walg_binary_path, args.config,
+                            timeout=walg_exporter_command_timeout,
+                            backoff=walg_exporter_scrape_interval)
+        exporter = Exporter(db, archive_watcher, runner,
+                            state_file=walg_exporter_state_file,
+                            integrity_timeout=walg_exporter_integrity_timeout,
+                            backup_reader=open_backup_reader(backup_storage_prefix),
+                            wal_storage=open_wal_storage(wal_storage_prefix),
+                            compact_backups=walg_exporter_compact_backups,
+                            max_backup_series=walg_exporter_basebackup_max_series,
+                            archiver_window=walg_exporter_archive_rate_window)
+        exporter.restore_state()
+        return exporter
+
+    # Serve the state saved by the previous run while Postgres and wal-g
+    # are being reached
+    exporter = start_exporter() if os.path.isfile(enable_flag) else None
+    cache.invalidate()
 
     # Check if this is a master instance
     while True:
-        if terminate:
+        if walg_common.terminate:
                 info('Received SIGTERM, shutting down')
                 break
 
         try:
-            with psycopg2.connect(
-                host = dbhost,
-                port = dbport,
-                user = dbuser,
-                password = dbpassword,
-                dbname = dbname,
-            ) as db_connection:
-                db_connection.autocommit = True
-                with db_connection.cursor() as c:
-                    c.execute("SELECT pg_is_in_recovery();")
-                    result = c.fetchone()
-                    info("Is in recovery mode? %s", result[0])
-                    break
+            result = db.archiver_snapshot()
+            info("Is in recovery mode? %s", result['is_in_recovery'])
+            break
         except Exception:
-            if terminate:
+            if walg_common.terminate:
                 info('Received SIGTERM during exception, shutting down')
                 break
 
@@ -391,36 +1880,29 @@ if __name__ == '__main__':
             time.sleep(walg_exporter_scrape_interval)
 
 
-    first_start = True
-
-    while True:
-        if terminate:
-                info('Received SIGTERM, shutting down')
-                break
+    if walg_common.terminate:
+        raise SystemExit(0)
+    if not os.path.isfile(enable_flag):
+        info('WAL-G exporter is disabled. Waiting to be enabled.')
+        time.sleep(walg_exporter_scrape_interval)
+        raise SystemExit(0)
 
-        try:
-            flag_enable = os.path.isfile('/var/lib/postgresql/walg_exporter.enable')
+    if exporter is None:
+        exporter = start_exporter()
+        cache.invalidate()
+    exporter.schedule(scheduler, intervals)
 
-            if flag_enable:
-                if first_start:
-                    # Launch exporter 
-                    # then set first_start to False so it won't re-initialize Exporter()
-                    exporter = Exporter()
-                    first_start = False
+    def check_enabled():
+        # Exit once the flag is removed, e.g. after a failover
+        if not os.path.isfile(enable_flag):
+            info('WAL-G exporter is disabled. Waiting to be enabled.')
+            scheduler.stop()
 
-                exporter.update_basebackup()
-                exporter.update_wal_status()
+    scheduler.add('enable-flag', check_enabled, walg_exporter_scrape_interval)
+    scheduler.run()
+    if walg_common.terminate:
+        info('Received SIGTERM, shutting down')
 
-                time.sleep(walg_exporter_scrape_interval)
-            else:
-                info('WAL-G exporter is disabled. Waiting to be enabled.')
-                time.sleep(walg_exporter_scrape_interval)
-                break
-        except Exception as e:
-            if terminate:
-                info('Received SIGTERM during exception, shutting down')
-                break
 
-            error('Error occured, retrying in %i seconds.', walg_exporter_scrape_interval)
-            error(e)
-            time.sleep(walg_exporter_scrape_interval)
+if __name__ == '__main__':
+    main()
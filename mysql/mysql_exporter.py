@@ -2,33 +2,44 @@ import os
 import signal
 import subprocess
 import json
+import hashlib
 import datetime
 import argparse
+import re
 import logging
 import time
-from logging import info, error
-from prometheus_client import start_http_server, Gauge
-import pymysql
-from dotenv import load_dotenv
+import math
+import threading
+import bisect
+import collections
+import sys
+from logging import info, error, debug
+from prometheus_client import CollectorRegistry, Counter, Gauge, REGISTRY
+from prometheus_client.core import Metric
 from pathlib import Path
 import configparser
 
+try:
+    import walg_common
+except ImportError:
+    # Run from a checkout: the runtime shared with the PostgreSQL exporter is one level up
+    sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import walg_common
+from walg_common import (CommandSkipped, PARSE_DURATION, RefreshTrigger, RenderCache, Scheduler, WalgRunner, instrument,
+                         open_storage, signal_handler, start_server)
+
 config_db = {}
 config_exporter = {}
 walg_binary_path = os.getenv("WALG_BINARY_PATH", "/usr/local/bin/wal-g")
 
 parser = argparse.ArgumentParser()
 parser.version = "0.3.1"
-parser.add_argument("--archive_dir", required=True, help="MySQL binlog directory (usually datadir)")
+parser.add_argument("--archive_dir", help="MySQL binlog directory (usually datadir)")
 parser.add_argument("--config", help="wal-g config file path")
 parser.add_argument("--debug", action="store_true", help="Enable debug logging")
 parser.add_argument("--version", action="store_true", help="Show binary version")
-args = parser.parse_args()
+parser.add_argument("--targets", help="Monitor every server listed in this file instead of a single one")
 
-logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
-for key in logging.Logger.manager.loggerDict:
-    if key != 'root':
-        logging.getLogger(key).setLevel(logging.WARNING)
 
 def load_headerless_config(path: Path):
     """Parse config where top key=value lines define DB settings (no walg_component needed) and optional [exporter] section follows."""
@@ -81,67 +92,223 @@ def load_headerless_config(path: Path):
             config_exporter = dict(parser_sections['exporter'])
     return True
 
-cfg_path = Path(args.config) if args.config else Path('config/mysql/wal-g-exporter.conf')
-if load_headerless_config(cfg_path):
-    info(f"Loaded config: {cfg_path}")
-else:
-    if args.config:
-        info(f"Config file not found or unreadable: {cfg_path}; continuing with env/defaults")
-
-archive_dir = args.archive_dir
-tmp_binlog_dir = config_db.get('tmp_binlog_dir') or os.getenv('WALG_EXPORTER_TMP_BINLOG_DIR', '/tmp')
-cleanup_enabled_raw = config_db.get('tmp_binlog_cleanup_enabled', 'true')
-cleanup_enabled = str(cleanup_enabled_raw).lower() in ('1','true','yes','on')
-try:
-    cleanup_max_size = int(config_db.get('tmp_binlog_cleanup_max_size', '512'))
-    if cleanup_max_size < 0:
-        raise ValueError
-except ValueError:
-    error("Invalid tmp_binlog_cleanup_max_size; using 512")
-    cleanup_max_size = 512
-if not os.path.isabs(tmp_binlog_dir):
-    error(f"tmp_binlog_dir must be absolute, got: {tmp_binlog_dir}; falling back to /tmp")
-    tmp_binlog_dir = '/tmp'
-if tmp_binlog_dir.rstrip('/') in ('', '/'):  # avoid root
-    error("Refusing to use root directory for tmp_binlog_dir; falling back to /tmp")
-    tmp_binlog_dir = '/tmp'
-try:
-    if not os.path.isdir(tmp_binlog_dir):
-        info(f"tmp_binlog_dir {tmp_binlog_dir} does not exist; attempting to create")
-        os.makedirs(tmp_binlog_dir, exist_ok=True)
-except Exception as _e:  # noqa: BLE001
-    error(f"Cannot ensure tmp_binlog_dir {tmp_binlog_dir}: {_e}; using /tmp")
-    tmp_binlog_dir = '/tmp'
-
-# HTTP listen port precedence: exporter.port > ENV EXPORTER_PORT > default
-http_port = None
-for candidate in [config_exporter.get('port'), os.getenv('EXPORTER_PORT')]:
-    if candidate:
-        try:
-            http_port = int(candidate)
-            break
-        except ValueError:
-            error(f"Invalid port ignored: {candidate}")
-if http_port is None:
-    http_port = 9351
-
-# Scrape interval precedence: exporter.walg_exporter_scrape_interval > ENV > default
-scrape_interval = None
-for candidate in [config_exporter.get('walg_exporter_scrape_interval'), os.getenv('WALG_EXPORTER_SCRAPE_INTERVAL')]:
-    if candidate:
+
+def configure(argv=None):
+    """Parse the command line, then read the config file, environment and defaults into the module settings.
+
+    Importing the module has no side effect: main() calls this first, library users with their own argv.
+    """
+    global args, walg_binary_path, archive_dir, tmp_binlog_dir, cleanup_enabled, cleanup_max_size, cleanup_budget, \
+        state_file, http_port, scrape_interval, command_timeout, workers, integrity_workers, max_commands, \
+        backup_list_interval, \
+        binlog_interval, refresh_debounce, refresh_min_interval, render_max_age, basebackup_series, \
+        basebackup_max_series, storage_prefix, integrity_interval  # noqa: PLW0603
+    args = parser.parse_args(argv)
+    if not args.archive_dir and not args.targets:
+        parser.error("--archive_dir or --targets is required")
+    walg_binary_path = os.getenv("WALG_BINARY_PATH", "/usr/local/bin/wal-g")
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    for key in logging.Logger.manager.loggerDict:
+        if key != 'root':
+            logging.getLogger(key).setLevel(logging.WARNING)
+
+    cfg_path = Path(args.config) if args.config else Path('config/mysql/wal-g-exporter.conf')
+    if load_headerless_config(cfg_path):
+        info(f"Loaded config: {cfg_path}")
+    else:
+        if args.config:
+            info(f"Config file not found or unreadable: {cfg_path}; continuing with env/defaults")
+
+    archive_dir = args.archive_dir
+    tmp_binlog_dir = config_db.get('tmp_binlog_dir') or os.getenv('WALG_EXPORTER_TMP_BINLOG_DIR', '/tmp')
+    cleanup_enabled_raw = config_db.get('tmp_binlog_cleanup_enabled', 'true')
+    cleanup_enabled = str(cleanup_enabled_raw).lower() in ('1','true','yes','on')
+    try:
+        cleanup_max_size = int(config_db.get('tmp_binlog_cleanup_max_size', '512'))
+        if cleanup_max_size < 0:
+            raise ValueError
+    except ValueError:
+        error("Invalid tmp_binlog_cleanup_max_size; using 512")
+        cleanup_max_size = 512
+
+    # Janitor interval and per-run budget (wall seconds, removed files)
+    cleanup_budget = {}
+    for key, default, cast in (('tmp_binlog_cleanup_interval', 300, int), ('tmp_binlog_cleanup_max_seconds', 1.0, float),
+                               ('tmp_binlog_cleanup_max_files', 1000, int)):
         try:
-            scrape_interval = int(candidate)
-            break
+            cleanup_budget[key] = cast(config_db.get(key, default))
+            if cleanup_budget[key] <= 0:
+                raise ValueError
         except ValueError:
-            error(f"Invalid scrape interval ignored: {candidate}")
-if scrape_interval is None:
-    scrape_interval = 60
+            error(f"Invalid {key}; using {default}")
+            cleanup_budget[key] = default
+    if not os.path.isabs(tmp_binlog_dir):
+        error(f"tmp_binlog_dir must be absolute, got: {tmp_binlog_dir}; falling back to /tmp")
+        tmp_binlog_dir = '/tmp'
+    if tmp_binlog_dir.rstrip('/') in ('', '/'):  # avoid root
+        error("Refusing to use root directory for tmp_binlog_dir; falling back to /tmp")
+        tmp_binlog_dir = '/tmp'
+    try:
+        if not os.path.isdir(tmp_binlog_dir):
+            info(f"tmp_binlog_dir {tmp_binlog_dir} does not exist; attempting to create")
+            os.makedirs(tmp_binlog_dir, exist_ok=True)
+    except Exception as _e:  # noqa: BLE001
+        error(f"Cannot ensure tmp_binlog_dir {tmp_binlog_dir}: {_e}; using /tmp")
+        tmp_binlog_dir = '/tmp'
+
+    # State file keeping the last known values across restarts; empty disables it
+    state_file = config_db.get('state_file', os.getenv('WALG_EXPORTER_STATE_FILE', '/var/tmp/walg-mysql-exporter.state'))
+
+    # HTTP listen port precedence: exporter.port > ENV EXPORTER_PORT > default
+    http_port = None
+    for candidate in [config_exporter.get('port'), os.getenv('EXPORTER_PORT')]:
+        if candidate:
+            try:
+                http_port = int(candidate)
+                break
+            except ValueError:
+                error(f"Invalid port ignored: {candidate}")
+    if http_port is None:
+        http_port = 9351
+
+    # Scrape interval precedence: exporter.walg_exporter_scrape_interval > ENV > default
+    scrape_interval = None
+    for candidate in [config_exporter.get('walg_exporter_scrape_interval'), os.getenv('WALG_EXPORTER_SCRAPE_INTERVAL')]:
+        if candidate:
+            try:
+                scrape_interval = int(candidate)
+                break
+            except ValueError:
+                error(f"Invalid scrape interval ignored: {candidate}")
+    if scrape_interval is None:
+        scrape_interval = 60
+
+    # wal-g command timeout precedence: exporter.walg_command_timeout > ENV > default
+    command_timeout = None
+    for candidate in [config_exporter.get('walg_command_timeout'), os.getenv('WALG_EXPORTER_COMMAND_TIMEOUT')]:
+        if candidate:
+            try:
+                command_timeout = int(candidate)
+                break
+            except ValueError:
+                error(f"Invalid command timeout ignored: {candidate}")
+    if command_timeout is None:
+        command_timeout = 600
+
+    # Multi-target mode (--targets): collections running at once, and wal-g processes running at once
+    workers = None
+    for candidate in [config_exporter.get('walg_exporter_workers'), os.getenv('WALG_EXPORTER_WORKERS')]:
+        if candidate:
+            try:
+                workers = int(candidate)
+                break
+            except ValueError:
+                error(f"Invalid workers ignored: {candidate}")
+    if workers is None:
+        workers = 4
+    # Jobs of the integrity lane (full binlog listings) run on a pool of their own
+    integrity_workers = None
+    for candidate in [config_exporter.get('walg_exporter_integrity_workers'), os.getenv('WALG_EXPORTER_INTEGRITY_WORKERS')]:
+        if candidate:
+            try:
+                integrity_workers = int(candidate)
+                break
+            except ValueError:
+                error(f"Invalid integrity workers ignored: {candidate}")
+    if integrity_workers is None:
+        integrity_workers = 1
+    max_commands = None
+    for candidate in [config_exporter.get('walg_exporter_max_commands'), os.getenv('WALG_EXPORTER_MAX_COMMANDS')]:
+        if candidate:
+            try:
+                max_commands = int(candidate)
+                break
+            except ValueError:
+                error(f"Invalid max commands ignored: {candidate}")
+    if max_commands is None:
+        max_commands = workers
 
-terminate = False
+    # Each collector runs on its own interval, default scrape_interval
+    backup_list_interval = None
+    for candidate in [config_exporter.get('walg_exporter_backup_list_interval'), os.getenv('WALG_EXPORTER_BACKUP_LIST_INTERVAL')]:
+        if candidate:
+            try:
+                backup_list_interval = int(candidate)
+                break
+            except ValueError:
+                error(f"Invalid backup-list interval ignored: {candidate}")
+    if backup_list_interval is None:
+        backup_list_interval = scrape_interval
+    binlog_interval = None
+    for candidate in [config_exporter.get('walg_exporter_binlog_interval'), os.getenv('WALG_EXPORTER_BINLOG_INTERVAL')]:
+        if candidate:
+            try:
+                binlog_interval = int(candidate)
+                break
+            except ValueError:
+                error(f"Invalid binlog interval ignored: {candidate}")
+    if binlog_interval is None:
+        binlog_interval = scrape_interval
 
-def signal_handler(sig, frame):  # noqa: ARG001
-    global terminate
-    terminate = True
+    # Refresh requests (POST /-/refresh, SIGUSR1): burst merge window and minimum seconds between runs
+    refresh_debounce = None
+    for candidate in [config_exporter.get('walg_exporter_refresh_debounce'), os.getenv('WALG_EXPORTER_REFRESH_DEBOUNCE')]:
+        if candidate:
+            try:
+                refresh_debounce = float(candidate)
+                break
+            except ValueError:
+                error(f"Invalid refresh debounce ignored: {candidate}")
+    if refresh_debounce is None:
+        refresh_debounce = 2.0
+    refresh_min_interval = None
+    for candidate in [config_exporter.get('walg_exporter_refresh_min_interval'), os.getenv('WALG_EXPORTER_REFRESH_MIN_INTERVAL')]:
+        if candidate:
+            try:
+                refresh_min_interval = float(candidate)
+                break
+            except ValueError:
+                error(f"Invalid refresh min interval ignored: {candidate}")
+    if refresh_min_interval is None:
+        refresh_min_interval = 30.0
+    render_max_age = None
+    for candidate in [config_exporter.get('walg_exporter_render_max_age'), os.getenv('WALG_EXPORTER_RENDER_MAX_AGE')]:
+        if candidate:
+            try:
+                render_max_age = float(candidate)
+                break
+            except ValueError:
+                error(f"Invalid render max age ignored: {candidate}")
+    if render_max_age is None:
+        render_max_age = 10.0
+    # Per-backup series: 'full' labels walg_basebackup with every field, 'compact' keeps backup_name only and exports
+    # the values as gauges of their own; basebackup_max_series caps them to the newest backups plus permanent ones
+    basebackup_series = (config_exporter.get('walg_exporter_basebackup_series')
+                         or os.getenv('WALG_EXPORTER_BASEBACKUP_SERIES') or 'full').lower()
+    basebackup_max_series = None
+    for candidate in [config_exporter.get('walg_exporter_basebackup_max_series'), os.getenv('WALG_EXPORTER_BASEBACKUP_MAX_SERIES')]:
+        if candidate:
+            try:
+                basebackup_max_series = int(candidate)
+                break
+            except ValueError:
+                error(f"Invalid basebackup max series ignored: {candidate}")
+    if basebackup_max_series is None:
+        basebackup_max_series = 0
+    # Binlog archive continuity comes from listings of binlog_005/ in the storage wal-g uploads to. Opt-in: the
+    # WALG_*_PREFIX variables of wal-g are not used, an S3 storage needs boto3
+    storage_prefix = config_exporter.get('walg_storage_prefix') or ''
+    integrity_interval = None
+    for candidate in [config_exporter.get('walg_exporter_integrity_interval'), os.getenv('WALG_EXPORTER_INTEGRITY_INTERVAL')]:
+        if candidate:
+            try:
+                integrity_interval = int(candidate)
+                break
+            except ValueError:
+                error(f"Invalid integrity interval ignored: {candidate}")
+    if integrity_interval is None:
+        integrity_interval = 3600
 
 
 def parse_backup_dates(bb):
@@ -171,148 +338,693 @@ def parse_backup_dates(bb):
     return bb
 
 
+EPOCH = datetime.datetime.fromtimestamp(0, tz=datetime.timezone.utc)
+STATE_VERSION = 1
+
+
+def write_state(path, state):
+    """Replace the state file atomically; a crash leaves the previous state intact."""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(state, f, separators=(',', ':'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def read_state(path):
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        error(f"Ignoring unreadable state file {path}: {e}")
+        return None
+    if state.get('version') != STATE_VERSION:
+        error(f"Ignoring state file {path} from another exporter version")
+        return None
+    return state
+
+
+def parse_plain_backup_list(output):
+    """Parse plain `backup-list` output (name + modification time columns) into backup-list --json shaped dicts."""
+    lines = [l.strip() for l in output.decode('utf-8').splitlines() if l.strip()]
+    raw_bbs = []
+    for line in lines[1:]:
+        parts = line.split()
+        if len(parts) < 2:
+            continue
+        raw_bbs.append({
+            'backup_name': parts[0],
+            'start_time': parts[1],
+            'finish_time': parts[1],
+            'uncompressed_size': 0,
+            'compressed_size': 0
+        })
+    return raw_bbs
+
+
+BINLOG_SEQ_RE = re.compile(r'\.(\d+)')
+
+
+def binlog_seq(filename):
+    m = BINLOG_SEQ_RE.search(filename)
+    return int(m.group(1)) if m else -1
+
+
+def gtid_transactions(gtid_set):
+    """Number of transactions in a GTID set such as 'uuid:1-5:11-18,uuid2:1-27' (tagged GTIDs included)."""
+    total = 0
+    for member in ''.join(gtid_set.split()).split(','):
+        for part in member.split(':')[1:]:
+            first, _, last = part.partition('-')
+            if first.isdigit():
+                total += (int(last) if last.isdigit() else int(first)) - int(first) + 1
+    return total
+
+
+BINLOG_NAME_RE = re.compile(r'^(.+)\.(\d+)$')
+BINLOG_PATH = 'binlog_005/'
+# Uploaded binlogs, compressed or not
+BINLOG_OBJECT_RE = re.compile(r'^(.+\.\d+)(\.[a-z0-9]+)?$')
+# Binlogs can be uploaded out of order, the incremental listing starts this many binlogs back
+BINLOG_INDEX_LOOKBACK = 16
+
+
+def binlog_storage(prefix):
+    """Storage for the binlog archive integrity, None (integrity not reported) without a prefix or without boto3."""
+    if not prefix:
+        return None
+    try:
+        return open_storage(prefix)
+    except ImportError as e:
+        error(f"Binlog archive integrity disabled, {prefix} needs boto3: {e}")
+        return None
+
+
+class BinlogIndex:
+    """Uploaded binlogs of every server (binlog basename) as sorted, disjoint [first, last] runs of sequence numbers.
+
+    Seeded from one full listing of binlog_005/, then each cycle only adds the objects listed after the newest
+    binlog; an unbroken archive stays a single run per server.
+    """
+
+    def __init__(self):
+        self.servers = {}
+
+    def add_object(self, key):
+        """Index a binlog_005/ object key; other objects are ignored."""
+        m = BINLOG_OBJECT_RE.match(key[len(BINLOG_PATH):]) if key.startswith(BINLOG_PATH) else None
+        return self.add(m.group(1)) if m else False
+
+    def start_after(self, server, width):
+        """Listing start for the binlogs of server uploaded since the last listing, None to list them all."""
+        runs = self.servers.get(server)
+        if not runs:
+            return None
+        return f"{BINLOG_PATH}{server}.{max(runs[-1][1] - BINLOG_INDEX_LOOKBACK, 0):0{width}d}"
+
+    def extend(self, other):
+        """Add the binlogs of other newer than the newest of this index, for the servers this index has."""
+        for server, runs in self.servers.items():
+            high = runs[-1][1] if runs else -1
+            for first, last in other.servers.get(server, ()):
+                if last <= high:
+                    continue
+                first = max(first, high + 1)
+                if runs and runs[-1][1] + 1 == first:
+                    runs[-1][1] = last
+                else:
+                    runs.append([first, last])
+                high = last
+
+    def add(self, name):
+        m = BINLOG_NAME_RE.match(name)
+        if not m:
+            return False
+        runs = self.servers.setdefault(m.group(1), [])
+        seq = int(m.group(2))
+        if runs and runs[-1][1] + 1 == seq:
+            # The common case, the archive grows at its end
+            runs[-1][1] = seq
+            return True
+        i = bisect.bisect_right(runs, [seq, math.inf])
+        previous = runs[i - 1] if i else None
+        following = runs[i] if i < len(runs) else None
+        if previous and seq <= previous[1]:
+            return True
+        if previous and previous[1] + 1 == seq:
+            previous[1] = seq
+            if following and following[0] == seq + 1:
+                previous[1] = following[1]
+                del runs[i]
+        elif following and following[0] == seq + 1:
+            following[0] = seq
+        else:
+            runs.insert(i, [seq, seq])
+        return True
+
+    def trim(self, server, start):
+        """Forget the binlogs older than start, no backup can replay them any more."""
+        runs = self.servers.get(server)
+        if not runs:
+            return
+        while runs and runs[0][1] < start:
+            del runs[0]
+        if runs and runs[0][0] < start:
+            runs[0][0] = start
+
+    def integrity(self, server, start=None):
+        """(found, missing, first gap as (first, last) or None) from start to the newest uploaded binlog of server."""
+        runs = self.servers.get(server)
+        if not runs:
+            return 0, 0, None
+        low = runs[0][0] if start is None else start
+        high = runs[-1][1]
+        if high < low:
+            # Nothing uploaded since the backup started
+            return 0, 0, None
+        found = 0
+        first_gap = None
+        previous = low - 1
+        for first, last in runs:
+            if last < low:
+                continue
+            first = max(first, low)
+            if first > previous + 1 and first_gap is None:
+                first_gap = (previous + 1, first - 1)
+            found += last - first + 1
+            previous = last
+        return found, high - low + 1 - found, first_gap
+
+    def to_state(self):
+        return {server: [list(run) for run in runs] for server, runs in self.servers.items()}
+
+    @classmethod
+    def from_state(cls, state):
+        index = cls()
+        index.servers = {server: [list(run) for run in runs] for server, runs in state.items()}
+        return index
+
+
+BinlogSnapshot = collections.namedtuple('BinlogSnapshot', ['binlogs', 'master_status', 'gtid_executed'])
+
+
+class MySQLConnection:
+    """Long lived connection shared by every collection; reconnects on the next query after the server went away."""
+
+    SNAPSHOT_QUERY = 'SHOW BINARY LOGS; SHOW MASTER STATUS; SELECT @@GLOBAL.gtid_executed AS gtid_executed'
+
+    def __init__(self, **conn_args):
+        import pymysql.constants.CLIENT
+        # One round-trip for the whole snapshot
+        self.conn_args = dict(conn_args, client_flag=conn_args.get('client_flag', 0) | pymysql.constants.CLIENT.MULTI_STATEMENTS)
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.connection is None or not self.connection.open:
+            debug(f"Connecting to MySQL at {self.conn_args.get('host')}:{self.conn_args.get('port')}")
+            import pymysql
+            self.connection = pymysql.connect(**self.conn_args)
+        return self.connection
+
+    def close(self):
+        import pymysql
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except pymysql.Error:
+                pass
+            self.connection = None
+
+    def ping(self):
+        """Open the connection if needed and check it answers; the next snapshot reuses it."""
+        with self.lock:
+            with self._connect().cursor() as c:
+                c.execute('SELECT 1')
+                c.fetchone()
+
+    def binlog_snapshot(self):
+        import pymysql.cursors
+        with self.lock:
+            for attempt in (1, 2):
+                try:
+                    with self._connect().cursor(pymysql.cursors.DictCursor) as c:
+                        c.execute(self.SNAPSHOT_QUERY)
+                        binlogs = c.fetchall()
+                        c.nextset()
+                        master_status = c.fetchone()
+                        c.nextset()
+                        row = c.fetchone()
+                    return BinlogSnapshot(binlogs, master_status, (row or {}).get('gtid_executed') or '')
+                except (pymysql.OperationalError, pymysql.InterfaceError):
+                    # Stale connection (server restart, failover, idle timeout): retry once on a fresh one
+                    self.close()
+                    if attempt == 2:
+                        raise
+
+
+class MySQLBackup:
+    """A backup-list entry, built once when the backup first shows up and kept while it is listed."""
+    __slots__ = ('name', 'uncompressed_size', 'compressed_size', 'start_time', 'finish_time', 'binlog_start',
+                 'is_permanent', 'labels')
+
+    def __init__(self, bb):
+        bb = parse_backup_dates(dict(bb))
+        self.name = bb.get('backup_name')
+        self.uncompressed_size = bb.get('uncompressed_size', 0)
+        self.compressed_size = bb.get('compressed_size', 0)
+        self.start_time = bb.get('start_time')
+        self.finish_time = bb.get('finish_time')
+        # First binlog needed to roll this backup forward
+        self.binlog_start = bb.get('binlog_start')
+        self.is_permanent = bool(bb.get('is_permanent'))
+        st_label = self.start_time.isoformat().replace('+00:00', 'Z') if self.start_time else ''
+        ft_label = self.finish_time.isoformat().replace('+00:00', 'Z') if self.finish_time else ''
+        self.labels = (self.name, str(self.uncompressed_size), str(self.compressed_size), st_label, ft_label)
+
+    def same(self, bb):
+        # Only the permanent flag can change, through backup-mark
+        return bool(bb.get('is_permanent')) == self.is_permanent
+
+    def compact_values(self):
+        """Values of the compact basebackup gauges, in the order of MySQLExporter.compact_gauges."""
+        start = (self.start_time or EPOCH).timestamp()
+        finish = (self.finish_time or self.start_time or EPOCH).timestamp()
+        return (start, finish, finish - start, self.uncompressed_size or 0, self.compressed_size or 0,
+                1 if self.is_permanent else 0)
+
+    def rate_values(self):
+        """Values of MySQLExporter.rate_gauges, exported in both modes."""
+        return (self.throughput(), self.compression_ratio())
+
+    def duration(self):
+        if not self.start_time or not self.finish_time:
+            return 0
+        return (self.finish_time - self.start_time).total_seconds()
+
+    def throughput(self):
+        """Uncompressed bytes per second."""
+        duration = self.duration()
+        return (self.uncompressed_size or 0) / duration if duration > 0 else 0
+
+    def compression_ratio(self):
+        return (self.uncompressed_size or 0) / self.compressed_size if self.compressed_size else 0
+
+    def to_state(self):
+        return [self.name, self.uncompressed_size, self.compressed_size, self.labels[3] or None, self.labels[4] or None,
+                self.binlog_start, self.is_permanent]
+
+    @classmethod
+    def from_state(cls, row):
+        # Older rows lack binlog_start and is_permanent
+        name, uncompressed_size, compressed_size, start_time, finish_time, binlog_start, is_permanent = (
+            list(row) + [None, None])[:7]
+        return cls({'backup_name': name, 'uncompressed_size': uncompressed_size, 'compressed_size': compressed_size,
+                    'start_time': start_time, 'finish_time': finish_time, 'binlog_start': binlog_start,
+                    'is_permanent': is_permanent})
+
+
+BACKUP_QUANTILES = (0.5, 0.9, 0.99)
+BackupStats = collections.namedtuple('BackupStats', ['durations', 'throughputs', 'compression_ratio', 'growth_per_day'])
+
+
+def quantiles(values):
+    """Nearest rank quantiles of BACKUP_QUANTILES, empty without values."""
+    values = sorted(values)
+    if not values:
+        return ()
+    return tuple(values[max(math.ceil(q * len(values)) - 1, 0)] for q in BACKUP_QUANTILES)
+
+
+def backup_stats(bbs):
+    """Statistics of the backups in the retention window, computed once per backup list change.
+
+    Only backups with a start and finish time count; the growth per day is the least squares slope of the
+    uncompressed size over the start time.
+    """
+    timed = [bb for bb in bbs if bb.start_time and bb.finish_time]
+    compressed = sum(bb.compressed_size or 0 for bb in timed)
+    growth = 0
+    if len(timed) > 1:
+        days = [bb.start_time.timestamp() / 86400 for bb in timed]
+        mean_day = sum(days) / len(days)
+        mean_size = sum(bb.uncompressed_size or 0 for bb in timed) / len(timed)
+        spread = sum((day - mean_day) ** 2 for day in days)
+        if spread:
+            growth = sum((day - mean_day) * ((bb.uncompressed_size or 0) - mean_size)
+                         for day, bb in zip(days, timed)) / spread
+    return BackupStats(quantiles(bb.duration() for bb in timed), quantiles(bb.throughput() for bb in timed),
+                       sum(bb.uncompressed_size or 0 for bb in timed) / compressed if compressed else 0, growth)
+
+
+class BackupCatalog:
+    """backup-list results indexed by backup_name; unchanged output is skipped and only new entries are parsed."""
+
+    def __init__(self, record=MySQLBackup):
+        self.record = record
+        self.digest = None
+        self.backups = {}
+        self.ordered = []
+
+    def update(self, output, parse=json.loads):
+        """Return (added, removed) records, or None when the output did not change since the last call."""
+        digest = hashlib.sha1(output).digest()
+        if digest == self.digest:
+            return None
+        raw = parse(output) if output.strip() else []
+        backups = {}
+        added = []
+        for bb in raw:
+            if 'backup_name' not in bb:
+                continue
+            record = self.backups.get(bb['backup_name'])
+            if record is None or not record.same(bb):
+                record = self.record(bb)
+                added.append(record)
+            backups[record.name] = record
+        removed = [record for name, record in self.backups.items() if backups.get(name) is not record]
+        if added or removed:
+            self.ordered = sorted(backups.values(), key=lambda record: record.start_time or EPOCH)
+        self.backups = backups
+        self.digest = digest
+        return added, removed
+
+    def __len__(self):
+        return len(self.ordered)
+
+    def to_state(self):
+        return {'digest': self.digest.hex() if self.digest else None,
+                'backups': [record.to_state() for record in self.ordered]}
+
+    def restore(self, state):
+        records = [self.record.from_state(row) for row in state['backups']]
+        self.backups = {record.name: record for record in records}
+        self.ordered = sorted(records, key=lambda record: record.start_time or EPOCH)
+        self.digest = bytes.fromhex(state['digest']) if state['digest'] else None
+
+
+class TargetsCollector:
+    """Serve the registries of several targets on one endpoint, every sample labelled with its cluster."""
+
+    def __init__(self, registries):
+        self.registries = registries
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        # A metric name may only appear once per exposition, families of the same name are merged
+        merged = {}
+        for cluster, registry in self.registries:
+            for family in registry.collect():
+                target = merged.get(family.name)
+                if target is None:
+                    target = merged[family.name] = Metric(family.name, family.documentation, family.type, family.unit)
+                target.samples.extend(sample._replace(labels=dict(sample.labels, cluster=cluster))
+                                      for sample in family.samples)
+        return list(merged.values())
+
+
 class MySQLExporter:
-    def __init__(self, conn_args):
+    def __init__(self, conn_args, state_file=None, runner=None, cluster=None, registry=REGISTRY, archive_dir=None,
+                 storage=None):
         self.conn_args = conn_args
+        self.db = MySQLConnection(**conn_args)
+        # Binlog directory, the file mtimes date the upload backlog
+        self.archive_dir = archive_dir or globals()['archive_dir']
+        self.runner = runner or WalgRunner(walg_binary_path, args.config, registry=registry)
+        # Set when monitoring several targets; the gauges then live in a registry of their own
+        self.cluster = cluster
+        self.cluster_label = cluster or ''
+        self.state_file = state_file
+        self.updated_at = None
+        self.restored = False
+        # Jobs still to complete before the restored state is all replaced
+        self.restored_jobs = set()
         self.basebackup_exception = False
+        self.catalog = BackupCatalog()
+        # Cleared after wal-g rejected `backup-list --detail --json` once, the plain list is used then
+        self.detail_backup_list = True
         self.bbs = []
+        # Backups with per-backup series, see sync_basebackup_series
+        self.compact_backups = basebackup_series == 'compact'
+        self.exported_bbs = {}
         self.latest_uploaded_binlog = None
         self.latest_active_binlog = None
+        # (files, bytes, mtime of the oldest) of the closed binlogs not uploaded yet, None while unknown
+        self.binlog_backlog = None
+        self.gtid_executed = None
+        # Uploaded binlogs listed from the storage, checked against the oldest backup each cycle. Without a
+        # storage the binlog archive integrity is not reported.
+        self.binlog_storage = storage
+        self.binlog_index = BinlogIndex()
+        # A restored index may miss what was uploaded while the exporter was down, the first listing is a full one
+        self.binlog_index_listed = False
+        # backup-list and binlog-find jobs both refresh the integrity and the state file
+        self.binlog_lock = threading.Lock()
+        self.state_lock = threading.Lock()
+        # (found, missing, first gap) of the current server
+        self.binlog_integrity = None
 
         # Metrics
-        self.basebackup = Gauge('walg_basebackup', 'Remote basebackups',
-                                ['backup_name', 'uncompressed_size', 'compressed_size', 'start_time', 'finish_time'])
-        self.basebackup_count = Gauge('walg_basebackup_count', 'Number of basebackups')
-        self.basebackup_exception_flag = Gauge('walg_basebackup_exception', '1 if basebackup retrieval failed else 0')
-        self.oldest_basebackup = Gauge('walg_oldest_basebackup', 'Oldest basebackup start time (unix seconds)')
-        self.last_backup_duration = Gauge('walg_last_backup_duration', 'Duration seconds of last basebackup')
-        self.latest_active_binlog_gauge = Gauge('walg_binlog_latest_active', 'Current active binlog file', ['file'])
-        self.latest_uploaded_binlog_gauge = Gauge('walg_binlog_latest_uploaded', 'Latest uploaded binlog file (wal-g storage)', ['file'])
+        if self.compact_backups:
+            self.basebackup = Gauge('walg_basebackup', 'Remote basebackups', ['backup_name'], registry=registry)
+            self.compact_gauges = [
+                Gauge('walg_basebackup_start_timestamp', 'Basebackup start time', ['backup_name'], registry=registry),
+                Gauge('walg_basebackup_finish_timestamp', 'Basebackup finish time', ['backup_name'], registry=registry),
+                Gauge('walg_basebackup_duration_seconds', 'Basebackup duration', ['backup_name'], registry=registry),
+                Gauge('walg_basebackup_uncompressed_size_bytes', 'Basebackup size before compression', ['backup_name'],
+                      registry=registry),
+                Gauge('walg_basebackup_compressed_size_bytes', 'Basebackup size in the storage', ['backup_name'],
+                      registry=registry),
+                Gauge('walg_basebackup_permanent', '1 if the basebackup is permanent else 0', ['backup_name'],
+                      registry=registry),
+            ]
+        else:
+            self.basebackup = Gauge('walg_basebackup', 'Remote basebackups',
+                                    ['backup_name', 'uncompressed_size', 'compressed_size', 'start_time', 'finish_time'],
+                                    registry=registry)
+            self.compact_gauges = []
+        # Computed values, labels of walg_basebackup can not hold them: both modes export them keyed by backup_name
+        self.rate_gauges = [
+            Gauge('walg_basebackup_throughput_bytes_per_second', 'Basebackup uncompressed bytes per second',
+                  ['backup_name'], registry=registry),
+            Gauge('walg_basebackup_compression_ratio', 'Basebackup uncompressed size over its compressed size',
+                  ['backup_name'], registry=registry),
+        ]
+        self.basebackup_omitted = Gauge('walg_basebackup_omitted', 'Basebackups without per-backup series because of the series cap',
+                                        registry=registry)
+        self.basebackup_count = Gauge('walg_basebackup_count', 'Number of basebackups', registry=registry)
+        self.retention_duration = Gauge('walg_basebackup_retention_duration_seconds',
+                                        'Basebackup duration quantiles over the retention window', ['quantile'],
+                                        registry=registry)
+        self.retention_throughput = Gauge('walg_basebackup_retention_throughput_bytes_per_second',
+                                          'Basebackup uncompressed bytes per second quantiles over the retention window',
+                                          ['quantile'], registry=registry)
+        self.retention_compression_ratio = Gauge('walg_basebackup_retention_compression_ratio',
+                                                 'Uncompressed over compressed size of the basebackups in the retention window',
+                                                 registry=registry)
+        self.retention_growth = Gauge('walg_basebackup_retention_growth_bytes_per_day',
+                                      'Growth of the basebackup uncompressed size per day', registry=registry)
+        self.basebackup_exception_flag = Gauge('walg_basebackup_exception', '1 if basebackup retrieval failed else 0', registry=registry)
+        self.oldest_basebackup = Gauge('walg_oldest_basebackup', 'Oldest basebackup start time (unix seconds)', registry=registry)
+        self.last_backup_duration = Gauge('walg_last_backup_duration', 'Duration seconds of last basebackup', registry=registry)
+        self.latest_active_binlog_gauge = Gauge('walg_binlog_latest_active', 'Current active binlog file', ['file'], registry=registry)
+        self.latest_uploaded_binlog_gauge = Gauge('walg_binlog_latest_uploaded', 'Latest uploaded binlog file (wal-g storage)', ['file'], registry=registry)
+
+        self.pending_files = Gauge('walg_binlog_pending_files', 'Closed binlogs not uploaded yet, -1 if unknown', registry=registry)
+        self.pending_bytes = Gauge('walg_binlog_pending_bytes', 'Size of the closed binlogs not uploaded yet, -1 if unknown',
+                                   registry=registry)
+        self.pending_oldest_age = Gauge('walg_binlog_pending_oldest_age_seconds',
+                                        'Time since the oldest binlog not uploaded yet was closed, -1 if unknown',
+                                        registry=registry)
+        self.latest_uploaded_seq = Gauge('walg_binlog_latest_uploaded_sequence', 'Sequence number of the latest uploaded binlog',
+                                         registry=registry)
+        self.latest_active_seq = Gauge('walg_binlog_latest_active_sequence', 'Sequence number of the current active binlog',
+                                       registry=registry)
+        self.gtid_executed_gauge = Gauge('walg_mysql_gtid_executed_transactions', 'Transactions in @@gtid_executed',
+                                         registry=registry)
+
+        # Only registered with a storage, zeros would read as an empty archive
+        if storage is not None:
+            self.binlog_integrity_status = Gauge('walg_binlog_integrity_status', 'Overall binlog archive integrity status',
+                                                 ['status'], registry=registry)
+            self.binlog_archive_count = Gauge('walg_binlog_archive_count', 'Uploaded binlogs from the oldest basebackup to the latest upload',
+                                              registry=registry)
+            self.binlog_archive_missing = Gauge('walg_binlog_archive_missing_count', 'Binlogs missing from the oldest basebackup to the latest upload',
+                                                registry=registry)
+            self.binlog_first_gap = Gauge('walg_binlog_archive_first_gap', 'Binlogs missing in the oldest gap of the archive',
+                                          ['start_file', 'end_file'], registry=registry)
+            self.binlog_integrity_status.labels('OK').set_function(
+                lambda: 1 if self.binlog_integrity and not self.binlog_integrity[1] else 0)
+            self.binlog_integrity_status.labels('FAILURE').set_function(
+                lambda: 1 if self.binlog_integrity and self.binlog_integrity[1] else 0)
+            self.binlog_archive_count.set_function(lambda: self.binlog_integrity[0] if self.binlog_integrity else 0)
+            self.binlog_archive_missing.set_function(lambda: self.binlog_integrity[1] if self.binlog_integrity else 0)
+
+        self.last_update = Gauge('walg_exporter_last_update_timestamp', 'End time of the last completed collection cycle', registry=registry)
+        self.state_restored = Gauge('walg_exporter_state_restored',
+                                    '1 while serving state restored from disk, until the backup list and the integrity are refreshed after startup',
+                                    registry=registry)
 
         self.basebackup_count.set_function(lambda: len(self.bbs))
+        self.basebackup_omitted.set_function(lambda: len(self.bbs) - len(self.exported_bbs))
+        self.pending_files.set_function(lambda: self.binlog_backlog[0] if self.binlog_backlog else -1)
+        self.pending_bytes.set_function(lambda: self.binlog_backlog[1] if self.binlog_backlog else -1)
+        self.pending_oldest_age.set_function(self._pending_oldest_age_callback)
+        self.latest_uploaded_seq.set_function(lambda: max(binlog_seq(self.latest_uploaded_binlog or ''), 0))
+        self.latest_active_seq.set_function(lambda: max(binlog_seq(self.latest_active_binlog or ''), 0))
+        self.gtid_executed_gauge.set_function(lambda: self.gtid_executed or 0)
+        self.basebackup_exception_flag.set_function(self.basebackup_exception_status)
+        self.last_update.set_function(lambda: self.updated_at or 0)
+        self.state_restored.set_function(lambda: 1 if self.restored else 0)
         self.oldest_basebackup.set_function(self._oldest_bb_callback)
         self.last_backup_duration.set_function(self._last_backup_duration_callback)
 
     # ---- Basebackup ----
     def update_basebackups(self):
         try:
-            cmd = [walg_binary_path, 'backup-list', '--detail', '--json']
-            if args.config:
-                cmd.extend(['--config', args.config])
-            res = subprocess.run(cmd, capture_output=True, check=True)
-            out = res.stdout.decode('utf-8').strip()
-            if not out:
-                new_bbs = []
-            else:
-                raw_bbs = json.loads(out)
-                new_bbs = [parse_backup_dates(bb) for bb in raw_bbs]
-        except subprocess.CalledProcessError:
-            # Fallback plain list
-            try:
-                cmd = [walg_binary_path, 'backup-list']
-                if args.config:
-                    cmd.extend(['--config', args.config])
-                res = subprocess.run(cmd, capture_output=True, check=True)
-                lines = [l.strip() for l in res.stdout.decode('utf-8').splitlines() if l.strip()]
-                new_bbs = []
-                if lines and len(lines) > 1:
-                    for line in lines[1:]:
-                        parts = line.split()
-                        if len(parts) < 2:
-                            continue
-                        name = parts[0]
-                        modified = parts[1]
-                        try:
-                            dt = datetime.datetime.strptime(modified, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=datetime.timezone.utc)
-                        except Exception:  # noqa: BLE001
-                            dt = None
-                        new_bbs.append({
-                            'backup_name': name,
-                            'start_time': dt,
-                            'finish_time': dt,
-                            'uncompressed_size': 0,
-                            'compressed_size': 0
-                        })
-            except Exception as e:  # noqa: BLE001
-                error(f"backup-list fallback failed: {e}")
-                self.basebackup_exception = True
-                self.bbs = []
-                return
+            delta = self.list_backups()
+        except CommandSkipped as e:
+            info(str(e))
+            return
         except FileNotFoundError:
             error("wal-g binary not found for backup-list")
             self.basebackup_exception = True
-            self.bbs = []
+            return
+        except subprocess.CalledProcessError as e:
+            error(f"backup-list failed: {e}")
+            self.basebackup_exception = True
+            return
+        except subprocess.TimeoutExpired as e:
+            # Keep serving the last known backups
+            error(f"backup-list timed out: {e}")
+            self.basebackup_exception = True
             return
         except Exception as e:  # noqa: BLE001
             error(f"Unexpected error listing backups: {e}")
             self.basebackup_exception = True
-            self.bbs = []
             return
 
-        # Update gauges
-        existing_names = {bb['backup_name'] for bb in self.bbs if 'backup_name' in bb}
-        new_names = {bb['backup_name'] for bb in new_bbs if 'backup_name' in bb}
-        for old in self.bbs:
-            if old.get('backup_name') not in new_names:
-                try:
-                    self.basebackup.remove(old.get('backup_name'),
-                                           str(old.get('uncompressed_size', 0)),
-                                           str(old.get('compressed_size', 0)),
-                                           '', '')
-                except Exception:  # noqa: BLE001
-                    pass
-
-        for bb in new_bbs:
-            if bb.get('backup_name') not in existing_names:
-                st = bb.get('start_time')
-                ft = bb.get('finish_time')
-                st_label = st.isoformat().replace('+00:00', 'Z') if isinstance(st, datetime.datetime) else ''
-                ft_label = ft.isoformat().replace('+00:00', 'Z') if isinstance(ft, datetime.datetime) else ''
-                self.basebackup.labels(
-                    bb.get('backup_name'),
-                    str(bb.get('uncompressed_size', 0)),
-                    str(bb.get('compressed_size', 0)),
-                    st_label,
-                    ft_label
-                ).set((ft or st or datetime.datetime.fromtimestamp(0, tz=datetime.timezone.utc)).timestamp())
-
-        new_bbs.sort(key=lambda x: x.get('start_time') or datetime.datetime.fromtimestamp(0, tz=datetime.timezone.utc))
-        self.bbs = new_bbs
         self.basebackup_exception = False
+        self.refreshed('backup-list')
+        if delta is None:
+            return
+        added, removed = delta
+        self.bbs = self.catalog.ordered
+        self.sync_basebackup_series()
+        self.update_backup_stats()
         if self.bbs:
-            info(f"{len(self.bbs)} basebackups found")
+            info(f"{len(self.bbs)} basebackups found, {len(added)} added, {len(removed)} deleted")
         else:
             info("No MySQL basebackups found")
 
+    def list_backups(self):
+        """Backup list delta from `backup-list --detail --json`, or from the plain `backup-list` when that fails.
+
+        A wal-g rejecting the flags or printing something else than JSON does not support them: the plain list is
+        used from then on and the detail command is no longer reported as failing.
+        """
+        if self.detail_backup_list:
+            try:
+                with instrument('backup-list', self.cluster_label):
+                    res = self.runner.run('backup-list', ['backup-list', '--detail', '--json'])
+                    with PARSE_DURATION.labels('backup-list', self.cluster_label).time():
+                        return self.catalog.update(res.output)
+            except subprocess.CalledProcessError as e:
+                if b'unknown flag' in (e.stderr or b''):
+                    self.detail_list_unsupported(e)
+                else:
+                    error(f"backup-list --detail --json failed, trying the plain backup-list: {e}")
+            except ValueError as e:
+                self.detail_list_unsupported(e)
+            except CommandSkipped as e:
+                info(f"{e}, trying the plain backup-list")
+        with instrument('backup-list-plain', self.cluster_label):
+            res = self.runner.run('backup-list-plain', ['backup-list'])
+            with PARSE_DURATION.labels('backup-list-plain', self.cluster_label).time():
+                return self.catalog.update(res.output, parse=parse_plain_backup_list)
+
+    def detail_list_unsupported(self, e):
+        info(f"backup-list --detail --json is not supported, using the plain backup-list from now on: {e}")
+        self.detail_backup_list = False
+        self.runner.forget('backup-list')
+
+    def sync_basebackup_series(self):
+        """Export the newest basebackup_max_series backups (all with 0) and every permanent one.
+
+        Only the series of backups entering or leaving that set change.
+        """
+        bbs = self.bbs
+        limit = basebackup_max_series
+        if limit and len(bbs) > limit:
+            bbs = [bb for bb in bbs[:-limit] if bb.is_permanent] + bbs[-limit:]
+        exported = {bb.name: bb for bb in bbs}
+        for name, old in self.exported_bbs.items():
+            if exported.get(name) is not old:
+                self._remove_basebackup_series(old)
+        for name, bb in exported.items():
+            if self.exported_bbs.get(name) is not bb:
+                self._add_basebackup_series(bb)
+        self.exported_bbs = exported
+
+    def update_backup_stats(self):
+        """Set the retention window gauges from the current backup list."""
+        stats = backup_stats(self.bbs)
+        if not stats.durations:
+            self.retention_duration.clear()
+            self.retention_throughput.clear()
+        for q, duration, throughput in zip(BACKUP_QUANTILES, stats.durations, stats.throughputs):
+            self.retention_duration.labels(str(q)).set(duration)
+            self.retention_throughput.labels(str(q)).set(throughput)
+        self.retention_compression_ratio.set(stats.compression_ratio)
+        self.retention_growth.set(stats.growth_per_day)
+
+    def _basebackup_labels(self, bb):
+        return (bb.name,) if self.compact_backups else bb.labels
+
+    def _add_basebackup_series(self, bb):
+        self.basebackup.labels(*self._basebackup_labels(bb)).set((bb.finish_time or bb.start_time or EPOCH).timestamp())
+        for gauge, value in zip(self.compact_gauges, bb.compact_values()):
+            gauge.labels(bb.name).set(value)
+        for gauge, value in zip(self.rate_gauges, bb.rate_values()):
+            gauge.labels(bb.name).set(value)
+
+    def _remove_basebackup_series(self, bb):
+        try:
+            self.basebackup.remove(*self._basebackup_labels(bb))
+            for gauge in self.compact_gauges + self.rate_gauges:
+                gauge.remove(bb.name)
+        except KeyError:
+            pass
 
     # ---- Binlogs ----
     def update_binlogs(self):
         # Latest uploaded via wal-g binlog-find (plain text, last match wins)
+        latest_uploaded = None
         try:
-            cmd = [walg_binary_path, 'binlog-find']
-            if args.config:
-                cmd.extend(['--config', args.config])
-            res = subprocess.run(cmd, capture_output=True, check=True)
-            stdout = res.stdout.decode('utf-8', errors='replace')
-            stderr = res.stderr.decode('utf-8', errors='replace')
-            # wal-g often writes INFO/WARNING (and even the discovered binlog line) to stderr
-            if args.debug:
-                info(f"binlog-find stdout:\n{stdout}\n--- stderr ---\n{stderr}")
-            combined = '\n'.join([stdout, stderr]).strip()
-            binlogs = []
-            for raw_line in combined.splitlines():
-                line = raw_line.strip()
-                if not line:
-                    continue
-                for token in line.split():
-                    if token.startswith('mysql-bin.') or token.startswith('binlog.'):
-                        binlogs.append(token)
-            # Select the latest binlog by max sequence number
-            def binlog_seq(filename):
-                import re
-                m = re.search(r'(?:mysql-bin\.|binlog\.)(\d+)', filename)
-                return int(m.group(1)) if m else -1
-            latest_uploaded = max(binlogs, key=binlog_seq) if binlogs else None
+            with instrument('binlog-find', self.cluster_label):
+                res = self.runner.run('binlog-find', ['binlog-find'])
+                with PARSE_DURATION.labels('binlog-find', self.cluster_label).time():
+                    stdout = res.output.decode('utf-8', errors='replace')
+                    stderr = res.stderr.decode('utf-8', errors='replace')
+                    # wal-g often writes INFO/WARNING (and even the discovered binlog line) to stderr
+                    if args.debug:
+                        info(f"binlog-find stdout:\n{stdout}\n--- stderr ---\n{stderr}")
+                    combined = '\n'.join([stdout, stderr]).strip()
+                    binlogs = []
+                    for raw_line in combined.splitlines():
+                        line = raw_line.strip()
+                        if not line:
+                            continue
+                        for token in line.split():
+                            if token.startswith('mysql-bin.') or token.startswith('binlog.'):
+                                binlogs.append(token)
+                    # Select the latest binlog by max sequence number
+                    latest_uploaded = max(binlogs, key=binlog_seq) if binlogs else None
             # Remove all previous uploaded binlog gauge values
             for label in list(self.latest_uploaded_binlog_gauge._metrics):
                 self.latest_uploaded_binlog_gauge.remove(label[0])
@@ -322,98 +1034,219 @@ class MySQLExporter:
             else:
                 if args.debug:
                     info('binlog-find produced no identifiable binlog filename')
-
-            # Post binlog-find cleanup (Option B): remove tmp stub files created during binlog discovery.
-            # Safety rules:
-            #  - Only delete files in /tmp starting with mysql-bin. or binlog.
-            #  - Must match pattern (prefix + digits only) to avoid accidental deletion of unrelated files.
-            #  - Skip if file size > 0 (acts only on empty marker files).
-            #  - Best-effort; failures are logged at debug level only.
-            try:
-                if cleanup_enabled:
-                    removed = 0
-                    scanned = 0
-                    skipped_pattern = 0
-                    skipped_size = 0
-                    skipped_error = 0
-                    import re as _re
-                    pat = _re.compile(r'^(mysql-bin|binlog)\.\d+$')
-                    for name in os.listdir(tmp_binlog_dir):
-                        if not (name.startswith('mysql-bin.') or name.startswith('binlog.')):
-                            continue
-                        scanned += 1
-                        full = os.path.join(tmp_binlog_dir, name)
-                        try:
-                            st = os.stat(full)
-                        except FileNotFoundError:
-                            continue
-                        # Pattern check
-                        if not pat.match(name):
-                            skipped_pattern += 1
-                            if args.debug:
-                                info(f"[debug-cleanup-skip] {full} reason=pattern")
-                            continue
-                        # Size threshold check
-                        if st.st_size > cleanup_max_size:
-                            skipped_size += 1
-                            if args.debug:
-                                info(f"[debug-cleanup-skip] {full} reason=size bytes={st.st_size} max={cleanup_max_size}")
-                            continue
-                        try:
-                            os.remove(full)
-                            removed += 1
-                            if args.debug:
-                                info(f"[debug-cleanup-remove] {full} bytes={st.st_size}")
-                        except Exception:  # noqa: BLE001
-                            skipped_error += 1
-                            if args.debug:
-                                info(f"[debug-cleanup-skip] {full} reason=error")
-                    if args.debug:
-                        info(
-                            f"[debug-cleanup] dir={tmp_binlog_dir} scanned={scanned} removed={removed} "
-                            f"skip_pattern={skipped_pattern} skip_size={skipped_size} skip_error={skipped_error} max_size={cleanup_max_size} enabled={cleanup_enabled}"
-                        )
-                else:
-                    if args.debug:
-                        info(f"[debug-cleanup] disabled dir={tmp_binlog_dir}")
-            except Exception as ce:  # noqa: BLE001
-                if args.debug:
-                    info(f"[debug-cleanup] cleanup error: {ce}")
-        except subprocess.CalledProcessError as e:  # noqa: PERF203
+        except CommandSkipped as e:
+            info(str(e))
+            # Not run this cycle, the last identified upload still holds
+            latest_uploaded = self.latest_uploaded_binlog
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:  # noqa: PERF203
             error(f"binlog-find failed: {e}")
         except FileNotFoundError:
             error("wal-g binary not found for binlog-find")
         except Exception as e:  # noqa: BLE001
             error(f"Unexpected binlog-find error: {e}")
         try:
-            conn = pymysql.connect(**self.conn_args)
-            with conn:
-                with conn.cursor(pymysql.cursors.DictCursor) as c:
-                    c.execute('SHOW MASTER STATUS')
-                    row = c.fetchone()
-                    # Remove all previous active binlog gauge values
-                    for label in list(self.latest_active_binlog_gauge._metrics):
-                        self.latest_active_binlog_gauge.remove(label[0])
-                    if row and row.get('File'):
-                        self.latest_active_binlog = row['File']
-                        self.latest_active_binlog_gauge.labels(file=row['File']).set(1)
+            with instrument('db-query', self.cluster_label):
+                snapshot = self.db.binlog_snapshot()
+        except Exception as e:  # noqa: BLE001
+            error(f"Binlog status query failed: {e}")
+            return
+        row = snapshot.master_status
+        # Remove all previous active binlog gauge values
+        for label in list(self.latest_active_binlog_gauge._metrics):
+            self.latest_active_binlog_gauge.remove(label[0])
+        if row and row.get('File'):
+            self.latest_active_binlog = row['File']
+            self.latest_active_binlog_gauge.labels(file=row['File']).set(1)
+        self.gtid_executed = gtid_transactions(snapshot.gtid_executed)
+        self.update_backlog(snapshot.binlogs, latest_uploaded)
+
+    def update_backlog(self, binlogs, latest_uploaded):
+        """Closed binlogs newer than the latest uploaded one; the active binlog can not be uploaded yet.
+
+        latest_uploaded is what binlog-find identified in this cycle, or before when it was skipped. Without it
+        (binlog-find failed, timed out or printed no known binlog name) the backlog is unknown rather than every
+        closed binlog.
+        """
+        if latest_uploaded is None:
+            self.binlog_backlog = None
+            return
+        uploaded = binlog_seq(latest_uploaded)
+        pending = [b for b in binlogs
+                   if binlog_seq(b['Log_name']) > uploaded and b['Log_name'] != self.latest_active_binlog]
+        oldest = None
+        if pending:
+            first = min(pending, key=lambda b: binlog_seq(b['Log_name']))
+            try:
+                oldest = os.stat(os.path.join(self.archive_dir, first['Log_name'])).st_mtime
+            except OSError as e:
+                debug(f"Cannot date pending binlog {first['Log_name']}: {e}")
+        self.binlog_backlog = (len(pending), sum(int(b['File_size']) for b in pending), oldest)
+
+    def binlog_server(self):
+        """Binlog basename match of the current server, None while unknown."""
+        return BINLOG_NAME_RE.match(self.latest_active_binlog or self.latest_uploaded_binlog or '')
+
+    def update_binlog_index(self, full=False):
+        """List the binlogs uploaded after the newest indexed one of the current server, or all of them.
+
+        The storage is listed without the lock, which is only held to merge the result.
+        """
+        m = self.binlog_server()
+        with self.binlog_lock:
+            start_after = None
+            if not full and self.binlog_index_listed and m:
+                start_after = self.binlog_index.start_after(m.group(1), len(m.group(2)))
+        with instrument('binlog-index' if start_after else 'binlog-index-full', self.cluster_label):
+            keys = [key for key, _ in self.binlog_storage.list(BINLOG_PATH, start_after)]
+        if start_after is None:
+            index = BinlogIndex()
+            for key in keys:
+                index.add_object(key)
+            with self.binlog_lock:
+                # Keep what incremental listings added in the meantime
+                index.extend(self.binlog_index)
+                self.binlog_index = index
+                self.binlog_index_listed = True
+            info(f"Binlog index rebuilt from {len(keys)} objects")
+            self.refreshed('binlog-index')
+        else:
+            with self.binlog_lock:
+                added = sum(1 for key in keys if self.binlog_index.add_object(key))
+            debug(f"{added} binlogs added to the index")
+
+    def update_binlog_integrity(self):
+        """Check the uploaded binlogs of the current server from the oldest backup taken on it."""
+        m = self.binlog_server()
+        if not m or self.binlog_storage is None:
+            return
+        server = m.group(1)
+        # Backups taken before a failover start on another server's binlogs
+        starts = [BINLOG_NAME_RE.match(bb.binlog_start or '') for bb in self.bbs]
+        starts = [int(s.group(2)) for s in starts if s and s.group(1) == server]
+        start = starts[0] if starts else None
+        with self.binlog_lock:
+            if start is not None:
+                self.binlog_index.trim(server, start)
+            found, missing, first_gap = self.binlog_index.integrity(server, start)
+            changed = self.binlog_integrity is None or tuple(self.binlog_integrity[1:]) != (missing, first_gap)
+            self.binlog_integrity = (found, missing, first_gap)
+            self.binlog_first_gap.clear()
+            if first_gap:
+                width = len(m.group(2))
+                self.binlog_first_gap.labels(f"{server}.{first_gap[0]:0{width}d}", f"{server}.{first_gap[1]:0{width}d}").set(
+                    first_gap[1] - first_gap[0] + 1)
+                if changed:
+                    error(f"Binlog archive of {server} has {missing} missing binlogs, first gap {first_gap[0]}-{first_gap[1]}")
+
+    def _pending_oldest_age_callback(self):
+        if not self.binlog_backlog:
+            return -1
+        if self.binlog_backlog[2] is None:
+            return 0
+        return max(time.time() - self.binlog_backlog[2], 0)
+
+    # ---- Collection cycle ----
+    def run_update(self, update):
+        """One scheduled job: a single update, then the derived metrics and the state file are refreshed."""
+        try:
+            update()
         except Exception as e:  # noqa: BLE001
-            error(f"SHOW MASTER STATUS failed: {e}")
+            error(f"Collection error: {e}")
+        self.update_binlog_integrity()
+        self.updated_at = time.time()
+        self.save_state()
+
+    def refreshed(self, job):
+        """The restored state is served until the backup list and, with a storage, the full binlog listing both come
+        from a successful run."""
+        self.restored_jobs.discard(job)
+        if not self.restored_jobs:
+            self.restored = False
+
+    def schedule(self, scheduler):
+        scheduler.add('backup-list', lambda: self.run_update(self.update_basebackups), backup_list_interval,
+                      self.cluster_label, refresh=True)
+        scheduler.add('binlog-find', lambda: self.run_update(self.update_binlogs), binlog_interval,
+                      self.cluster_label, refresh=True)
+        if self.binlog_storage is not None:
+            scheduler.add('binlog-index', lambda: self.run_update(self.update_binlog_index), binlog_interval,
+                          self.cluster_label, refresh=True)
+            # Full listing on the slow schedule, catches deleted binlogs
+            scheduler.add('binlog-index-rebuild', lambda: self.run_update(lambda: self.update_binlog_index(full=True)),
+                          integrity_interval, self.cluster_label, lane='integrity')
+
+    # ---- State file ----
+    def save_state(self):
+        if not self.state_file:
+            return
+        with self.binlog_lock:
+            binlog_index = self.binlog_index.to_state()
+        state = {
+            'version': STATE_VERSION,
+            'saved_at': time.time(),
+            'updated_at': self.updated_at,
+            'catalog': self.catalog.to_state(),
+            'latest_uploaded_binlog': self.latest_uploaded_binlog,
+            'latest_active_binlog': self.latest_active_binlog,
+            'binlog_backlog': self.binlog_backlog,
+            'gtid_executed': self.gtid_executed,
+            'binlog_index': binlog_index,
+            'binlog_integrity': self.binlog_integrity,
+        }
+        with self.state_lock:
+            try:
+                write_state(self.state_file, state)
+            except OSError as e:
+                error(f"Cannot save state to {self.state_file}: {e}")
+
+    def restore_state(self):
+        """Serve the last known values until the first refresh completes."""
+        if not self.state_file:
+            return False
+        state = read_state(self.state_file)
+        if state is None:
+            return False
+        try:
+            self.catalog.restore(state['catalog'])
+            self.latest_uploaded_binlog = state['latest_uploaded_binlog']
+            self.latest_active_binlog = state['latest_active_binlog']
+            backlog = state.get('binlog_backlog')
+            self.binlog_backlog = tuple(backlog) if backlog else None
+            self.gtid_executed = state.get('gtid_executed')
+            self.binlog_index = BinlogIndex.from_state(state.get('binlog_index') or {})
+            integrity = state.get('binlog_integrity')
+            if integrity and self.binlog_storage is not None:
+                found, missing, first_gap = integrity
+                self.binlog_integrity = (found, missing, tuple(first_gap) if first_gap else None)
+            self.updated_at = state['updated_at']
+        except (KeyError, TypeError, ValueError) as e:
+            error(f"Ignoring invalid state file {self.state_file}: {e}")
+            return False
+        self.bbs = self.catalog.ordered
+        self.sync_basebackup_series()
+        self.update_backup_stats()
+        if self.latest_uploaded_binlog:
+            self.latest_uploaded_binlog_gauge.labels(file=self.latest_uploaded_binlog).set(1)
+        if self.latest_active_binlog:
+            self.latest_active_binlog_gauge.labels(file=self.latest_active_binlog).set(1)
+        self.restored = True
+        self.restored_jobs = {'backup-list', 'binlog-index'} if self.binlog_storage is not None else {'backup-list'}
+        info(f"Restored state saved at {datetime.datetime.fromtimestamp(state['saved_at'])}: {len(self.bbs)} basebackups")
+        return True
 
     # ---- Metric callbacks ----
     def _oldest_bb_callback(self):
         if not self.bbs:
             return 0
-        first = self.bbs[0]
-        st = first.get('start_time')
+        st = self.bbs[0].start_time
         return st.timestamp() if isinstance(st, datetime.datetime) else 0
 
     def _last_backup_duration_callback(self):
         if not self.bbs:
             return 0
         last = self.bbs[-1]
-        st = last.get('start_time')
-        ft = last.get('finish_time')
+        st = last.start_time
+        ft = last.finish_time
         if st and ft:
             return (ft - st).total_seconds()
         return 0
@@ -422,13 +1255,169 @@ class MySQLExporter:
         return 1 if self.basebackup_exception else 0
 
 
-def main():
-    info("Startup MySQL WAL-G exporter")
+TMP_BINLOG_RE = re.compile(r'^(mysql-bin|binlog)\.\d+$')
+
+CLEANUP_FILES = Counter('walg_tmp_binlog_cleanup_files', 'Files seen by the tmp binlog janitor by outcome', ['result'])
+CLEANUP_BUDGET_EXHAUSTED = Counter('walg_tmp_binlog_cleanup_budget_exhausted',
+                                   'Janitor runs stopped early by their time or file budget', ['budget'])
+
+
+class TmpBinlogJanitor:
+    """Remove the empty binlog stubs binlog-find leaves in tmp_binlog_dir, scheduled on its own interval.
+
+    Safety rules:
+     - Only regular files named mysql-bin.<digits> or binlog.<digits> are candidates.
+     - Files bigger than max_size are kept.
+     - Each run stops after max_seconds or max_files removals. Candidates already looked at in the current pass
+       over the directory are skipped by name, so the next run resumes with the files left instead of spending its
+       budget on the same kept ones; a run reaching the end of the directory starts a new pass.
+    """
+
+    def __init__(self, directory, max_size, interval, max_seconds, max_files):
+        self.directory = directory
+        self.max_size = max_size
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.max_files = max_files
+        # Names looked at since the current pass started
+        self.examined = set()
+
+    def run_once(self):
+        """Return the per-outcome file counts of one run."""
+        counts = collections.Counter()
+        deadline = time.monotonic() + self.max_seconds
+        finished = True
+        with instrument('tmp-cleanup'), os.scandir(self.directory) as entries:
+            for entry in entries:
+                if time.monotonic() > deadline:
+                    CLEANUP_BUDGET_EXHAUSTED.labels('time').inc()
+                    finished = False
+                    break
+                # Only the name is looked at before the pattern matches, unrelated files cost no syscall
+                if not entry.name.startswith(('mysql-bin.', 'binlog.')) or entry.name in self.examined:
+                    continue
+                if counts['removed'] >= self.max_files:
+                    CLEANUP_BUDGET_EXHAUSTED.labels('files').inc()
+                    finished = False
+                    break
+                self.examined.add(entry.name)
+                counts['scanned'] += 1
+                if not TMP_BINLOG_RE.match(entry.name):
+                    counts['skipped_pattern'] += 1
+                    continue
+                try:
+                    if not entry.is_file(follow_symlinks=False):
+                        counts['skipped_pattern'] += 1
+                        continue
+                    size = entry.stat(follow_symlinks=False).st_size
+                    if size > self.max_size:
+                        counts['skipped_size'] += 1
+                        debug(f"[cleanup-skip] {entry.path} reason=size bytes={size} max={self.max_size}")
+                        continue
+                    os.remove(entry.path)
+                    counts['removed'] += 1
+                    debug(f"[cleanup-remove] {entry.path} bytes={size}")
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    counts['skipped_error'] += 1
+                    debug(f"[cleanup-skip] {entry.path} reason=error {e}")
+        if finished:
+            self.examined = set()
+        for result, count in counts.items():
+            CLEANUP_FILES.labels(result).inc(count)
+        debug(f"[cleanup] dir={self.directory} " + ' '.join(f"{result}={count}" for result, count in sorted(counts.items())))
+        return counts
+
+
+def schedule_janitor(scheduler):
+    if not cleanup_enabled:
+        info(f"tmp binlog cleanup disabled for {tmp_binlog_dir}")
+        return None
+    janitor = TmpBinlogJanitor(tmp_binlog_dir, cleanup_max_size, cleanup_budget['tmp_binlog_cleanup_interval'],
+                               cleanup_budget['tmp_binlog_cleanup_max_seconds'], cleanup_budget['tmp_binlog_cleanup_max_files'])
+    scheduler.add('tmp-cleanup', janitor.run_once, janitor.interval)
+    return janitor
+
+
+Target = collections.namedtuple('Target', ['cluster', 'conn_args', 'archive_dir', 'walg_config', 'state_file',
+                                           'storage_prefix'])
+
+
+def read_targets(path):
+    """Read the --targets file, one section per MySQL server.
+
+    Sections take host, port, user, password, database, ssl_disabled, archive_dir, walg_config, state_file
+    (defaults to the exporter state file suffixed with the section name) and storage_prefix (the wal-g storage of
+    the server, for the binlog archive integrity).
+    """
+    config = configparser.ConfigParser(interpolation=None)
+    with open(path) as f:
+        config.read_file(f)
+    targets = []
+    for cluster in config.sections():
+        section = config[cluster]
+        conn_args = dict(host=section.get('host', 'localhost'), port=section.getint('port', 3306),
+                         user=section.get('user', 'root'), password=section.get('password', ''),
+                         database=section.get('database', 'mysql'), charset='utf8mb4', connect_timeout=10)
+        if section.getboolean('ssl_disabled', False):
+            conn_args['ssl'] = None
+        targets.append(Target(cluster, conn_args, section['archive_dir'], section.get('walg_config'),
+                              section.get('state_file', f"{state_file}.{cluster}" if state_file else ''),
+                              section.get('storage_prefix')))
+    if not targets:
+        raise ValueError(f"No target in {path}")
+    return targets
+
+
+def monitor_targets(targets):
+    """Serve every server of the host on one endpoint; jobs run on the scheduler pool and the runners share a cap
+    on wal-g processes."""
+    info(f"Monitoring {len(targets)} servers: {', '.join(target.cluster for target in targets)}")
+    slots = threading.BoundedSemaphore(max_commands)
+    refresh = RefreshTrigger(refresh_debounce, refresh_min_interval)
+    refresh.install_signals()
+    cache = RenderCache(REGISTRY, render_max_age)
+    start_server(http_port, refresh, cache)
+    info(f'Exporter listening on {http_port}')
+    scheduler = Scheduler(workers, refresh, scrape_interval, cache, integrity_workers)
+    exporters = []
+    registries = []
+    for target in targets:
+        registry = CollectorRegistry()
+        runner = WalgRunner(walg_binary_path, target.walg_config, timeout=command_timeout, backoff=scrape_interval,
+                            cluster=target.cluster, slots=slots, registry=registry)
+        exporter = MySQLExporter(target.conn_args, state_file=target.state_file, runner=runner,
+                                 cluster=target.cluster, registry=registry, archive_dir=target.archive_dir,
+                                 storage=binlog_storage(target.storage_prefix))
+        exporter.restore_state()
+        exporter.schedule(scheduler)
+        exporters.append(exporter)
+        registries.append((target.cluster, registry))
+    REGISTRY.register(TargetsCollector(registries))
+    # Serve the restored state right away
+    cache.invalidate()
+    schedule_janitor(scheduler)
+
+    scheduler.run()
+    info('Shutdown requested')
+
+
+def main(argv=None):
+    """Run the exporter; the HTTP endpoint comes up before any database or wal-g work."""
     signal.signal(signal.SIGTERM, signal_handler)
 
+    # walg.env may set any of the settings read by configure()
     dotenv_path = Path('/etc/default/walg.env')
     if dotenv_path.exists():
+        from dotenv import load_dotenv
         load_dotenv(dotenv_path=dotenv_path)
+    configure(argv)
+    info("Startup MySQL WAL-G exporter")
+
+    if args.targets:
+        monitor_targets(read_targets(args.targets))
+        return
 
     # Connection params (env > defaults) - config file overrides handled earlier if desired
     dbhost = config_db.get('host') or os.getenv('MYSQL_HOST', 'localhost')
@@ -442,38 +1431,39 @@ def main():
     if ssl_disabled:
         conn_args['ssl'] = None
 
-    exporter = MySQLExporter(conn_args)
-    # Add dynamic exception gauge (value provided via function)
-    exporter.basebackup_exception_flag.set_function(exporter.basebackup_exception_status)
-
-    start_http_server(http_port)
+    refresh = RefreshTrigger(refresh_debounce, refresh_min_interval)
+    refresh.install_signals()
+    cache = RenderCache(REGISTRY, render_max_age)
+    start_server(http_port, refresh, cache)
     info(f'Exporter listening on {http_port}')
 
-    # Warm-up DB connectivity
-    while True:
+    runner = WalgRunner(walg_binary_path, args.config, timeout=command_timeout, backoff=scrape_interval, registry=REGISTRY)
+    if not storage_prefix:
+        info('Binlog archive integrity needs walg_storage_prefix, not reported')
+    exporter = MySQLExporter(conn_args, state_file=state_file, runner=runner, storage=binlog_storage(storage_prefix))
+    exporter.restore_state()
+    # Serve the restored state right away
+    cache.invalidate()
+    scheduler = Scheduler(workers, refresh, scrape_interval, cache, integrity_workers)
+    schedule_janitor(scheduler)
+
+    # Warm-up DB connectivity on the connection the collections keep using
+    while not walg_common.terminate:
         try:
-            conn = pymysql.connect(**conn_args)
+            exporter.db.ping()
             info(f"Connected to MySQL at {dbhost}:{dbport}")
-            with conn:
-                with conn.cursor() as c:
-                    c.execute('SELECT 1')
-                    c.fetchone()
             break
         except Exception as e:  # noqa: BLE001
+            exporter.db.close()
             error(f"Initial DB connect failed: {e}")
             time.sleep(5)
+    if walg_common.terminate:
+        info('Shutdown requested')
+        return
 
-    # Main loop
-    while True:
-        if terminate:
-            info('Shutdown requested')
-            break
-        try:
-            exporter.update_basebackups()
-            exporter.update_binlogs()
-        except Exception as e:  # noqa: BLE001
-            error(f"Loop error: {e}")
-        time.sleep(scrape_interval)
+    exporter.schedule(scheduler)
+    scheduler.run()
+    info('Shutdown requested')
 
 if __name__ == '__main__':
     main()
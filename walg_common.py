@@ -0,0 +1,704 @@
+"""Runtime shared by the PostgreSQL and MySQL exporters.
+
+wal-g runner, self-instrumentation, storage listings, refresh trigger,
+rendered output cache and job scheduler. Both scripts import it, and both
+PyInstaller builds bundle it.
+"""
+import collections
+import concurrent.futures
+import contextlib
+import gzip
+import hashlib
+import heapq
+import http.server
+import ipaddress
+import itertools
+import math
+import os
+import random
+import select
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from logging import info, error
+from prometheus_client import REGISTRY
+from prometheus_client import MetricsHandler
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.exposition import choose_encoder, gzip_accepted
+
+# Set by SIGTERM, every loop of both exporters checks it
+terminate = False
+
+
+def signal_handler(sig, frame):
+    global terminate
+    info('SIGTERM received, preparing to shutdown')
+    terminate = True
+
+
+# Self instrumentation
+# --------------------
+
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300,
+                    600, 1800, 3600)
+PARSE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+STAGE_DURATION = Histogram('walg_exporter_stage_duration_seconds',
+                           'Wall time of a collection stage',
+                           ['stage', 'cluster'], buckets=DURATION_BUCKETS)
+STAGE_FAILURES = Counter('walg_exporter_stage_failures',
+                         'Failed collection stages by cause',
+                         ['stage', 'cause', 'cluster'])
+PARSE_DURATION = Histogram('walg_exporter_parse_duration_seconds',
+                           'Time spent parsing wal-g output',
+                           ['stage', 'cluster'], buckets=PARSE_BUCKETS)
+COMMAND_OUTPUT = Counter('walg_command_output_bytes',
+                         'Bytes written by wal-g commands',
+                         ['command', 'stream', 'cluster'])
+COMMAND_CPU = Counter('walg_command_cpu_seconds',
+                      'CPU time used by wal-g commands',
+                      ['command', 'mode', 'cluster'])
+COMMAND_MAX_RSS = Gauge('walg_command_max_rss_bytes',
+                        'Peak resident memory of the last wal-g run',
+                        ['command', 'cluster'])
+
+
+def failure_cause(e):
+    if isinstance(e, subprocess.TimeoutExpired):
+        return 'timeout'
+    if isinstance(e, subprocess.CalledProcessError):
+        return 'exit_code'
+    if isinstance(e, FileNotFoundError):
+        return 'not_found'
+    # The database drivers are only imported once a connection is made
+    for driver in ('psycopg2', 'pymysql'):
+        module = sys.modules.get(driver)
+        if module is not None and isinstance(e, module.Error):
+            return 'database'
+    if isinstance(e, (ValueError, KeyError, TypeError)):
+        return 'parse'
+    return 'other'
+
+
+@contextlib.contextmanager
+def instrument(stage, cluster=''):
+    # Wall time and failures of one collection stage; skipped commands did
+    # not run and are not recorded. The cluster label stays empty, which
+    # Prometheus treats as no label, unless several targets are monitored
+    started = time.time()
+    try:
+        yield
+    except CommandSkipped:
+        raise
+    except Exception as e:
+        STAGE_FAILURES.labels(stage, failure_cause(e), cluster).inc()
+        STAGE_DURATION.labels(stage, cluster).observe(time.time() - started)
+        raise
+    STAGE_DURATION.labels(stage, cluster).observe(time.time() - started)
+
+
+class CountingReader():
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.bytes += len(data)
+        return data
+
+
+# wal-g commands
+# --------------
+
+CommandResult = collections.namedtuple('CommandResult', ['output', 'stderr'])
+
+
+class CommandSkipped(Exception):
+    pass
+
+
+class CommandState():
+    __slots__ = ('lock', 'failures', 'retry_at', 'last_success', 'last_error')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.retry_at = 0
+        self.last_success = None
+        self.last_error = None
+
+
+def read_all(stream):
+    return stream.read()
+
+
+class WalgRunner():
+    # Every wal-g call goes through the runner: a hung command is killed
+    # after its timeout, the same command never runs twice at once and
+    # repeated failures back off exponentially, with jitter, instead of
+    # hammering a throttled storage. Callers keep serving their last data.
+    # Runners of several targets can share slots, a semaphore capping the
+    # wal-g processes running at once. Runs with capped=False skip it, the
+    # integrity lane of the scheduler bounds those on its own. With a
+    # registry, the walg_command_* gauges of each command are registered
+    # there; without one the caller reports `states` itself.
+    def __init__(self, binary, config=None, timeout=600, backoff=30,
+                 max_backoff=1800, cluster='', slots=None, registry=None):
+        self.binary = binary
+        self.config = config
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.cluster = cluster
+        self.slots = slots
+        self.lock = threading.Lock()
+        self.states = {}
+        self.gauges = ()
+        if registry is not None:
+            self.gauges = (
+                Gauge('walg_command_last_success_timestamp',
+                      'End time of the last successful wal-g run',
+                      ['command'], registry=registry),
+                Gauge('walg_command_consecutive_failures',
+                      'Failed wal-g runs since the last success',
+                      ['command'], registry=registry),
+                Gauge('walg_command_stale',
+                      '1 if the metrics of a wal-g command are from an '
+                      'older run because the last ones failed',
+                      ['command'], registry=registry),
+                Gauge('walg_command_backoff_seconds',
+                      'Seconds until a failing wal-g command is retried',
+                      ['command'], registry=registry))
+
+    def command_state(self, name):
+        with self.lock:
+            if name not in self.states:
+                state = self.states[name] = CommandState()
+                if self.gauges:
+                    last_success, failures, stale, backoff = self.gauges
+                    last_success.labels(name).set_function(
+                        lambda: state.last_success or 0)
+                    failures.labels(name).set_function(lambda: state.failures)
+                    stale.labels(name).set_function(
+                        lambda: 1 if state.failures else 0)
+                    backoff.labels(name).set_function(
+                        lambda: max(state.retry_at - time.time(), 0))
+            return self.states[name]
+
+    def forget(self, name):
+        # Drop the state and the series of a command that is not run any more
+        with self.lock:
+            if self.states.pop(name, None) is None:
+                return
+            for gauge in self.gauges:
+                gauge.remove(name)
+
+    def run(self, name, arguments, consume=read_all, timeout=None, capped=True):
+        state = self.command_state(name)
+        wait = state.retry_at - time.time()
+        if wait > 0:
+            raise CommandSkipped('%s backing off for %ss after %s failures'
+                                 % (name, math.ceil(wait), state.failures))
+        if not state.lock.acquire(blocking=False):
+            raise CommandSkipped('%s is still running' % name)
+        try:
+            command = [self.binary] + arguments
+            if self.config:
+                command.extend(['--config', self.config])
+            if self.slots is None or not capped:
+                result = self.execute(name, command, consume,
+                                      timeout or self.timeout)
+            else:
+                with self.slots:
+                    result = self.execute(name, command, consume,
+                                          timeout or self.timeout)
+        except Exception as e:
+            state.failures += 1
+            state.last_error = e
+            if state.failures > 1:
+                delay = min(self.max_backoff,
+                            self.backoff * 2 ** (state.failures - 2))
+                state.retry_at = time.time() + random.uniform(delay / 2, delay)
+            raise
+        finally:
+            state.lock.release()
+        state.failures = 0
+        state.retry_at = 0
+        state.last_error = None
+        state.last_success = time.time()
+        return result
+
+    def execute(self, name, command, consume, timeout):
+        # Feed stdout to consume() as it is produced. stderr is drained on
+        # the side so a chatty wal-g can not block on a full pipe.
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, start_new_session=True)
+        timed_out = threading.Event()
+
+        def kill():
+            timed_out.set()
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+        timer = threading.Timer(timeout, kill)
+        timer.daemon = True
+        timer.start()
+        stderr = []
+        drain = threading.Thread(target=lambda: stderr.append(proc.stderr.read()),
+                                 daemon=True)
+        drain.start()
+        stdout = CountingReader(proc.stdout)
+        try:
+            output = consume(stdout)
+        except Exception:
+            if not timed_out.is_set():
+                proc.kill()
+                raise
+        finally:
+            timer.cancel()
+            proc.stdout.close()
+            self.reap(name, proc)
+            drain.join()
+            proc.stderr.close()
+        stderr = b''.join(stderr)
+        COMMAND_OUTPUT.labels(name, 'stdout', self.cluster).inc(stdout.bytes)
+        COMMAND_OUTPUT.labels(name, 'stderr', self.cluster).inc(len(stderr))
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(command, timeout, stderr=stderr)
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, command,
+                                                stderr=stderr)
+        return CommandResult(output, stderr)
+
+    def reap(self, name, proc):
+        # Wait with wait4() to get the resource usage of this very child,
+        # getrusage(RUSAGE_CHILDREN) would mix up concurrent commands
+        try:
+            _, status, usage = os.wait4(proc.pid, 0)
+        except ChildProcessError:
+            proc.wait()
+            return
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+        COMMAND_CPU.labels(name, 'user', self.cluster).inc(usage.ru_utime)
+        COMMAND_CPU.labels(name, 'system', self.cluster).inc(usage.ru_stime)
+        # ru_maxrss is in kilobytes on Linux
+        COMMAND_MAX_RSS.labels(name, self.cluster).set(usage.ru_maxrss * 1024)
+
+
+
+# Storage
+# -------
+
+
+class FileStorage():
+    # wal-g file backend, WALG_FILE_PREFIX
+    def __init__(self, root):
+        self.root = root
+
+    def list(self, prefix, start_after=None):
+        # (key, etag) of the objects right under prefix, like a listing
+        # with a / delimiter, only keys sorting after start_after
+        try:
+            entries = os.scandir(os.path.join(self.root, prefix))
+        except FileNotFoundError:
+            return []
+        with entries:
+            return [(prefix + entry.name, self.etag(entry.stat()))
+                    for entry in entries
+                    if (start_after is None or prefix + entry.name > start_after)
+                    and entry.is_file()]
+
+    def stat(self, key):
+        try:
+            return self.etag(os.stat(os.path.join(self.root, key)))
+        except FileNotFoundError:
+            return None
+
+    def read(self, key):
+        with open(os.path.join(self.root, key), 'rb') as f:
+            return f.read()
+
+    @staticmethod
+    def etag(st):
+        return '%x-%x' % (st.st_mtime_ns, st.st_size)
+
+
+class S3Storage():
+    # S3 compatible storage, WALG_S3_PREFIX. boto3 is not part of the
+    # default build; credentials and region come from the usual AWS_*
+    # variables, AWS_ENDPOINT and AWS_S3_FORCE_PATH_STYLE as for wal-g.
+    def __init__(self, url, pool_size=10):
+        import boto3
+        from botocore.config import Config
+        bucket, _, path = url[len('s3://'):].partition('/')
+        path = path.strip('/')
+        self.bucket = bucket
+        self.path = path + '/' if path else ''
+        path_style = os.getenv('AWS_S3_FORCE_PATH_STYLE', '').lower() == 'true'
+        self.client = boto3.client(
+            's3',
+            endpoint_url=os.getenv('AWS_ENDPOINT') or None,
+            region_name=os.getenv('AWS_REGION') or None,
+            config=Config(max_pool_connections=pool_size,
+                          s3={'addressing_style': 'path' if path_style else 'auto'}))
+
+    def list(self, prefix, start_after=None):
+        objects = []
+        options = {'StartAfter': self.path + start_after} if start_after else {}
+        pages = self.client.get_paginator('list_objects_v2').paginate(
+            Bucket=self.bucket, Prefix=self.path + prefix, Delimiter='/',
+            **options)
+        for page in pages:
+            for obj in page.get('Contents', ()):
+                objects.append((obj['Key'][len(self.path):], obj['ETag']))
+        return objects
+
+    def stat(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.head_object(Bucket=self.bucket,
+                                           Key=self.path + key)['ETag']
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def read(self, key):
+        return self.client.get_object(Bucket=self.bucket,
+                                      Key=self.path + key)['Body'].read()
+
+
+def open_storage(prefix, pool_size=10):
+    if prefix.startswith('s3://'):
+        return S3Storage(prefix, pool_size)
+    if prefix.startswith('file://'):
+        prefix = prefix[len('file://'):]
+    return FileStorage(prefix)
+
+
+# Refresh trigger
+# ---------------
+
+REFRESH_REQUESTS = Counter('walg_exporter_refresh_requests',
+                           'Refresh requests received', ['source'])
+REFRESH_RUNS = Counter('walg_exporter_refresh_runs',
+                       'Refreshes started by refresh requests')
+REFRESH_SOURCES = {b'h': 'http', b's': 'signal'}
+
+
+class RefreshTrigger():
+    # Wakes the scheduler before the next runs are due, e.g. from a
+    # backup-push hook. Requests go through a pipe: os.write takes no lock,
+    # so the signal handlers can use it too. Requests arriving within
+    # `debounce` seconds are merged into one run and runs start at least
+    # `min_gap` seconds apart, whatever the number of hooks.
+    def __init__(self, debounce=2, min_gap=30):
+        self.debounce = debounce
+        self.min_gap = min_gap
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        os.set_blocking(self.write_fd, False)
+        # First request not served yet, start of the last refresh
+        self.requested_at = None
+        self.last_run = None
+
+    def trigger(self, source=b'h'):
+        try:
+            os.write(self.write_fd, source)
+        except BlockingIOError:
+            # Pipe full, plenty of wake-ups are pending already
+            pass
+
+    def install_signals(self):
+        # SIGUSR1 asks for a refresh, SIGTERM also ends the current wait
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def on_term(sig, frame):
+            if callable(previous):
+                previous(sig, frame)
+            self.trigger(b't')
+
+        signal.signal(signal.SIGTERM, on_term)
+        signal.signal(signal.SIGUSR1, lambda sig, frame: self.trigger(b's'))
+
+    def drain(self):
+        while True:
+            try:
+                data = os.read(self.read_fd, 4096)
+            except BlockingIOError:
+                return
+            for byte, source in REFRESH_SOURCES.items():
+                if byte in data:
+                    REFRESH_REQUESTS.labels(source).inc(data.count(byte))
+                    if self.requested_at is None:
+                        self.requested_at = time.monotonic()
+
+    def wait(self, timeout):
+        # Sleep for timeout seconds at most, True when a refresh is due
+        deadline = time.monotonic() + timeout
+        while not terminate:
+            now = time.monotonic()
+            due = math.inf
+            if self.requested_at is not None:
+                due = max(self.requested_at + self.debounce,
+                          (self.last_run or -math.inf) + self.min_gap)
+                if now >= due:
+                    self.requested_at = None
+                    self.last_run = now
+                    REFRESH_RUNS.inc()
+                    return True
+            if now >= deadline:
+                return False
+            if select.select([self.read_fd], [], [], min(due, deadline) - now)[0]:
+                self.drain()
+                if self.requested_at is None:
+                    # Woken for shutdown
+                    return False
+        return False
+
+
+# Rendered output
+# ---------------
+
+RENDER_DURATION = Histogram('walg_exporter_render_duration_seconds',
+                            'Time spent rendering the exposition output',
+                            ['format'], buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1, 5))
+RenderedOutput = collections.namedtuple('RenderedOutput',
+                                        ['generation', 'rendered_at', 'body', 'gzipped'])
+
+
+class RenderCache():
+    # The registry is rendered once per collection cycle for each format
+    # asked for, with a gzip copy, and scrapes are served those bytes: any
+    # number of scrapers costs one rendering. Finished jobs invalidate the
+    # copies, max_age bounds how long the values computed at scrape time
+    # (archive_status, ages, self-metrics) can be served unchanged.
+    def __init__(self, registry, max_age):
+        self.registry = registry
+        self.max_age = max_age
+        self.outputs = {}
+        self.generations = itertools.count()
+        self.generation = next(self.generations)
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        self.generation = next(self.generations)
+
+    def fresh(self, output):
+        return (output is not None and output.generation == self.generation and
+                time.monotonic() - output.rendered_at <= self.max_age)
+
+    def get(self, encoder, content_type):
+        output = self.outputs.get(content_type)
+        if self.fresh(output):
+            return output
+        with self.lock:
+            # Scrapers arriving meanwhile wait for the same rendering
+            output = self.outputs.get(content_type)
+            if not self.fresh(output):
+                output = self.outputs[content_type] = self.render(encoder, content_type)
+        return output
+
+    def render(self, encoder, content_type):
+        generation = self.generation
+        started = time.monotonic()
+        body = encoder(self.registry)
+        gzipped = gzip.compress(body, compresslevel=6)
+        kind = 'openmetrics' if content_type.startswith('application/openmetrics-text') else 'text'
+        RENDER_DURATION.labels(kind).observe(time.monotonic() - started)
+        return RenderedOutput(generation, started, body, gzipped)
+
+
+class ExporterHandler(MetricsHandler):
+    # GET serves the rendered registry, POST /-/refresh wakes the
+    # collector. Only the host itself may trigger a refresh: every cycle
+    # costs storage requests.
+    refresh = None
+    cache = None
+
+    def do_GET(self):
+        params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        if self.cache is None or 'name[]' in params:
+            # Filtered scrapes are rendered on demand
+            return super().do_GET()
+        encoder, content_type = choose_encoder(self.headers.get('Accept'))
+        output = self.cache.get(encoder, content_type)
+        body = output.body
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        if gzip_accepted(self.headers.get('Accept-Encoding')):
+            body = output.gzipped
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path.split('?')[0] != '/-/refresh':
+            self.send_error(404)
+            return
+        if not ipaddress.ip_address(self.client_address[0]).is_loopback:
+            self.send_error(403)
+            return
+        self.refresh.trigger(b'h')
+        self.send_response(202)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+def start_server(port, refresh, cache=None):
+    # One thread per connection, so a slow scraper does not hold the others
+    handler = type('Handler', (ExporterHandler,),
+                   {'registry': REGISTRY, 'refresh': refresh, 'cache': cache})
+    server = http.server.ThreadingHTTPServer(('', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='http',
+                     daemon=True).start()
+    return server
+
+
+# Scheduler
+# ---------
+
+JOB_RUNS = Counter('walg_exporter_job_runs', 'Scheduled job runs', ['job', 'cluster'])
+JOB_MISSED = Counter('walg_exporter_job_missed',
+                     'Runs skipped because the previous run of the job was still going',
+                     ['job', 'cluster'])
+JOB_LATE = Counter('walg_exporter_job_late',
+                   'Runs started more than a second after their slot', ['job', 'cluster'])
+JOB_START_DELAY = Histogram('walg_exporter_job_start_delay_seconds',
+                            'Delay between the slot of a run and its start',
+                            ['job', 'cluster'],
+                            buckets=(0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300))
+JOB_LATE_AFTER = 1
+
+
+def job_offset(name, interval):
+    # Same for a host and job across restarts, spread over the fleet
+    key = ('%s/%s' % (socket.gethostname(), name)).encode()
+    return int.from_bytes(hashlib.sha1(key).digest()[:8], 'big') / 2.0 ** 64 * interval
+
+
+class Job():
+    __slots__ = ('name', 'cluster', 'fn', 'interval', 'offset', 'refresh',
+                 'enabled', 'lane', 'running')
+
+    def __init__(self, name, fn, interval, cluster, refresh, enabled, lane):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.cluster = cluster
+        self.offset = job_offset('%s/%s' % (cluster, name), interval)
+        self.refresh = refresh
+        self.enabled = enabled
+        self.lane = lane
+        self.running = False
+
+    def next_slot(self, now):
+        # Slots are offset + k * interval on the wall clock
+        return self.offset + (math.floor((now - self.offset) / self.interval) + 1) * self.interval
+
+
+class Scheduler():
+    # Runs every job on its own interval on a bounded pool. The slots of a
+    # job are shifted by a per-host phase, so that hosts restarted together
+    # do not list the storage in step, and a job never overlaps itself: a
+    # slot coming while the previous run still goes is counted as missed.
+    # Refresh requests run the `refresh` jobs at once. Every finished run
+    # invalidates the rendered output. Jobs of the integrity lane (wal-verify
+    # or a full binlog_005/ listing can take an hour) run on a pool of their
+    # own, so they never take the workers of backup-list, archive-status or
+    # binlog-find.
+    def __init__(self, workers, refresh, startup_spread, cache=None,
+                 integrity_workers=1):
+        self.pools = {
+            '': concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='walg-job'),
+            'integrity': concurrent.futures.ThreadPoolExecutor(
+                max_workers=integrity_workers, thread_name_prefix='walg-integrity'),
+        }
+        self.refresh = refresh
+        self.cache = cache
+        # First runs happen within this many seconds of startup
+        self.startup_spread = startup_spread
+        self.jobs = []
+        self.queue = []
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.stopping = False
+
+    def add(self, name, fn, interval, cluster='', refresh=False, enabled=None,
+            lane=''):
+        job = Job(name, fn, interval, cluster, refresh, enabled, lane)
+        self.jobs.append(job)
+        first = time.time() + job.offset * min(self.startup_spread, interval) / interval
+        heapq.heappush(self.queue, (first, next(self.sequence), job))
+        return job
+
+    def start(self, job, slot):
+        if job.enabled is not None and not job.enabled():
+            return True
+        with self.lock:
+            if job.running:
+                return False
+            job.running = True
+        if job.refresh:
+            # Refresh requests keep their distance from scheduled runs too
+            self.refresh.last_run = time.monotonic()
+        self.pools[job.lane].submit(self.execute, job, slot)
+        return True
+
+    def execute(self, job, slot):
+        delay = max(time.time() - slot, 0)
+        JOB_START_DELAY.labels(job.name, job.cluster).observe(delay)
+        if delay > JOB_LATE_AFTER:
+            JOB_LATE.labels(job.name, job.cluster).inc()
+        JOB_RUNS.labels(job.name, job.cluster).inc()
+        try:
+            job.fn()
+        except Exception as e:
+            error('%s job failed: %s', job.name, e)
+        finally:
+            with self.lock:
+                job.running = False
+            if self.cache is not None:
+                self.cache.invalidate()
+
+    def run_due(self):
+        now = time.time()
+        while self.queue and self.queue[0][0] <= now:
+            slot, _, job = heapq.heappop(self.queue)
+            # Slots that went by while the process could not run
+            # (suspended, clock step) are missed as well
+            missed = int((now - slot) // job.interval)
+            if not self.start(job, slot):
+                missed += 1
+            if missed:
+                JOB_MISSED.labels(job.name, job.cluster).inc(missed)
+            heapq.heappush(self.queue, (job.next_slot(now), next(self.sequence), job))
+
+    def stop(self):
+        self.stopping = True
+        self.refresh.trigger(b't')
+
+    def run(self):
+        while not terminate and not self.stopping:
+            timeout = self.queue[0][0] - time.time() if self.queue else 60
+            if self.refresh.wait(max(timeout, 0)):
+                now = time.time()
+                for job in self.jobs:
+                    if job.refresh:
+                        self.start(job, now)
+            self.run_due()
+        for pool in self.pools.values():
+            pool.shutdown(wait=False)